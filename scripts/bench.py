@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for uberdict.
+
+Usage: python scripts/bench.py [name ...]
+
+Runs the named benchmarks (or all of them), printing the best time per
+call of each timed statement.
+"""
+from __future__ import print_function
+
+import io
+import json
+import os
+import pickle
+import sys
+import threading
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from uberdict import frozenudict, lockedudict, udict  # noqa: E402
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def report(label, stmt, number=None, repeat=5):
+    timer = timeit.Timer(stmt)
+    if number is None:
+        number, _ = timer.autorange() if hasattr(timer, 'autorange') \
+            else (10, None)
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+    print('  %-40s %10.2f usec' % (label, best * 1e6))
+    return best
+
+
+def wide(width=10000):
+    return dict(('key%d' % i, {'value': i, 'tags': ['a', 'b']})
+                for i in range(width))
+
+
+def deep(depth=500):
+    root = node = {}
+    for i in range(depth):
+        node['level'] = i
+        node['child'] = node = {}
+    return root
+
+
+def recursive_fromdict(cls, mapping):
+    # the recursive implementation of `udict.fromdict` prior to 0.5.0
+    ud = cls()
+    for k in mapping:
+        v = dict.__getitem__(mapping, k)
+        if isinstance(v, dict):
+            v = recursive_fromdict(cls, v)
+        dict.__setitem__(ud, k, v)
+    return ud
+
+
+def recursive_todict(ud):
+    # the recursive implementation of `udict.todict` prior to 0.5.0
+    d = dict()
+    for k in ud:
+        v = dict.__getitem__(ud, k)
+        if isinstance(v, udict):
+            v = recursive_todict(v)
+        d[k] = v
+    return d
+
+
+@benchmark
+def convert():
+    for name, doc in [('wide', wide()), ('deep', deep())]:
+        ud = udict.fromdict(doc)
+        print(name)
+        report('recursive fromdict',
+               lambda: recursive_fromdict(udict, doc))
+        report('fromdict', lambda: udict.fromdict(doc))
+        report('fromdict(lists=True)',
+               lambda: udict.fromdict(doc, lists=True))
+        report('recursive todict', lambda: recursive_todict(ud))
+        report('todict', lambda: ud.todict())
+
+
+def initialized_copy(ud):
+    # `udict.copy` prior to 0.5.0
+    return udict(ud)
+
+
+@benchmark
+def construct():
+    ud = udict.fromdict(dict(('key%d' % i, i) for i in range(10000)))
+    keys = list(ud)
+    report('udict(ud)', lambda: initialized_copy(ud))
+    report('copy', lambda: ud.copy())
+    report('udict((k, None) for k in keys)',
+           lambda: udict((k, None) for k in keys))
+    report('fromkeys', lambda: udict.fromkeys(keys))
+    report('pickle', lambda: pickle.loads(pickle.dumps(ud, 2)))
+
+
+def recursive_merge(base, other):
+    # merging by hand over `todict` copies, as done before 0.5.0
+    result = dict(base)
+    for key, value in other.items():
+        if isinstance(value, dict) and isinstance(result.get(key), dict):
+            value = recursive_merge(result[key], value)
+        result[key] = value
+    return result
+
+
+@benchmark
+def merge():
+    base = udict.fromdict(wide(25000))
+    other = dict(('key%d' % i, {'value': -i}) for i in range(0, 25000, 2))
+    report('recursive merge of todict copies',
+           lambda: udict.fromdict(recursive_merge(base.todict(), other)),
+           number=3)
+    report('merge', lambda: base.merge(other), number=3)
+    report('deep_update', lambda: base.copy().deep_update(other), number=3)
+
+
+def recursive_diff(old, new, path=()):
+    # diffing by hand over `todict` copies, as done before 0.5.0
+    patch = []
+    for key, value in old.items():
+        if key not in new:
+            patch.append(('remove', path + (key,), None))
+        elif isinstance(value, dict) and isinstance(new[key], dict):
+            patch.extend(recursive_diff(value, new[key], path + (key,)))
+        elif value != new[key]:
+            patch.append(('change', path + (key,), new[key]))
+    for key, value in new.items():
+        if key not in old:
+            patch.append(('add', path + (key,), value))
+    return patch
+
+
+@benchmark
+def diff():
+    old = udict.fromdict(wide(25000))
+    new = udict.fromdict(old.todict())
+    new.apply_patch([('change', 'key%d.value' % i, -1)
+                     for i in range(0, 25000, 1000)])
+    report('recursive diff of todict copies',
+           lambda: recursive_diff(old.todict(), new.todict()), number=3)
+    report('diff (separate copies)', lambda: old.diff(new), number=3)
+    shared = old.copy()
+    shared['key5'] = udict(value=-1)
+    report('diff (shared subtrees)', lambda: old.diff(shared), number=3)
+
+
+@benchmark
+def persistent():
+    doc = wide()
+    ud = udict.fromdict(doc)
+    fu = frozenudict.fromdict(doc)
+    report('snapshot: fromdict(ud)', lambda: udict.fromdict(ud), number=20)
+    report('snapshot: frozenudict', lambda: fu.copy())
+    report("update: ud['key5.value'] = 1",
+           lambda: ud.__setitem__('key5.value', 1))
+    report("update: fu.set('key5.value', 1)",
+           lambda: fu.set('key5.value', 1))
+
+
+@benchmark
+def encode():
+    ud = udict.fromdict(wide(), lists=True)
+    report('json.dumps(todict(lists=True))',
+           lambda: json.dumps(ud.todict(lists=True)), number=5)
+    report('json.dump(todict(lists=True))',
+           lambda: json.dump(ud.todict(lists=True), io.StringIO()), number=5)
+    report('toJSON', lambda: ud.toJSON(), number=5)
+    report('dump', lambda: ud.dump(io.StringIO()), number=5)
+
+
+def sections(count=250, size=250):
+    return dict(('section%d' % i,
+                 dict(('item%d' % j, {'id': j, 'name': 'item %d' % j,
+                                      'price': j * 0.5, 'active': True})
+                      for j in range(size)))
+                for i in range(count))
+
+
+@benchmark
+def reencode():
+    ud = udict.fromdict(sections())
+    counter = [0]
+
+    def change():
+        counter[0] += 1
+        for i in range(0, 250, 50):
+            ud['section%d.item7.id' % i] = counter[0]
+
+    report('toJSON after 5 changes',
+           lambda: (change(), ud.toJSON()), number=5)
+    report('toJSON(cache=True) after 5 changes',
+           lambda: (change(), ud.toJSON(cache=True)), number=5)
+
+
+def threaded(func, threads=4):
+    workers = [threading.Thread(target=func) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+@benchmark
+def concurrent():
+    # 4 threads each making 2000 calls, 1 in 20 of them an increment
+    doc = {'stats': {'hits': 0}, 'config': {'limits': {'rate': 10}}}
+    ud = udict.fromdict(doc)
+    lock = threading.Lock()
+
+    def with_lock():
+        for i in range(2000):
+            with lock:
+                if i % 20:
+                    ud['config.limits.rate']
+                else:
+                    ud['stats.hits'] += 1
+
+    lud = lockedudict.fromdict(doc)
+
+    def locked():
+        for i in range(2000):
+            if i % 20:
+                lud['config.limits.rate']
+            else:
+                lud.increment('stats.hits')
+
+    report('udict with a threading.Lock', lambda: threaded(with_lock),
+           number=5)
+    report('lockedudict', lambda: threaded(locked), number=5)
+
+
+@benchmark
+def bulk():
+    docs = [json.dumps({'id': i, 'user': {'name': 'user %d' % i},
+                        'items': [{'sku': j, 'qty': 1} for j in range(10)]})
+            for i in range(20000)]
+    report('[fromJSON(doc) for doc in docs]',
+           lambda: [udict.fromJSON(doc) for doc in docs], number=1)
+    report('list(fromJSON_many(docs))',
+           lambda: list(udict.fromJSON_many(docs)), number=1)
+    report("... keep=['id']",
+           lambda: list(udict.fromJSON_many(docs, keep=['id'])), number=1)
+
+
+@benchmark
+def binary():
+    ud = udict.fromdict(sections(20, 250))
+    records = [udict.fromdict({'id': i, 'user': {'name': 'user %d' % i},
+                               'tags': ['a', 'b'], 'score': i * 0.5,
+                               'items': [{'sku': j, 'qty': 1}
+                                         for j in range(5)]})
+               for i in range(1000)]
+    for label, dumps, loads in [
+            ('pickle', lambda value: pickle.dumps(value, -1), pickle.loads),
+            ('JSON', json.dumps, udict.fromJSON),
+            ('to_bytes', lambda value: value.to_bytes(), udict.from_bytes)]:
+        data = dumps(ud)
+        print('  %s: %d bytes' % (label, len(data)))
+        report('%s: dump' % label, lambda: dumps(ud), number=5)
+        report('%s: load' % label, lambda: loads(data), number=5)
+    for label, dumps, loads in [
+            ('pickle (1000 records)', lambda values: pickle.dumps(values, -1),
+             pickle.loads),
+            ('to_bytes_many (1000 records)', udict.to_bytes_many,
+             udict.from_bytes_many)]:
+        data = dumps(records)
+        print('  %s: %d bytes' % (label, len(data)))
+        report('%s: dump' % label, lambda: dumps(records), number=5)
+        report('%s: load' % label, lambda: loads(data), number=5)
+
+
+def main(names):
+    for name in names or sorted(BENCHMARKS):
+        print('== %s' % name)
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
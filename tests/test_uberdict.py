@@ -1,10 +1,32 @@
 from collections import Mapping
 from functools import partial
+import copy
+import io
+import itertools
+import json
 import sys
+import threading
 
 import pytest
 
-from uberdict import _descend, _get, udict
+from uberdict import (
+    _descend,
+    _get,
+    dotpath,
+    frozenudict,
+    get_json_backend,
+    json_backends,
+    lazyudict,
+    lockedudict,
+    overlayudict,
+    trackedudict,
+    register_json_backend,
+    set_json_backend,
+    udict,
+    JSONArrayParser,
+    JSONBackend,
+)
+import uberdict
 
 try:
     import cPickle as pickle
@@ -17,7 +39,7 @@ except ImportError:
     from unittest import mock
 
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 version_info = namedtuple('version_info',
                           'major,minor,micro,releaselevel,serial')
@@ -241,6 +263,47 @@ def test_init_dict_arg_dotted_key_and_nested():
     assert type(elems[0][1]) is dict  # not a udict!
 
 
+def test_init_dict_arg_hyphenated_keys():
+    d = {'a-b': 1, 'c': 2, 3: 'x-y'}
+    ud = udict(d)
+    assert ud == {'a_b': 1, 'c': 2, 3: 'x-y'}
+    assert d == {'a-b': 1, 'c': 2, 3: 'x-y'}  # unchanged
+
+
+def test_init_dict_arg_hyphenated_unicode_keys():
+    ud = udict({u'a-b': 1, u'c': 2, 3: 4})
+    assert ud == {u'a_b': 1, u'c': 2, 3: 4}
+    assert type(udict({u'a-b': 1}).popitem()[0]) is type(u'')
+    # (on python 2, 'a-b' == u'a-b')
+    assert type(udict({'a-b': 1}).popitem()[0]) is str
+    assert type(udict({u'a-b': 1}).popitem()[0]) is type(u'')
+
+
+def test_init_dict_arg_hyphenated_keys_and_kwargs():
+    assert udict({'a-b': 1}, a_b=2) == {'a_b': 2}
+    assert udict({'a-b': 1}, **{'c-d': 2}) == {'a_b': 1, 'c-d': 2}
+
+
+def test_init_hyphenated_keys_cache_bounded(monkeypatch):
+    monkeypatch.setattr(uberdict, '_hyphens', {})
+    monkeypatch.setattr(uberdict, '_MAXHYPHENS', 2)
+    udict({'a-b': 1, 'c-d': 2, 'e-f': 3})
+    assert len(uberdict._hyphens) <= 2
+
+
+def test_verbatim():
+    d = {'a-b': 1}
+    ud = udict.verbatim(d, **{'c-d': 2})
+    assert type(ud) is udict
+    assert ud == {'a-b': 1, 'c-d': 2}
+    assert type(lazyudict.verbatim()) is lazyudict
+
+
+def test_copy_keeps_keys():
+    ud = udict.verbatim({'a-b': 1})
+    assert ud.copy() == {'a-b': 1}
+
+
 def test_init_udict_arg():
     orig = udict({
         'a': {'b': 'a->b'},
@@ -822,6 +885,127 @@ def test_fromdict_udicts():
     assert items(ud) == items(d)
 
 
+def test_fromdict_lists_default_untouched():
+    lst = [{'a': 'a'}]
+    ud = udict.fromdict({'lst': lst})
+    assert ud['lst'] is lst
+    assert type(ud['lst'][0]) is dict
+
+
+def test_fromdict_lists():
+    d = {
+        'lst': [{'a': {'b': 'a->b'}}, [{'c': 'c'}], 'x'],
+        'tup': ({'d': 'd'}, ({'e': 'e'},)),
+        'a': {'lst': [1, 2]},
+    }
+    ud = udict.fromdict(d, lists=True)
+    assert ud == d
+    assert type(ud['lst']) is list
+    assert ud['lst'] is not d['lst']
+    assert type(ud['lst'][0]) is udict
+    assert type(ud['lst'][0]['a']) is udict
+    assert type(ud['lst'][1][0]) is udict
+    assert type(ud['tup']) is tuple
+    assert type(ud['tup'][0]) is udict
+    assert type(ud['tup'][1]) is tuple
+    assert type(ud['tup'][1][0]) is udict
+    assert ud['a.lst'] is not d['a']['lst']
+
+
+def test_fromdict_sequence_subclass_untouched():
+    Pair = namedtuple('Pair', 'first,second')
+    pair = Pair({'a': 'a'}, None)
+    ud = udict.fromdict({'pair': pair}, lists=True)
+    assert ud['pair'] is pair
+
+
+def _deep(depth):
+    root = node = {}
+    for i in range(depth):
+        node['child'] = node = {'level': i}
+    return root
+
+
+def test_fromdict_todict_deep():
+    depth = sys.getrecursionlimit() * 2
+    ud = udict.fromdict(_deep(depth))
+    d = ud.todict()
+    for i in range(depth):
+        ud, d = ud['child'], d['child']
+        assert type(ud) is udict
+        assert type(d) is dict
+        assert ud['level'] == d['level'] == i
+
+
+def test_fromJSON():
+    ud = udict.fromJSON('{"a": {"b": "a->b"}, "a.b": "a.b", "c": [1, 2]}')
+    assert items(ud) == [
+        ('a', udict(b='a->b')),
+        ('a.b', 'a.b'),
+        ('c', [1, 2]),
+    ]
+    assert type(ud) is udict
+    assert type(ud['a']) is udict
+
+
+def test_fromJSON_subclass():
+    class MyDict(udict):
+        pass
+    ud = MyDict.fromJSON('{"a": {"b": "a->b"}}')
+    assert type(ud) is MyDict
+    assert type(ud.a) is MyDict
+
+
+def test_fromJSON_objects_in_arrays():
+    ud = udict.fromJSON('{"lst": [{"a": {"b": 1}}, [{"c": 2}]]}')
+    assert type(ud.lst[0]) is udict
+    assert ud.lst[0].a.b == 1
+    assert ud.lst[1][0].c == 2
+
+
+def test_fromJSON_non_object():
+    lst = udict.fromJSON('[{"a": 1}, 2]')
+    assert lst == [udict(a=1), 2]
+    assert type(lst[0]) is udict
+    assert udict.fromJSON('null') is None
+
+
+def test_fromJSON_hyphenated_keys():
+    ud = udict.fromJSON('{"status-code": {"x-y": 1, "z": 2}, "a-b": 3}')
+    assert items(ud) == [
+        ('a_b', 3),
+        ('status_code', udict(x_y=1, z=2)),
+    ]
+    assert ud.status_code.x_y == 1
+
+
+def test_fromJSON_duplicate_keys():
+    assert udict.fromJSON('{"a": 1, "a": 2}') == udict(a=2)
+    assert udict.fromJSON('{"a-b": 1, "a-b": 2}') == udict(a_b=2)
+
+
+def test_fromJSON_bytes():
+    ud = udict.fromJSON(b('{"a": {"b": "\\u00e9"}}'))
+    assert ud.a.b == u'\u00e9'
+    assert udict.fromJSON(bytearray(b('{"a": 1}'))) == udict(a=1)
+
+
+def test_fromJSON_kwargs():
+    ud = udict.fromJSON('{"a": 1.5}', parse_float=str)
+    assert ud.a == '1.5'
+
+
+def test_fromJSONfile(tmpdir):
+    path = tmpdir.join('doc.json')
+    path.write('{"a": {"b-c": "a->b"}}')
+    with open(str(path)) as fp:
+        assert udict.fromJSONfile(fp) == udict(a=udict(b_c='a->b'))
+    with open(str(path), 'rb') as fp:
+        ud = udict.fromJSONfile(fp)
+    assert type(ud.a) is udict
+    assert ud.a.b_c == 'a->b'
+
+
 def test_fromkeys_classmethod():
     ud = udict.fromkeys([])
     assert ud == udict()
@@ -889,6 +1073,20 @@ def test_todict_dotted_keys():
     assert type(items(d)[0][1]) is dict
 
 
+def test_todict_lists():
+    ud = udict.fromdict({
+        'lst': [{'a': 'a'}, ({'b': 'b'},)],
+        'd': {'lst': [{}]},
+    }, lists=True)
+    d = ud.todict(lists=True)
+    assert d == ud
+    assert type(d['lst'][0]) is dict
+    assert type(d['lst'][1]) is tuple
+    assert type(d['lst'][1][0]) is dict
+    assert type(d['d']['lst'][0]) is dict
+    assert type(ud.todict()['lst'][0]) is udict
+
+
 def test_keys():
     d = dict(foo=dict(bar='barbar'))
     ud = udict.fromdict(d)
@@ -959,6 +1157,45 @@ def test_copy():
     assert copy.foo.boo is orig.foo.boo
 
 
+def test_copy_subclass():
+    orig = lazyudict(a={'b': 1})
+    copy = orig.copy()
+    assert type(copy) is lazyudict
+    assert copy == orig
+    assert copy is not orig
+
+
+def test_fromkeys_subclass():
+    ud = lazyudict.fromkeys('ab', 1)
+    assert type(ud) is lazyudict
+    assert ud == {'a': 1, 'b': 1}
+
+
+def test_fromkeys_hyphenated_keys():
+    assert udict.fromkeys(['a-b']) == {'a-b': None}
+
+
+def test_pickle_subclass():
+    orig = lazyudict({'a-b': {'c': 1}})
+    unpickled = pickle.loads(pickle.dumps(orig))
+    assert type(unpickled) is lazyudict
+    assert unpickled == orig
+
+
+def test_pickle_verbatim_keys():
+    orig = udict.verbatim({'a-b': 1})
+    assert pickle.loads(pickle.dumps(orig)) == {'a-b': 1}
+
+
+def test_frozenudict_copy_and_pickle():
+    fu = frozenudict.fromdict({'a': {'b': 1}})
+    assert fu.copy() is fu
+    unpickled = pickle.loads(pickle.dumps(fu))
+    assert type(unpickled) is frozenudict
+    assert type(unpickled.a) is frozenudict
+    assert unpickled == fu
+
+
 def test_setdefault_value_plain_not_present():
     ud = udict()
     child = udict()
@@ -1227,9 +1464,11 @@ def test_subclass_missing_instance_variable_ignored():
     version_info(2, 7, 13, 'final', 0),
     version_info(3, 6, 2, 'final', 0),
 ])
-def test_iteritems(version_info):
+def test_iteritems(version_info, monkeypatch):
     assert version_info.major in (2, 3)
-    sys.modules.pop('uberdict', None)
+    # (the original module is restored afterwards, so that the udicts of
+    # the other tests can still be pickled)
+    monkeypatch.delitem(sys.modules, 'uberdict', raising=False)
     dct = mock.MagicMock()
     method = 'iteritems' if version_info[0] == 2 else 'items'
     with mock.patch.object(sys, 'version_info') as v_info:
@@ -1238,3 +1477,2340 @@ def test_iteritems(version_info):
         import uberdict
         uberdict.iteritems(dct)
         getattr(dct, method).assert_called_once_with()
+
+
+def test_dotpath_tokens():
+    path = dotpath('a.b.c')
+    assert path.key == 'a.b.c'
+    assert path.tokens == ('a', 'b', 'c')
+    assert path.parents == ('a', 'b')
+    assert path.token == 'c'
+    assert repr(path) == "dotpath('a.b.c')"
+
+
+def test_dotpath_call(udict_):
+    assert dotpath('1.2.3')(udict_) == '1->2->3'
+    assert dotpath('a')(udict_) == udict(b='a->b')
+    with pytest.raises(KeyError):
+        dotpath('1.Z.X')(udict_)
+    with pytest.raises(TypeError):
+        dotpath('a.b.c')(udict_)
+
+
+def test_dotpath_plain_dict(dict_):
+    assert dotpath('1.2.3')(dict_) == '1->2->3'
+    assert dotpath('1.2.3').get(dict_) == '1->2->3'
+
+
+def test_dotpath_get(udict_):
+    assert dotpath('a.b').get(udict_) == 'a->b'
+    assert dotpath('a.x').get(udict_) is None
+    assert dotpath('x.y.z').get(udict_, 42) == 42
+
+
+def test_dotpath_set(udict_):
+    dotpath('1.2.4').set(udict_, '1->2->4')
+    assert udict_['1.2.4'] == '1->2->4'
+    with pytest.raises(KeyError):
+        dotpath('x.y').set(udict_, None)
+
+
+def test_dotpath_delete(udict_):
+    dotpath('1.2.3').delete(udict_)
+    assert udict_['1.2'] == udict()
+    with pytest.raises(KeyError):
+        dotpath('1.2.3').delete(udict_)
+
+
+def test_dotpath_exists(udict_):
+    assert dotpath('a.b').exists(udict_)
+    assert dotpath('1.2').exists(udict_)
+    assert not dotpath('a.c').exists(udict_)
+    assert not dotpath('x.y').exists(udict_)
+
+
+def test_dotted_key_compiled_once():
+    ud = udict(a=udict(b=1))
+    uberdict._cache.clear()
+    assert ud['a.b'] == 1
+    path = uberdict._cache['a.b']
+    assert ud.get('a.b') == 1
+    assert uberdict._cache['a.b'] is path
+
+
+def test_dotted_key_cache_bounded(monkeypatch):
+    monkeypatch.setattr(uberdict, '_MAXCACHE', 4)
+    uberdict._cache.clear()
+    ud = udict()
+    for i in range(10):
+        ud.get('a.%d' % i)
+        assert len(uberdict._cache) <= 4
+
+
+def test_get_many(udict_):
+    keys = ['1.2.3', 'a.b', 'c', 'a', '1.2.x', 'x.y.z', 'a.b', None]
+    assert udict_.get_many(keys) == [udict_.get(key) for key in keys]
+    assert udict_.get_many(keys, 42) == [udict_.get(key, 42) for key in keys]
+
+
+def test_get_many_empty(udict_):
+    assert udict_.get_many([]) == []
+    assert udict_.get_many(iter(['c'])) == ['c']
+
+
+def test_get_many_through_non_dict_typeerror(udict_):
+    with pytest.raises(TypeError):
+        udict_.get_many(['a.b.c'])
+
+
+def test_get_many_shared_prefix_traversed_once():
+    child = mock.MagicMock()
+    child.__getitem__.side_effect = {'b': udict(c=1, d=2)}.__getitem__
+    ud = udict(a=child)
+    assert ud.get_many(['a.b.c', 'a.b.d', 'a.b.e']) == [1, 2, None]
+    assert child.__getitem__.call_count == 1
+
+
+def test_get_many_subclass_missing():
+    ud = DefaultDict(fail_factory, a=DefaultDict(int))
+    assert ud.get_many(['b', 'a.b']) == [None, 0]
+
+
+def test_set_many(udict_):
+    udict_.set_many({
+        '1.2.3': 'three',
+        '1.2.4': 'four',
+        'a.c': 'a->c',
+        'd': 'd',
+    })
+    assert udict_['1.2'] == udict({'3': 'three', '4': 'four'})
+    assert udict_['a'] == udict(b='a->b', c='a->c')
+    assert udict_['d'] == 'd'
+
+
+def test_set_many_dotted_keys_in_mapping():
+    ud = udict(a=udict())
+    ud.set_many(udict({'a.b': 'a->b'}))
+    assert ud == udict(a=udict(b='a->b'))
+
+
+def test_set_many_parent_before_child():
+    ud = udict()
+    ud.set_many({'a.b': 'a->b', 'a': udict()})
+    assert ud == udict(a=udict(b='a->b'))
+
+
+def test_set_many_missing_parent():
+    ud = udict()
+    with pytest.raises(KeyError):
+        ud.set_many({'a.b': 'a->b'})
+
+
+@pytest.fixture
+def lazyudict_(dict_):
+    return lazyudict(dict_)
+
+
+def test_lazyudict_children_plain_until_accessed(lazyudict_, dict_):
+    assert type(dict.__getitem__(lazyudict_, 'a')) is dict
+    assert lazyudict_ == dict_
+
+
+def test_lazyudict_getitem(lazyudict_, dict_):
+    a = lazyudict_['a']
+    assert type(a) is lazyudict
+    assert a == dict_['a']
+    assert dict.__getitem__(lazyudict_, 'a') is a
+    assert lazyudict_['a'] is a
+    assert dict_['a'] is not a
+
+
+def test_lazyudict_getitem_dotted(lazyudict_):
+    two = lazyudict_['1.2']
+    assert type(two) is lazyudict
+    assert lazyudict_['1.2'] is two
+    assert lazyudict_['1.2.3'] == '1->2->3'
+    assert type(lazyudict_['1']) is lazyudict
+    assert lazyudict_['1']['2'] is two
+
+
+def test_lazyudict_dotted_does_not_change_source():
+    src = {'a': {'b': {'c': 1}}, 'd': udict(e={'f': 2})}
+    ud = lazyudict(src)
+    assert type(ud['a.b']) is lazyudict
+    assert type(ud.get('a.b')) is lazyudict
+    assert type(src['a']['b']) is dict
+    assert ud['a.b'] is ud.a.b
+    assert type(dict.__getitem__(ud, 'a')) is lazyudict
+    assert type(ud.get('d.e')) is lazyudict
+    assert type(src['d']['e']) is dict
+
+
+def test_lazyudict_getattr(lazyudict_):
+    assert lazyudict_.a.b == 'a->b'
+    assert type(lazyudict_.a) is lazyudict
+    assert lazyudict_.a is lazyudict_['a']
+    assert getattr(lazyudict_, '1').get('2.3') == '1->2->3'
+    with pytest.raises(AttributeError):
+        lazyudict_.missing
+
+
+def test_lazyudict_get(lazyudict_):
+    assert type(lazyudict_.get('a')) is lazyudict
+    assert type(lazyudict_.get('1.2')) is lazyudict
+    assert lazyudict_.get('1.2') is lazyudict_.get('1.2')
+    assert lazyudict_.get('1.2.3') == '1->2->3'
+    assert lazyudict_.get('x.y', 42) == 42
+    assert lazyudict_.get('x', {}) == {}
+    assert 'x' not in lazyudict_
+
+
+def test_lazyudict_get_many(lazyudict_):
+    values = lazyudict_.get_many(['1.2', 'c', 'x'], 42)
+    assert values == [udict({'3': '1->2->3'}), 'c', 42]
+    assert type(values[0]) is lazyudict
+    assert lazyudict_['1.2'] is values[0]
+
+
+def test_lazyudict_setdefault(lazyudict_):
+    assert type(lazyudict_.setdefault('a', None)) is lazyudict
+    assert lazyudict_.setdefault('x', {}) == {}
+
+
+def test_lazyudict_pop(lazyudict_):
+    assert type(lazyudict_.pop('a')) is lazyudict
+    assert 'a' not in lazyudict_
+
+
+def test_lazyudict_contains_does_not_convert(lazyudict_):
+    assert '1.2' in lazyudict_
+    assert type(dict.__getitem__(lazyudict_, '1')) is dict
+
+
+def test_lazyudict_missing_not_stored():
+    class LazyDefault(lazyudict):
+        def __missing__(self, key):
+            return {'default': key}
+    ud = LazyDefault()
+    assert ud['x'] == {'default': 'x'}
+    assert type(ud['x']) is LazyDefault
+    assert 'x' not in ud
+
+
+# conformance tests that every registered JSON backend must pass
+
+@pytest.fixture(params=json_backends())
+def json_backend(request):
+    return request.param
+
+
+def test_json_backend_fromJSON(json_backend):
+    ud = udict.fromJSON('{"a": {"b": "a->b"}, "a.b": "a.b", "c": [1, 2.5]}',
+                        backend=json_backend)
+    assert items(ud) == [
+        ('a', udict(b='a->b')),
+        ('a.b', 'a.b'),
+        ('c', [1, 2.5]),
+    ]
+    assert type(ud) is udict
+    assert type(ud['a']) is udict
+
+
+def test_json_backend_fromJSON_subclass(json_backend):
+    ud = lazyudict.fromJSON('{"a": {"b": "a->b"}}', backend=json_backend)
+    assert type(ud) is lazyudict
+    assert type(dict.__getitem__(ud, 'a')) is lazyudict
+
+
+def test_json_backend_fromJSON_objects_in_arrays(json_backend):
+    ud = udict.fromJSON('{"lst": [{"a": {"b": 1}}, [{"c": 2}]]}',
+                        backend=json_backend)
+    assert type(ud.lst) is list
+    assert type(ud.lst[0]) is udict
+    assert ud.lst[0].a.b == 1
+    assert ud.lst[1][0].c == 2
+
+
+def test_json_backend_fromJSON_non_object(json_backend):
+    lst = udict.fromJSON('[{"a": 1}, 2]', backend=json_backend)
+    assert lst == [udict(a=1), 2]
+    assert type(lst[0]) is udict
+    assert udict.fromJSON('null', backend=json_backend) is None
+
+
+def test_json_backend_fromJSON_hyphenated_keys(json_backend):
+    ud = udict.fromJSON('{"status-code": {"x-y": 1, "z": 2}, "a-b": 3}',
+                        backend=json_backend)
+    assert items(ud) == [
+        ('a_b', 3),
+        ('status_code', udict(x_y=1, z=2)),
+    ]
+
+
+def test_json_backend_fromJSON_bytes(json_backend):
+    ud = udict.fromJSON(b('{"a": {"b": "\\u00e9"}}'), backend=json_backend)
+    assert ud.a.b == u'\u00e9'
+
+
+def test_json_backend_toJSON(json_backend):
+    ud = udict.fromdict({'a': {'b': [udict(c=None)]}, 'a.b': True})
+    encoded = ud.toJSON(backend=json_backend)
+    assert isinstance(encoded, type(u''))
+    assert udict.fromJSON(encoded) == ud
+
+
+def test_json_backend_dump(json_backend):
+    ud = udict.fromdict({'a': {'b': [udict(c=None)]}, 'a.b': True})
+    fp = io.StringIO()
+    ud.dump(fp, backend=json_backend)
+    assert udict.fromJSON(fp.getvalue()) == ud
+    assert ''.join(ud.iterJSON(backend=json_backend)) == fp.getvalue()
+
+
+def test_json_backend_iter_json_lines(json_backend):
+    fp = io.BytesIO(b('{"a-b": {"c": 1}}\n\n[{"d": 2}]\n'))
+    values = list(udict.iter_json_lines(fp, backend=json_backend))
+    assert values == [udict(a_b=udict(c=1)), [udict(d=2)]]
+    assert type(values[0].a_b) is udict
+    assert type(values[1][0]) is udict
+
+
+def test_json_backend_write_json_lines(json_backend):
+    fp = io.StringIO()
+    records = [udict(a=udict(b=1)), udict(c=[udict(d=None)])]
+    assert udict.write_json_lines(records, fp, backend=json_backend) == 2
+    lines = fp.getvalue().splitlines()
+    assert len(lines) == 2
+    assert [udict.fromJSON(line) for line in lines] == records
+
+
+def test_fromJSON_unknown_backend():
+    with pytest.raises(ValueError):
+        udict.fromJSON('{}', backend='nosuchbackend')
+    with pytest.raises(ValueError):
+        set_json_backend('nosuchbackend')
+
+
+def test_set_json_backend():
+    backend = mock.Mock(spec=JSONBackend)
+    register_json_backend('test', backend)
+    try:
+        set_json_backend('test')
+        assert get_json_backend() is backend
+        assert udict.fromJSON('{}', x=1) is backend.decode.return_value
+        backend.decode.assert_called_once_with('{}', udict, x=1)
+        assert udict().toJSON() is backend.dumps.return_value
+    finally:
+        set_json_backend('json')
+        uberdict._json_backends.pop('test')
+    assert get_json_backend() is get_json_backend('json')
+
+
+def test_json_backend_default_decode():
+    class PlainBackend(JSONBackend):
+        def loads(self, data, **kwargs):
+            return json.loads(data, **kwargs)
+    ud = PlainBackend().decode('{"a-b": [{"c": {}}]}', udict)
+    assert ud == udict(a_b=[udict(c=udict())])
+    assert type(ud.a_b[0].c) is udict
+
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'sort_keys': True},
+    {'separators': (',', ':')},
+    {'indent': 2},
+    {'ensure_ascii': False},
+])
+def test_iterJSON_matches_json_dumps(kwargs):
+    ud = udict.fromdict({
+        'a': {'b': [udict(c=None), 1.5]},
+        'a.b': True,
+        'e': u'\u00e9',
+        'lst': [],
+        'd': {},
+    })
+    # (python 2's json.dumps looks up a dotted key of a udict as a path)
+    expected = json.dumps(ud.todict(lists=True), **kwargs)
+    chunks = list(ud.iterJSON(**kwargs))
+    assert all(isinstance(chunk, type(u'')) for chunk in chunks)
+    assert ''.join(chunks) == expected
+    assert ud.toJSON(**kwargs) == expected
+
+
+def test_iterJSON_chunks(monkeypatch):
+    monkeypatch.setattr(uberdict, '_MEMBERS_PER_CHUNK', 2)
+    ud = udict(a=1, b=udict(c=[1]), c=None)
+    assert list(ud.iterJSON(sort_keys=True)) == [
+        '{"a": 1, "b": {"c": [1]}', ', "c": null', '}'
+    ]
+    ud = udict(a=1, b=udict(c=[1, 2, 3]), c=None)
+    assert list(ud.iterJSON(sort_keys=True)) == [
+        '{"a": 1', ', "b": {"c": [1, 2', ', 3', ']}, "c": null', '}'
+    ]
+
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'sort_keys': True},
+    {'separators': (',', ':')},
+])
+def test_iterJSON_nested_chunks_bounded(kwargs):
+    items = [{'id': i, 'tags': ['a', 'b']} for i in range(1000)]
+    ud = udict.fromdict({'data': {'items': items, 'n': 1000}, 'e': []},
+                        lists=True)
+    chunks = list(ud.iterJSON(**kwargs))
+    assert ''.join(chunks) == json.dumps(ud, **kwargs)
+    assert len(chunks) > 10
+    assert max(len(chunk) for chunk in chunks) < 5000
+    deep = [[[items]], (items,)]
+    assert ''.join(udict(a=deep).iterJSON()) == json.dumps(udict(a=deep))
+
+
+def test_iterJSON_circular():
+    ud = udict(a=list(range(100)))
+    ud.a.append(ud)
+    with pytest.raises(ValueError):
+        ''.join(ud.iterJSON())
+
+
+def test_iterJSON_empty():
+    assert ''.join(udict().iterJSON()) == '{}'
+
+
+def test_iterJSON_non_string_keys():
+    ud = udict.fromdict({1: 'one', None: 'none', 'a': {2.5: 'x'}})
+    assert ''.join(ud.iterJSON()) == json.dumps(ud)
+    assert udict.fromJSON(ud.toJSON()) == {
+        '1': 'one', 'null': 'none', 'a': {'2.5': 'x'}
+    }
+
+
+def test_iterJSON_custom_encoder():
+    class Encoder(json.JSONEncoder):
+        def default(self, obj):
+            if isinstance(obj, set):
+                return sorted(obj)
+            return json.JSONEncoder.default(self, obj)
+    ud = udict(s=set([2, 1]))
+    assert ''.join(ud.iterJSON(cls=Encoder)) == '{"s": [1, 2]}'
+    with pytest.raises(TypeError):
+        ud.toJSON()
+
+
+def test_dump_does_not_copy():
+    ud = udict(a=udict(b=1))
+    fp = io.StringIO()
+    with mock.patch.object(udict, 'todict') as todict:
+        ud.dump(fp)
+    assert not todict.called
+    assert json.loads(fp.getvalue()) == ud
+
+
+def test_json_backend_toJSON_cache(json_backend):
+    ud = udict.fromdict({'a': {'b': [udict(c=None)], 'd': {'e': 1}}, 'f': 2})
+    encoded = ud.toJSON(backend=json_backend, cache=True)
+    assert encoded == ud.toJSON(backend=json_backend)
+    ud.a.d.e = 3
+    assert udict.fromJSON(ud.toJSON(backend=json_backend, cache=True)) == ud
+
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'sort_keys': True},
+    {'separators': (',', ':')},
+    {'ensure_ascii': False},
+])
+def test_toJSON_cache_matches_json_dumps(kwargs):
+    ud = udict.fromdict({
+        'a': {'b': [udict(c=None), 1.5], 'c': {'d': 1}},
+        'a.b': True,
+        'e': u'\u00e9',
+        'lst': [],
+        'd': {},
+        'z': {'y': {'x': None}, 'w': 'v'},
+    })
+    # (python 2's json.dumps looks up a dotted key of a udict as a path)
+    expected = json.dumps(ud.todict(lists=True), **kwargs)
+    for _ in range(2):
+        assert ud.toJSON(cache=True, **kwargs) == expected
+
+
+def test_toJSON_cache_reuses_fragments():
+    ud = udict.fromdict({'a': {'b': {'c': 1}}, 'd': {'e': 2}})
+    expected = json.dumps(ud)
+    assert ud.toJSON(cache=True) == expected
+    with mock.patch.object(json.JSONEncoder, 'encode',
+                           side_effect=json.JSONEncoder.encode,
+                           autospec=True) as encode:
+        assert ud.toJSON(cache=True) == expected
+        # only the probe for the separators
+        assert encode.call_count == 1
+        encode.reset_mock()
+        ud.a.b.c = 3
+        assert ud.toJSON(cache=True) == expected.replace('1', '3')
+        # the probe, the members of b, the key b, and the keys a and d
+        assert encode.call_count == 5
+
+
+@pytest.mark.parametrize('change', [
+    lambda ud: ud.__setitem__('a.b.c', 3),
+    lambda ud: ud.a.b.__setattr__('c', 3),
+    lambda ud: ud.a.b.update(x=1),
+    lambda ud: ud.a.b.pop('c'),
+    lambda ud: ud.a.b.clear(),
+    lambda ud: ud.a.b.setdefault('x', 1),
+    lambda ud: ud.a.__delitem__('b'),
+    lambda ud: ud.deep_update({'a': {'b': {'c': 3}}}),
+    lambda ud: ud.apply_patch([('add', 'a.b.x', [1])]),
+])
+def test_toJSON_cache_invalidation(change):
+    ud = udict.fromdict({'a': {'b': {'c': 1}}, 'd': {'e': 2}})
+    ud.toJSON(cache=True)
+    change(ud)
+    assert ud.toJSON(cache=True) == json.dumps(ud)
+
+
+def test_toJSON_cache_shared_subtree():
+    shared = udict(c=1)
+    ud = udict(a=udict(b=shared), d=udict(b=shared))
+    other = udict(x=shared)
+    ud.toJSON(cache=True)
+    other.toJSON(cache=True)
+    shared.c = 2
+    assert ud.toJSON(cache=True) == json.dumps(ud)
+    assert other.toJSON(cache=True) == json.dumps(other)
+
+
+def test_toJSON_cache_mutable_values():
+    ud = udict.fromdict({'a': {'b': [1], 'c': {'d': 1}}})
+    ud.toJSON(cache=True)
+    ud.a.b.append(2)
+    ud.a.c['e'] = udict(f=[])
+    assert ud.toJSON(cache=True) == json.dumps(ud)
+    ud.a.c.e.f.append(1)
+    assert ud.toJSON(cache=True) == json.dumps(ud)
+
+
+def test_toJSON_cache_options():
+    ud = udict.fromdict({'a': {'b': u'\u00e9'}})
+    assert ud.toJSON(cache=True) == json.dumps(ud)
+    assert (ud.toJSON(cache=True, ensure_ascii=False) ==
+            json.dumps(ud, ensure_ascii=False))
+    assert ud.toJSON(cache=True) == json.dumps(ud)
+
+
+def test_toJSON_cache_non_string_keys():
+    ud = udict.fromdict({1: 'one', 'a': {2.5: 'x', 'b': {'c': None}}})
+    assert ud.toJSON(cache=True) == json.dumps(ud)
+    ud.a.b.c = 1
+    assert ud.toJSON(cache=True) == json.dumps(ud)
+
+
+def test_toJSON_cache_frozen():
+    fu = frozenudict.fromdict({'a': {'b': [1, {'c': 2}]}, 'd': 3})
+    assert fu.toJSON(cache=True) == json.dumps(fu)
+    assert fu.toJSON(cache=True) == json.dumps(fu)
+    assert fu.set('a.e', 1).toJSON(cache=True) == json.dumps(fu.set('a.e', 1))
+
+
+def test_toJSON_cache_indent():
+    with pytest.raises(ValueError):
+        udict(a=1).toJSON(cache=True, indent=2)
+
+
+def test_iter_json_lines_text():
+    fp = io.StringIO(u'{"a": 1}\n  \n{"b": {"c": 2}}\n{"d": 3}')
+    values = list(udict.iter_json_lines(fp))
+    assert values == [udict(a=1), udict(b=udict(c=2)), udict(d=3)]
+    assert type(values[1].b) is udict
+
+
+def test_iter_json_lines_subclass():
+    fp = io.StringIO(u'{"a": {"b": 1}}\n')
+    value, = lazyudict.iter_json_lines(fp)
+    assert type(value) is lazyudict
+    assert type(dict.__getitem__(value, 'a')) is lazyudict
+
+
+def test_iter_json_lines_batches():
+    fp = io.StringIO(u''.join(u'{"i": %d}\n' % i for i in range(5)))
+    batches = list(udict.iter_json_lines(fp, batch_size=2))
+    assert batches == [
+        [udict(i=0), udict(i=1)],
+        [udict(i=2), udict(i=3)],
+        [udict(i=4)],
+    ]
+
+
+def test_iter_json_lines_is_lazy():
+    fp = mock.MagicMock()
+    fp.__iter__.return_value = iter(['{"a": 1}\n', '{"b": 2}\n'])
+    values = udict.iter_json_lines(fp)
+    assert next(values) == udict(a=1)
+    assert list(values) == [udict(b=2)]
+
+
+def test_iter_json_lines_error_lineno():
+    fp = io.StringIO(u'{"a": 1}\n\n{"b": \n')
+    values = udict.iter_json_lines(fp)
+    assert next(values) == udict(a=1)
+    with pytest.raises(ValueError) as e:
+        next(values)
+    assert str(e.value).startswith('line 3: ')
+
+
+def test_iter_json_lines_start():
+    values = udict.iter_json_lines([u'{"a": 1}\n', u'{\n'], start=41)
+    assert next(values) == udict(a=1)
+    with pytest.raises(ValueError) as e:
+        next(values)
+    assert str(e.value).startswith('line 42: ')
+    values = frozenudict.iter_json_lines([u'{\n'], start=7)
+    with pytest.raises(ValueError) as e:
+        next(values)
+    assert str(e.value).startswith('line 7: ')
+
+
+needs_asyncio = pytest.mark.skipif(sys.version_info < (3, 6),
+                                   reason='needs python 3.6')
+
+
+class FakeStreamReader(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.sizes = []
+
+    def read(self, n=-1):
+        import asyncio
+        self.sizes.append(n)
+        chunk, self.data = self.data[:n], self.data[n:]
+        return asyncio.sleep(0, result=chunk)
+
+
+class CountingExecutor(object):
+
+    def __init__(self):
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(1)
+        self.calls = 0
+
+    def submit(self, func, *args):
+        self.calls += 1
+        return self.executor.submit(func, *args)
+
+
+def run_async(coroutine):
+    import asyncio
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def collect_async(iterator):
+    # the equivalent of `[value async for value in iterator]`
+    import asyncio
+    loop = asyncio.new_event_loop()
+    values = []
+    try:
+        while True:
+            try:
+                values.append(loop.run_until_complete(iterator.__anext__()))
+            except StopAsyncIteration:  # noqa: F821
+                return values
+    finally:
+        loop.close()
+
+
+@needs_asyncio
+@pytest.mark.parametrize('data', [
+    b('{"a-b": {"c": [1, {"d": 2}]}}'),
+    u'{"a-b": {"c": [1, {"d": 2}]}}',
+])
+def test_afromJSON(data):
+    reader = FakeStreamReader(data)
+    ud = run_async(udict.afromJSON(reader, chunk_size=4))
+    assert ud == {'a_b': {'c': [1, {'d': 2}]}}
+    assert type(ud.a_b.c[1]) is udict
+    assert set(reader.sizes) == {4}
+
+
+@needs_asyncio
+def test_afromJSON_arguments():
+    reader = FakeStreamReader(b('{"a": {"b": 1, "c": 2.5}}'))
+    fu = run_async(frozenudict.afromJSON(reader, keep=['a.c'],
+                                         parse_float=str))
+    assert fu == {'a': {'c': '2.5'}}
+    assert type(fu) is frozenudict
+    with pytest.raises(ValueError):
+        run_async(udict.afromJSON(FakeStreamReader(b(''))))
+
+
+@needs_asyncio
+def test_afromJSON_offload():
+    executor = CountingExecutor()
+    data = b('{"a": "%s"}' % ('x' * 100))
+    ud = run_async(udict.afromJSON(FakeStreamReader(data), executor=executor,
+                                   offload_size=len(data)))
+    assert ud.a == 'x' * 100
+    assert executor.calls == 1
+    run_async(udict.afromJSON(FakeStreamReader(data), executor=executor,
+                              offload_size=len(data) + 1))
+    run_async(udict.afromJSON(FakeStreamReader(data), executor=executor,
+                              offload_size=None))
+    assert executor.calls == 1
+
+
+@needs_asyncio
+@pytest.mark.parametrize('chunk_size', [1, 5, 64, 65536])
+def test_aiter_json_lines(chunk_size):
+    data = b('{"a-b": 1}\n\n[{"c": 2}]\n{"d": {"e": 3}}')
+    values = collect_async(udict.aiter_json_lines(FakeStreamReader(data),
+                                                  chunk_size=chunk_size))
+    assert values == list(udict.iter_json_lines(io.BytesIO(data)))
+    assert values == [{'a_b': 1}, [{'c': 2}], {'d': {'e': 3}}]
+    assert type(values[2].d) is udict
+
+
+@needs_asyncio
+def test_aiter_json_lines_text_and_batches():
+    reader = FakeStreamReader(u'{"a": 1}\n{"b": 2}\n{"c": 3}\n')
+    values = collect_async(
+        trackedudict.aiter_json_lines(reader, batch_size=2, chunk_size=3))
+    assert values == [[{'a': 1}, {'b': 2}], [{'c': 3}]]
+    assert type(values[0][0]) is trackedudict
+
+
+@needs_asyncio
+def test_aiter_json_lines_empty():
+    reader = FakeStreamReader(b(''))
+    assert collect_async(udict.aiter_json_lines(reader)) == []
+
+
+@needs_asyncio
+def test_aiter_json_lines_error_lineno():
+    reader = FakeStreamReader(b('{"a": 1}\n\n{"b": 2}\n{"c": \n'))
+    with pytest.raises(ValueError) as e:
+        collect_async(udict.aiter_json_lines(reader, chunk_size=3))
+    assert str(e.value).startswith('line 4: ')
+
+
+@needs_asyncio
+def test_aiter_json_lines_offload():
+    executor = CountingExecutor()
+    data = b('{"a": 1}\n{"b": 2}\n%s\n' % ('{"c": "%s"}' % ('x' * 100)))
+    values = collect_async(udict.aiter_json_lines(
+        FakeStreamReader(data), chunk_size=20, executor=executor,
+        offload_size=100))
+    assert values == [{'a': 1}, {'b': 2}, {'c': 'x' * 100}]
+    assert executor.calls == 1
+
+
+@needs_asyncio
+def test_aiter_json_lines_long_line():
+    import asyncio
+    line = b('{"a": "%s"}\n') % (b('x') * (1 << 22))
+    chunks = [line[i:i + 1000] for i in range(0, len(line), 1000)]
+    chunks.append(b('{"b": 1}'))
+    reader = mock.Mock()
+    reader.read.side_effect = lambda n: asyncio.sleep(
+        0, result=chunks.pop(0) if chunks else b(''))
+    values = collect_async(udict.aiter_json_lines(reader))
+    assert values == [{'a': 'x' * (1 << 22)}, {'b': 1}]
+
+
+def test_write_json_lines_batches():
+    fp = mock.Mock()
+    count = udict.write_json_lines(
+        (udict(i=i) for i in range(5)), fp, batch_size=2)
+    assert count == 5
+    assert fp.write.call_args_list == [
+        mock.call('{"i": 0}\n{"i": 1}\n'),
+        mock.call('{"i": 2}\n{"i": 3}\n'),
+        mock.call('{"i": 4}\n'),
+    ]
+
+
+def test_write_json_lines_empty():
+    fp = io.StringIO()
+    assert udict.write_json_lines([], fp) == 0
+    assert fp.getvalue() == ''
+
+
+def test_write_json_lines_kwargs():
+    fp = io.StringIO()
+    udict.write_json_lines([udict(b=1, a=2)], fp, sort_keys=True,
+                           separators=(',', ':'))
+    assert fp.getvalue() == '{"a":2,"b":1}\n'
+
+
+def test_write_json_lines_indent():
+    fp = io.StringIO()
+    with pytest.raises(ValueError):
+        udict.write_json_lines([udict(a=udict(b=1))], fp, indent=2)
+    assert fp.getvalue() == ''
+    udict.write_json_lines([udict(a=1)], fp, indent=None)
+    assert list(udict.iter_json_lines(io.StringIO(fp.getvalue()))) == [
+        udict(a=1)]
+
+
+_ARRAY_DOC = u"""
+{
+  "meta": {"items": "not this one", "n": [1, 2]},
+  "data": {
+    "skipped": [{"a": 1}],
+    "items": [
+      {"id": 1, "name": "a \\"quoted\\" ] name", "tags": ["x", "y"]},
+      {"id": 2, "nested": {"lst": [{"k-1": "\\u00e9"}]}},
+      3,
+      "four, five",
+      [6, {"seven": 7}]
+    ],
+    "after": {"x": 1}
+  }
+}
+"""
+
+
+def _feed_all(parser, doc, size):
+    values = []
+    for i in range(0, len(doc), size):
+        values.extend(parser.feed(doc[i:i + size]))
+    parser.close()
+    return values
+
+
+@pytest.mark.parametrize('size', [1, 2, 7, 1000])
+def test_json_array_parser_path(size, json_backend):
+    parser = JSONArrayParser('data.items', backend=json_backend)
+    values = _feed_all(parser, _ARRAY_DOC, size)
+    expected = json.loads(_ARRAY_DOC)['data']['items']
+    expected[1]['nested']['lst'][0] = {'k_1': u'\u00e9'}
+    assert values == expected
+    assert type(values[0]) is udict
+    assert type(values[1].nested.lst[0]) is udict
+    assert type(values[4][1]) is udict
+
+
+@pytest.mark.parametrize('size', [1, 3, 1000])
+def test_json_array_parser_bytes(size):
+    doc = _ARRAY_DOC.encode('utf-8')
+    values = _feed_all(JSONArrayParser('data.items'), doc, size)
+    assert values[1].nested.lst[0].k_1 == u'\u00e9'
+
+
+def test_json_array_parser_top_level():
+    values = _feed_all(JSONArrayParser(), u' [ {"a": [1]}, {"b": {}} ] ', 3)
+    assert values == [udict(a=[1]), udict(b=udict())]
+
+
+def test_json_array_parser_empty():
+    assert _feed_all(JSONArrayParser(), u'[]', 1) == []
+    assert _feed_all(JSONArrayParser('a'), u'{"a": [ ]}', 1) == []
+
+
+def test_json_array_parser_hyphenated_path():
+    doc = u'{"the-data": {"the_items": [1, 2]}}'
+    assert _feed_all(JSONArrayParser('the_data.the-items'), doc, 4) == [1, 2]
+
+
+def test_json_array_parser_subclass():
+    values = _feed_all(JSONArrayParser(cls=lazyudict), u'[{"a": {}}]', 2)
+    assert type(values[0]) is lazyudict
+
+
+def test_json_array_parser_elements_as_completed():
+    parser = JSONArrayParser()
+    assert parser.feed(u'[{"a": 1}, {"b"') == [udict(a=1)]
+    assert parser.feed(u': 2}') == []
+    assert parser.feed(u']') == [udict(b=2)]
+    assert parser.done
+    assert parser.feed(u'trailing') == []
+    parser.close()
+
+
+def test_json_array_parser_number_split():
+    parser = JSONArrayParser()
+    assert parser.feed(u'[12') == []
+    assert parser.feed(u'3, 4') == [123]
+    assert parser.feed(u'5]') == [45]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 1000])
+@pytest.mark.parametrize('doc, expected', [
+    (u'[1.25]', [1.25]),
+    (u'[1.5e3, 2]', [1500.0, 2]),
+    (u'[-12, 1E-2 ,3]', [-12, 0.01, 3]),
+])
+def test_json_array_parser_number_prefix(doc, expected, size, json_backend):
+    parser = JSONArrayParser(backend=json_backend)
+    assert _feed_all(parser, doc, size) == expected
+    assert list(udict.iter_json_array(io.StringIO(doc), chunk_size=size)) \
+        == expected
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 4, 5])
+def test_json_array_parser_string_split(size):
+    doc = u'{"k\\"-": {"\\\\": ["a\\\\", "b\\"],", "\\u00e9"]}}'
+    values = _feed_all(JSONArrayParser(u'k"-.\\'), doc, size)
+    assert values == [u'a\\', u'b"],', u'\u00e9']
+
+
+def test_json_array_parser_long_string():
+    parser = JSONArrayParser()
+    assert parser.feed(u'["') == []
+    for i in range(1000):
+        assert parser.feed(u'x\\"' * 100) == []
+        assert len(parser._buf) == 300
+    assert parser.feed(u'", 1]') == [u'x"' * 100000, 1]
+
+
+def test_json_array_parser_buffer_bounded():
+    parser = JSONArrayParser()
+    parser.feed(u'[')
+    for i in range(100):
+        parser.feed(u'{"i": %d}, ' % i)
+        assert len(parser._buf) < 20
+
+
+def test_json_array_parser_no_array():
+    parser = JSONArrayParser('missing')
+    assert parser.feed(u'{"a": [1, 2]}') == []
+    with pytest.raises(ValueError) as e:
+        parser.close()
+    assert 'no JSON array' in str(e.value)
+
+
+def test_json_array_parser_incomplete():
+    parser = JSONArrayParser()
+    assert parser.feed(u'[1, 2') == [1]
+    with pytest.raises(ValueError) as e:
+        parser.close()
+    assert 'incomplete' in str(e.value)
+
+
+def test_json_array_parser_bad_element():
+    parser = JSONArrayParser()
+    with pytest.raises(ValueError):
+        parser.feed(u'[{"a": }]')
+
+
+def test_iter_json_array():
+    fp = io.StringIO(_ARRAY_DOC)
+    values = list(udict.iter_json_array(fp, 'data.items', chunk_size=5))
+    assert len(values) == 5
+    assert values[0].name == u'a "quoted" ] name'
+
+
+def test_iter_json_array_stops_reading():
+    fp = io.BytesIO(b('[1, 2] this is never read'))
+    fp.read = mock.Mock(side_effect=fp.read)
+    assert list(udict.iter_json_array(fp, chunk_size=6)) == [1, 2]
+    assert fp.read.call_count == 1
+
+
+def test_iter_json_array_incomplete():
+    values = udict.iter_json_array(io.StringIO(u'[1, 2'))
+    assert next(values) == 1
+    with pytest.raises(ValueError):
+        next(values)
+
+
+_PROJECT_DOC = {
+    'id': 1,
+    'meta': {'created': 'today', 'owner': {'name': 'x', 'email': 'y'}},
+    'items': [{'id': 2, 'blob': 'z' * 10}, {'id': 3, 'blob': ''}, 4],
+    'pair': ({'id': 5, 'blob': ''},),
+}
+
+
+def test_fromdict_keep():
+    d = udict.fromdict(_PROJECT_DOC, keep=['id', 'meta.owner.name'])
+    assert d == {'id': 1, 'meta': {'owner': {'name': 'x'}}}
+    assert isinstance(d.meta.owner, udict)
+
+
+def test_fromdict_keep_through_lists():
+    d = udict.fromdict(_PROJECT_DOC, keep=['items.id', 'pair.id'])
+    assert d == {'items': [{'id': 2}, {'id': 3}, 4], 'pair': ({'id': 5},)}
+    assert isinstance(d['items'][0], udict)
+    assert type(d.pair) is tuple
+
+
+def test_fromdict_keep_prefix_wins():
+    d = udict.fromdict(_PROJECT_DOC, keep=['meta.owner.name', 'meta'])
+    assert d == {'meta': _PROJECT_DOC['meta']}
+    assert isinstance(d.meta.owner, udict)
+
+
+def test_fromdict_keep_missing_and_scalar():
+    assert udict.fromdict(_PROJECT_DOC, keep=['nope', 'id.x']) == {}
+
+
+def test_fromdict_drop():
+    d = udict.fromdict(_PROJECT_DOC, drop=['items.blob', 'pair', 'meta.owner'])
+    assert d == {
+        'id': 1,
+        'meta': {'created': 'today'},
+        'items': [{'id': 2}, {'id': 3}, 4],
+    }
+    assert _PROJECT_DOC['meta']['owner'] == {'name': 'x', 'email': 'y'}
+
+
+def test_fromdict_keep_and_drop():
+    d = udict.fromdict(_PROJECT_DOC, keep=['meta'], drop=['meta.owner.email'])
+    assert d == {'meta': {'created': 'today', 'owner': {'name': 'x'}}}
+
+
+def test_fromdict_drop_lists():
+    d = udict.fromdict(_PROJECT_DOC, lists=True, drop=['meta'])
+    assert isinstance(d['items'][0], udict)
+    d = udict.fromdict(_PROJECT_DOC, drop=['meta'])
+    assert d['items'] is _PROJECT_DOC['items']
+
+
+def test_fromJSON_keep(json_backend):
+    data = json.dumps({'a-b': {'c-d': 1, 'e': 2}, 'f': [{'g-h': 3}]})
+    d = udict.fromJSON(data, backend=json_backend, keep=['a-b.c_d', 'f.g-h'])
+    assert d == {'a_b': {'c_d': 1}, 'f': [{'g_h': 3}]}
+    assert isinstance(d.f[0], udict)
+
+
+def test_fromJSON_drop(json_backend):
+    data = json.dumps({'a-b': {'c-d': 1, 'e': [{}]}, 'f': 3})
+    d = udict.fromJSON(data, backend=json_backend, drop=['a_b.c_d', 'f'])
+    assert d == {'a_b': {'e': [{}]}}
+    assert isinstance(d.a_b.e[0], udict)
+
+
+def test_fromJSON_keep_drop_unicode_keys(json_backend):
+    data = u'{"a-b": {"c-d": 1, "e": 2}, "f": 3}'
+    d = udict.fromJSON(data, backend=json_backend, drop=[u'a-b.e', u'f'])
+    assert d == {'a_b': {'c_d': 1}}
+    d = udict.fromJSON(data, backend=json_backend, keep=[u'a_b.c-d'])
+    assert d == {'a_b': {'c_d': 1}}
+
+
+def test_frozenudict_deep_frozen():
+    fu = frozenudict({'a': {'b': [1, {'c': [2]}]}, 'd-e': 3})
+    assert fu == {'a': {'b': (1, {'c': (2,)})}, 'd_e': 3}
+    assert type(fu.a) is frozenudict
+    assert type(fu['a.b'][1]) is frozenudict
+
+
+def test_frozenudict_shares_frozen():
+    inner = frozenudict(x=1)
+    assert frozenudict(a=inner).a is inner
+
+
+def test_frozenudict_hash():
+    fu = frozenudict.fromdict({'a': {'b': [1, 2]}})
+    assert hash(fu) == hash(frozenudict.fromdict({'a': {'b': (1, 2)}}))
+    assert {fu: 1}[frozenudict.fromdict({'a': {'b': [1, 2]}})] == 1
+    assert fu.__dict__['_hash'] == hash(fu)
+
+
+def test_frozenudict_hash_cached():
+    fu = frozenudict(a=1)
+    fu.__dict__['_hash'] = 42
+    assert hash(fu) == 42
+
+
+def test_frozenudict_unhashable_value():
+    with pytest.raises(TypeError):
+        hash(frozenudict(a=set()))
+
+
+@pytest.mark.parametrize('mutate', [
+    lambda fu: fu.__setitem__('a', 2),
+    lambda fu: fu.__setitem__('b.c', 2),
+    lambda fu: fu.__delitem__('a'),
+    lambda fu: setattr(fu, 'a', 2),
+    lambda fu: delattr(fu, 'a'),
+    lambda fu: fu.setdefault('x', 1),
+    lambda fu: fu.pop('a'),
+    lambda fu: fu.popitem(),
+    lambda fu: fu.clear(),
+    lambda fu: fu.update(a=2),
+    lambda fu: fu.set_many({'a': 2}),
+])
+def test_frozenudict_immutable(mutate):
+    fu = frozenudict(a=1, b={'c': 1})
+    with pytest.raises(TypeError):
+        mutate(fu)
+    assert fu == {'a': 1, 'b': {'c': 1}}
+
+
+def test_frozenudict_immutable_through_udict():
+    ud = udict(f=frozenudict(a=1))
+    with pytest.raises(TypeError):
+        ud['f.a'] = 2
+    with pytest.raises(TypeError):
+        ud.pop('f.a')
+    with pytest.raises(TypeError):
+        ud.set_many({'f.b': 2})
+    assert ud.f == {'a': 1}
+
+
+def test_frozenudict_init_again():
+    fu = frozenudict(a=1, b={'c': [1]})
+    h = hash(fu)
+    fu.__init__({'z': [1]}, a=2)
+    assert fu == {'a': 1, 'b': {'c': (1,)}}
+    assert hash(fu) == h == hash(frozenudict(a=1, b={'c': [1]}))
+    empty = frozenudict()
+    empty.__init__(a=1)
+    assert empty == {}
+
+
+def test_frozenudict_reads():
+    fu = frozenudict.fromdict({'a': {'b': 1}})
+    assert fu.a.b == 1
+    assert fu['a.b'] == 1
+    assert fu.get('a.c', 2) == 2
+    assert 'a.b' in fu
+    assert fu.get_many(['a.b', 'x']) == [1, None]
+
+
+def test_frozenudict_fromdict():
+    d = {'a': {'b': [{'c': 1}]}, 'x': 1}
+    fu = frozenudict.fromdict(d)
+    assert type(fu) is frozenudict
+    assert type(fu.a.b[0]) is frozenudict
+    assert d == {'a': {'b': [{'c': 1}]}, 'x': 1}
+    assert frozenudict.fromdict(d, keep=['a.b.c']) == {'a': {'b': ({'c': 1},)}}
+
+
+def test_frozenudict_fromJSON(json_backend):
+    fu = frozenudict.fromJSON('{"a-b": [{"c": [1]}], "d": 2}',
+                              backend=json_backend)
+    assert fu == {'a_b': ({'c': (1,)},), 'd': 2}
+    assert type(fu.a_b[0]) is frozenudict
+    assert frozenudict.fromJSON('{"a-b": 1, "d": 2}', drop=['a_b']) == {'d': 2}
+
+
+def test_frozenudict_iter_json():
+    lines = list(frozenudict.iter_json_lines(io.StringIO(u'{"a": [1]}\n')))
+    assert lines == [{'a': (1,)}]
+    assert type(lines[0]) is frozenudict
+    batches = list(frozenudict.iter_json_lines(io.StringIO(u'{"a": 1}\n'),
+                                               batch_size=5))
+    assert type(batches[0][0]) is frozenudict
+    values = list(frozenudict.iter_json_array(io.StringIO(u'[{"a": [1]}]')))
+    assert values == [{'a': (1,)}]
+    assert type(values[0]) is frozenudict
+
+
+def test_frozenudict_verbatim_and_fromkeys():
+    assert frozenudict.verbatim({'a-b': [1]}) == {'a-b': (1,)}
+    fu = frozenudict.fromkeys('ab', {'c': []})
+    assert type(fu.a) is frozenudict
+    assert fu.a is fu.b
+
+
+def test_frozenudict_thaw():
+    fu = frozenudict.fromdict({'a': {'b': [{'c': 1}]}})
+    ud = fu.thaw()
+    assert type(ud) is udict
+    assert type(ud.a) is udict
+    assert type(ud.a.b[0]) is udict
+    ud.a.x = 1
+    assert 'x' not in fu.a
+
+
+def test_frozenudict_evolve():
+    fu = frozenudict.fromdict({'a': {'b': {'c': 1}, 'd': {'e': 2}}, 'f': 3})
+    evolved = fu.evolve({'a.b.c': [4]}, f=5)
+    assert evolved == {'a': {'b': {'c': (4,)}, 'd': {'e': 2}}, 'f': 5}
+    assert fu == {'a': {'b': {'c': 1}, 'd': {'e': 2}}, 'f': 3}
+    assert evolved.a.d is fu.a.d
+    assert type(evolved.a.b) is frozenudict
+
+
+def test_frozenudict_evolve_shared_prefix():
+    fu = frozenudict.fromdict({'a': {'b': 1, 'c': 2}})
+    evolved = fu.evolve({'a.b': 3, 'a.c': 4})
+    assert evolved == {'a': {'b': 3, 'c': 4}}
+    evolved = fu.evolve(OrderedDict([('a.b', 3), ('a', {'x': 1}),
+                                     ('a.y', 2)]))
+    assert evolved == {'a': {'x': 1, 'y': 2}}
+
+
+def test_frozenudict_evolve_errors():
+    fu = frozenudict.fromdict({'a': {'b': 1}})
+    with pytest.raises(KeyError):
+        fu.evolve({'x.y': 1})
+    with pytest.raises(TypeError):
+        fu.evolve({'a.b.c': 1})
+
+
+def test_frozenudict_set():
+    v1 = frozenudict.fromdict({'a': {'b': {'c': 1}}, 'x': {'y': 2}})
+    v2 = v1.set('a.b.c', {'d': [3]})
+    v3 = v2.set('z', 4)
+    assert v1 == {'a': {'b': {'c': 1}}, 'x': {'y': 2}}
+    assert v2 == {'a': {'b': {'c': {'d': (3,)}}}, 'x': {'y': 2}}
+    assert v3 == {'a': {'b': {'c': {'d': (3,)}}}, 'x': {'y': 2}, 'z': 4}
+    assert v2.x is v1.x
+    assert v3.a is v2.a
+    assert type(v2.a.b.c) is frozenudict
+    with pytest.raises(KeyError):
+        v1.set('q.r', 1)
+
+
+def test_frozenudict_remove():
+    v1 = frozenudict.fromdict({'a': {'b': 1, 'c': 2}, 'x': {'y': 3}})
+    v2 = v1.remove('a.b')
+    assert v2 == {'a': {'c': 2}, 'x': {'y': 3}}
+    assert v1.a == {'b': 1, 'c': 2}
+    assert v2.x is v1.x
+    assert v2.remove('x') == {'a': {'c': 2}}
+    with pytest.raises(KeyError):
+        v1.remove('a.q')
+    with pytest.raises(KeyError):
+        v1.remove('q')
+
+
+def test_frozenudict_versions_hash():
+    v1 = frozenudict.fromdict({'a': {'b': 1}})
+    v2 = v1.set('a.b', 2)
+    assert hash(v2.set('a.b', 1)) == hash(v1)
+    assert v2.set('a.b', 1) == v1
+
+
+@pytest.fixture
+def layers():
+    defaults = udict.fromdict({
+        'db': {'host': 'localhost', 'port': 5432, 'opts': {'ssl': False}},
+        'debug': False,
+        'name': 'app',
+    })
+    env = udict.fromdict({'db': {'host': 'prod'}, 'debug': True})
+    return udict(), env, defaults
+
+
+def test_overlayudict_reads(layers):
+    ov = overlayudict(*layers)
+    assert ov.debug is True
+    assert ov.name == 'app'
+    assert ov.db.host == 'prod'
+    assert ov['db.port'] == 5432
+    assert ov.get('db.opts.ssl') is False
+    assert ov.get('db.nope', 1) == 1
+    assert 'db.opts' in ov
+    assert 'db.opts.nope' not in ov
+    assert sorted(ov) == ['db', 'debug', 'name']
+    assert len(ov) == 3
+    with pytest.raises(KeyError):
+        ov['nope']
+    with pytest.raises(AttributeError):
+        ov.nope
+
+
+def test_overlayudict_nested_overlay(layers):
+    ov = overlayudict(*layers)
+    assert type(ov.db) is overlayudict
+    assert ov.db.maps == [layers[1].db, layers[2].db]
+    # a dict found in a single lower layer is still an overlay
+    assert type(ov.db.opts) is overlayudict
+
+
+def test_overlayudict_top_layer_dict():
+    top = udict(a=udict(b=1))
+    ov = overlayudict(top, udict(c=2))
+    assert ov.a is top.a
+
+
+def test_overlayudict_shadowing():
+    ov = overlayudict(udict(a=1), udict(a={'b': 2}))
+    assert ov.a == 1
+    ov = overlayudict(udict(a={'b': 1}), udict(a=2), udict(a={'c': 3}))
+    assert ov.a.maps == [ov.maps[0].a]
+    assert ov.todict() == {'a': {'b': 1}}
+
+
+def test_overlayudict_plain_dict_layers():
+    top = {'a': {'b': {'c': 1}}}
+    ov = overlayudict(top, {'d': {'e': 2}})
+    assert ov.a.b.c == 1
+    assert ov.d.e == 2
+    assert ov['a.b.c'] == 1
+    ov.a.b.c = 3
+    assert top == {'a': {'b': {'c': 3}}}
+
+
+def test_overlayudict_writes_go_to_top(layers):
+    top, env, defaults = layers
+    ov = overlayudict(*layers)
+    ov['db.opts.ssl'] = True
+    ov.name = 'other'
+    ov['x'] = 1
+    assert ov.db.opts.ssl is True
+    assert ov.name == 'other'
+    assert top == {'db': {'opts': {'ssl': True}}, 'name': 'other', 'x': 1}
+    assert type(top.db.opts) is udict
+    assert env == {'db': {'host': 'prod'}, 'debug': True}
+    assert defaults.db.opts.ssl is False
+
+
+def test_overlayudict_nested_writes(layers):
+    top = layers[0]
+    ov = overlayudict(*layers)
+    db = ov.db
+    db.user = 'me'
+    db['opts'].ssl = True
+    assert top == {'db': {'user': 'me', 'opts': {'ssl': True}}}
+    assert db.host == 'prod'
+    assert ov.db.user == 'me'
+
+
+def test_overlayudict_deletes(layers):
+    top = layers[0]
+    ov = overlayudict(*layers)
+    with pytest.raises(KeyError):
+        del ov['name']
+    with pytest.raises(KeyError):
+        del ov['db.host']
+    with pytest.raises(AttributeError):
+        del ov.name
+    ov['db.host'] = 'test'
+    del ov['db.host']
+    assert ov.db.host == 'prod'
+    ov.x = 1
+    del ov.x
+    assert top == {'db': {}}
+
+
+def test_overlayudict_cache(layers):
+    top = layers[0]
+    ov = overlayudict(*layers, cache=True)
+    assert ov.db is ov.db
+    assert ov['db.opts'] is ov.db.opts
+    assert ov.debug is True
+    top['debug'] = 'stale'
+    assert ov.debug is True
+    ov['db.opts.ssl'] = True
+    assert ov.debug == 'stale'
+    assert ov.db.opts.ssl is True
+
+
+def test_overlayudict_no_cache(layers):
+    ov = overlayudict(*layers)
+    layers[0]['debug'] = 'fresh'
+    assert ov.debug == 'fresh'
+
+
+def test_overlayudict_bad_kwargs():
+    with pytest.raises(TypeError):
+        overlayudict(udict(), cahce=True)
+
+
+def test_overlayudict_default_layer():
+    ov = overlayudict()
+    ov.a = 1
+    assert ov.maps == [{'a': 1}]
+
+
+def test_overlayudict_new_child(layers):
+    ov = overlayudict(*layers, cache=True)
+    child = ov.new_child()
+    child.debug = 'child'
+    assert child.debug == 'child'
+    assert ov.debug is True
+    assert child.maps[1:] == ov.maps
+    assert child.new_child(udict(x=1)).x == 1
+
+
+def test_overlayudict_todict(layers):
+    layers[2]['tags'] = ['a']
+    ov = overlayudict(*layers)
+    d = ov.todict()
+    assert d == {
+        'db': {'host': 'prod', 'port': 5432, 'opts': {'ssl': False}},
+        'debug': True,
+        'name': 'app',
+        'tags': ['a'],
+    }
+    assert type(d['db']['opts']) is dict
+    assert d['tags'] is layers[2]['tags']
+    assert ov.todict(lists=True)['tags'] is not layers[2]['tags']
+    assert ov == d
+
+
+def test_overlayudict_mutablemapping_methods(layers):
+    ov = overlayudict(*layers)
+    assert ov.setdefault('db.port', 1) == 5432
+    assert ov.setdefault('db.user', 'me') == 'me'
+    ov.update({'db.host': 'h'})
+    assert ov.pop('db.host') == 'h'
+    assert layers[0] == {'db': {'user': 'me'}}
+
+
+def test_overlayudict_repr():
+    assert repr(overlayudict(udict(a=1))) == "overlayudict({'a': 1})"
+
+
+def _merge_docs():
+    base = udict.fromdict({
+        'a': {'b': 1, 'c': [1], 'd': {'e': 2}},
+        'f': 3,
+        'g': (1,),
+    })
+    other = {'a': {'b': 10, 'c': [2], 'd': {'x': {'y': 1}}}, 'g': [2], 'h': 4}
+    return base, other
+
+
+def test_deep_update_replace():
+    base, other = _merge_docs()
+    d = base.a.d
+    assert base.deep_update(other) is None
+    assert base == {
+        'a': {'b': 10, 'c': [2], 'd': {'e': 2, 'x': {'y': 1}}},
+        'f': 3,
+        'g': [2],
+        'h': 4,
+    }
+    assert base.a.d is d
+    assert type(base.a.d.x) is udict
+    assert base.a.d.x is not other['a']['d']['x']
+
+
+def test_deep_update_keep():
+    base, other = _merge_docs()
+    base.deep_update(other, 'keep')
+    assert base == {
+        'a': {'b': 1, 'c': [1], 'd': {'e': 2, 'x': {'y': 1}}},
+        'f': 3,
+        'g': (1,),
+        'h': 4,
+    }
+
+
+def test_deep_update_append():
+    base, other = _merge_docs()
+    c = base.a.c
+    base.deep_update(other, 'append')
+    assert base.a.c == [1, 2]
+    assert c == [1]
+    assert base.g == (1, 2)
+    assert base.a.b == 10
+
+
+def test_deep_update_callable():
+    base, other = _merge_docs()
+    calls = []
+
+    def strategy(path, old, new):
+        calls.append(path)
+        return old + new if path == 'a.b' else new
+    base.deep_update(other, strategy)
+    assert base.a.b == 11
+    assert sorted(calls) == ['a.b', 'a.c', 'g']
+
+
+def test_deep_update_strategy_per_path():
+    base, other = _merge_docs()
+    base.deep_update(other, {'a': 'keep', 'a.c': 'append'})
+    assert base.a.b == 1
+    assert base.a.c == [1, 2]
+    assert base.a.d.x == {'y': 1}
+    assert base.g == [2]
+
+
+def test_deep_update_unknown_strategy():
+    base, other = _merge_docs()
+    with pytest.raises(ValueError):
+        base.deep_update(other, 'nope')
+    with pytest.raises(ValueError):
+        base.deep_update(other, {'a.b': ['nope']})
+
+
+def test_deep_update_plain_and_frozen_children():
+    fu = frozenudict(x=1)
+    ud = udict(a={'b': 1}, f=fu)
+    ud.deep_update({'a': {'c': {'d': 1}}, 'f': {'y': [1]}})
+    assert type(ud.a['c']) is dict
+    assert ud.f == {'x': 1, 'y': (1,)}
+    assert type(ud.f) is frozenudict
+    assert fu == {'x': 1}
+
+
+def test_deep_update_deep():
+    depth = sys.getrecursionlimit() * 2
+    base, other = udict.fromdict(_deep(depth)), _deep(depth)
+    node = other
+    while 'child' in node:
+        node['level'] = -1
+        node = node['child']
+    base.deep_update(other)
+    node = base
+    for _ in range(depth - 1):
+        node = node.child
+        assert node.level == -1
+
+
+def test_merge():
+    base, other = _merge_docs()
+    merged = base.merge(other)
+    assert merged == {
+        'a': {'b': 10, 'c': [2], 'd': {'e': 2, 'x': {'y': 1}}},
+        'f': 3,
+        'g': [2],
+        'h': 4,
+    }
+    assert base == _merge_docs()[0]
+    assert type(merged.a) is udict
+    assert merged.a is not base.a
+
+
+def test_merge_shares_untouched():
+    base = udict.fromdict({'a': {'b': 1}, 'c': {'d': 2}})
+    merged = base.merge({'a': {'b': 2}})
+    assert merged.c is base.c
+    assert base.a.b == 1
+
+
+def test_frozenudict_merge():
+    fu = frozenudict.fromdict({'a': {'b': 1}, 'c': {'d': 2}})
+    merged = fu.merge({'a': {'x': [1]}}, 'keep')
+    assert type(merged) is frozenudict
+    assert type(merged.a) is frozenudict
+    assert merged == {'a': {'b': 1, 'x': (1,)}, 'c': {'d': 2}}
+    assert merged.c is fu.c
+    assert fu.a == {'b': 1}
+    with pytest.raises(TypeError):
+        fu.deep_update({'a': 1})
+
+
+def test_flatten():
+    ud = udict.fromdict({'a': {'b': 1, 'c': {'d': [2]}}, 'e': {}, 3: 4})
+    # (sorted, as the order of a dict isn't fixed on python 2)
+    assert sorted(ud.flatten()) == [
+        ('3', 4), ('a.b', 1), ('a.c.d', [2]), ('e', {}),
+    ]
+    assert ('a/c/d', [2]) in list(ud.flatten('/'))
+
+
+def test_flatten_unicode_keys():
+    ud = udict.fromJSON('{"caf\\u00e9": {"b": 1}}')
+    assert list(ud.flatten()) == [(u'caf\u00e9.b', 1)]
+
+
+def test_flatten_is_lazy():
+    values = udict(a=udict(b=1), c=2).flatten()
+    assert next(values) == ('a.b', 1)
+
+
+def test_flatten_deep():
+    depth = sys.getrecursionlimit() * 2
+    pairs = list(udict.fromdict(_deep(depth)).flatten())
+    assert len(pairs) == depth
+    assert pairs[-1][0].count('.') == depth
+
+
+def test_unflatten():
+    ud = udict.unflatten([('a.b', 1), ('a.c.d', 2), ('e', 3), ('a.c.f', 4)])
+    assert ud == {'a': {'b': 1, 'c': {'d': 2, 'f': 4}}, 'e': 3}
+    assert type(ud.a.c) is udict
+    assert udict.unflatten({'a/b': 1}, sep='/') == {'a': {'b': 1}}
+    assert type(lazyudict.unflatten({'a.b': 1}).a) is lazyudict
+
+
+def test_unflatten_round_trip():
+    ud = udict.fromdict({'a': {'b': 1, 'c': {'d': [2]}}, 'e': {}})
+    assert udict.unflatten(ud.flatten()) == ud
+
+
+def test_unflatten_conflicts():
+    with pytest.raises(ValueError):
+        udict.unflatten([('a', 1), ('a.b', 2)])
+    with pytest.raises(ValueError):
+        udict.unflatten([('a.b.c', 1), ('a.b', 2)])
+    with pytest.raises(ValueError):
+        udict.unflatten([('a.b', 1), ('a.b.c', 2)])
+    assert udict.unflatten([('a.b', 1), ('a.b', 2)]) == {'a': {'b': 2}}
+
+
+def test_unflatten_empty_keys():
+    for d in [{'': 3}, {'': {'a': 1}}, {'a': {'': {'': 2}}, '': 4}]:
+        ud = udict.fromdict(d)
+        assert udict.unflatten(ud.flatten()) == ud
+    with pytest.raises(ValueError):
+        udict.unflatten([('', 1), ('.a', 2)])
+
+
+def test_unflatten_non_string_keys():
+    with pytest.raises(TypeError) as excinfo:
+        udict.unflatten([(3, 4)])
+    assert "'int'" in str(excinfo.value)
+
+
+def test_frozenudict_unflatten():
+    fu = frozenudict.unflatten([('a.b', [1])])
+    assert fu == {'a': {'b': (1,)}}
+    assert type(fu.a) is frozenudict
+
+
+def _diff_docs():
+    a = udict.fromdict({
+        'a': {'b': 1, 'c': {'d': 2}, 'e': [1]},
+        'f': 3,
+        'g': {'h': 4},
+        1: 'x',
+    })
+    b = udict.fromdict({
+        'a': {'b': 1, 'c': {'d': 5, 'x': 6}, 'e': [1, 2]},
+        'g': 7,
+        'i': {'j': 8},
+        1: 'y',
+    })
+    return a, b
+
+
+def test_diff():
+    a, b = _diff_docs()
+    assert sorted(a.diff(b), key=repr) == sorted([
+        ('change', 'a.c.d', 5),
+        ('add', 'a.c.x', 6),
+        ('change', 'a.e', [1, 2]),
+        ('remove', 'f', None),
+        ('change', 'g', 7),
+        ('add', 'i', {'j': 8}),
+        ('change', (1,), 'y'),
+    ], key=repr)
+    assert udict.diff(a, a) == []
+    assert a.diff(udict.fromdict(a.todict())) == []
+
+
+def test_diff_undotted_keys():
+    a = udict.fromdict({'a.b': {'c': 1}, 'd': {2: 3}})
+    b = udict.fromdict({'a.b': {'c': 2}, 'd': {2: 4}})
+    assert sorted(a.diff(b)) == [
+        ('change', ('a.b', 'c'), 2),
+        ('change', ('d', 2), 4),
+    ]
+
+
+def test_diff_unicode_keys():
+    a = udict.fromJSON('{"a": {"caf\\u00e9": 1}}')
+    b = udict.fromJSON('{"a": {"caf\\u00e9": 2}}')
+    assert a.diff(b) == [('change', u'a.caf\u00e9', 2)]
+    a.apply_patch(a.diff(b))
+    assert a == b
+
+
+def test_diff_skips_identical(monkeypatch):
+    shared = udict(x=1)
+    a, b = udict(s=shared, t=udict(y=1)), udict(s=shared, t=udict(y=1))
+    compared = []
+    monkeypatch.setattr(uberdict, '_same',
+                        lambda x, y: compared.append(x) or x == y)
+    assert a.diff(b) == []
+    assert compared == [a.t]
+
+
+def test_diff_frozen_hashes():
+    a = frozenudict.fromdict({'a': {'b': 1}})
+    b = a.set('a.b', 2)
+    assert uberdict._same(a.a, a.a.copy())
+    assert not uberdict._same(a.a, b.a)
+    assert a.diff(b) == [('change', 'a.b', 2)]
+
+
+def test_apply_patch():
+    a, b = _diff_docs()
+    patch = a.diff(b)
+    a.apply_patch(patch)
+    assert a == b
+    assert type(a.i) is udict
+    assert a.i is not b.i
+
+
+def test_apply_patch_errors():
+    ud = udict(a=udict(b=1))
+    with pytest.raises(KeyError):
+        ud.apply_patch([('remove', 'a.c', None)])
+    with pytest.raises(KeyError):
+        ud.apply_patch([('add', 'x.y', 1)])
+    with pytest.raises(ValueError):
+        ud.apply_patch([('move', 'a.b', 1)])
+    with pytest.raises(TypeError):
+        frozenudict(a=1).apply_patch([('remove', 'a', None)])
+    with pytest.raises(TypeError):
+        udict(f=frozenudict(a=1)).apply_patch([('remove', 'f.a', None)])
+
+
+def test_diff_patch_json_round_trip():
+    a, b = _diff_docs()
+    del a[1], b[1]
+    patch = json.loads(json.dumps(a.diff(b)))
+    a.apply_patch(patch)
+    assert a == b
+
+
+def _fingerprinted():
+    ud = udict.fromdict({
+        'a': {'b': {'c': 1}, 'd': (udict(e=2),)},
+        'f': {'g': None},
+        'h': frozenset([1, u'x']),
+        'i': 1.5,
+    })
+    return ud, ud.fingerprint()
+
+
+def test_fingerprint_content():
+    ud, fp = _fingerprinted()
+    assert len(fp) == 40
+    other = udict.fromdict({
+        'i': 1.5,
+        'h': frozenset([u'x', 1]),
+        'f': {'g': None},
+        'a': {'d': ({'e': 2},), 'b': {'c': 1}},
+    })
+    assert other.fingerprint() == fp
+    assert frozenudict.fromdict(ud).fingerprint() == fp
+    assert udict(a=1).fingerprint() != udict(a='1').fingerprint()
+    assert udict(a=1).fingerprint() != udict(a=True).fingerprint()
+    assert udict(a=[1]).fingerprint() != udict(a=(1,)).fingerprint()
+    assert udict(a=1).fingerprint() != udict(b=1).fingerprint()
+    assert udict(a=1).fingerprint() != udict(a=1.0).fingerprint()
+
+
+def test_fingerprint_stable():
+    assert udict(a=[1, u'b', None]).fingerprint() == \
+        udict(a=[1, u'b', None]).fingerprint()
+    assert udict().fingerprint() == \
+        '76e94348139b788d21edc7b9cd011af238d0de03'
+
+
+def test_fingerprint_unsupported_value():
+    with pytest.raises(TypeError):
+        udict(a=object()).fingerprint()
+
+
+def test_fingerprint_cached(monkeypatch):
+    ud, fp = _fingerprinted()
+    monkeypatch.setattr(uberdict, '_token',
+                        mock.Mock(side_effect=AssertionError))
+    assert ud.fingerprint() == fp
+
+
+@pytest.mark.parametrize('change', [
+    lambda ud: ud.a.b.__setitem__('c', 2),
+    lambda ud: ud.__setitem__('a.b.c', 2),
+    lambda ud: setattr(ud.a.b, 'x', 1),
+    lambda ud: delattr(ud.a.b, 'c'),
+    lambda ud: ud.__delitem__('a.b.c'),
+    lambda ud: ud.pop('a.b.c'),
+    lambda ud: ud.a.b.pop('c'),
+    lambda ud: ud.a.b.popitem(),
+    lambda ud: ud.a.b.clear(),
+    lambda ud: ud.a.b.update(c=2),
+    lambda ud: ud.setdefault('a.b.x', 1),
+    lambda ud: ud.set_many({'a.b.c': 2}),
+    lambda ud: ud.deep_update({'a': {'b': {'c': 2}}}),
+    lambda ud: ud.apply_patch([('change', 'a.b.c', 2)]),
+    lambda ud: ud.a.d[0].__setitem__('e', 3),
+])
+def test_fingerprint_invalidated(change):
+    ud, fp = _fingerprinted()
+    f = ud.f
+    f_fp = f.fingerprint()
+    change(ud)
+    assert ud.fingerprint() != fp
+    assert ud.fingerprint() == udict.fromdict(ud.todict()).fingerprint()
+    assert f.__dict__['_memo'].fingerprint == f_fp
+
+
+def test_fingerprint_shared_child():
+    child = udict(x=1)
+    a, b = udict(c=child), udict(c=child, d=2)
+    fa, fb = a.fingerprint(), b.fingerprint()
+    child.x = 2
+    assert a.fingerprint() != fa
+    assert b.fingerprint() != fb
+
+
+def test_fingerprint_not_cached_with_mutable_values():
+    ud = udict(a=udict(b=[1]), c={'d': 1})
+    fp = ud.fingerprint()
+    assert ud.a.__dict__.get('_memo') is None
+    ud.a.b.append(2)
+    ud.c['d'] = 2
+    assert ud.fingerprint() != fp
+
+
+def test_fingerprint_not_copied():
+    ud, fp = _fingerprinted()
+    assert '_memo' not in ud.copy().__dict__
+    assert '_memo' not in copy.deepcopy(ud).__dict__
+
+
+def test_memo_key_not_shadowed():
+    ud = udict(_memo=5)
+    assert ud._memo == 5
+    ud.x = 1
+    assert ud._memo == 5
+
+
+def test_fingerprint_deep():
+    depth = sys.getrecursionlimit() * 2
+    ud = udict.fromdict(_deep(depth))
+    fp = ud.fingerprint()
+    node = ud
+    for _ in range(depth - 1):
+        node = node.child
+    node.level = -1
+    assert ud.fingerprint() != fp
+
+
+def test_diff_uses_fingerprints():
+    a = udict.fromdict({'x': {'y': 1}, 'z': {'w': 1}})
+    b = udict.fromdict({'x': {'y': 1}, 'z': {'w': 2}})
+    a.fingerprint(), b.fingerprint()
+    # tamper with the contents behind the cache's back
+    dict.__setitem__(a.x, 'y', 5)
+    assert a.diff(b) == [('change', 'z.w', 2)]
+
+
+def _tracked():
+    return trackedudict.fromdict({
+        'a': {'b': {'c': 1, 'd': 2}, 'e': 3},
+        'f': {'g': 4},
+        'h': 5,
+    })
+
+
+def test_trackedudict_clean():
+    td = _tracked()
+    assert td.dirty_paths() == set()
+    assert type(td.a.b) is trackedudict
+
+
+@pytest.mark.parametrize('change, paths', [
+    (lambda td: td.__setitem__('h', 6), {'h'}),
+    (lambda td: setattr(td.a.b, 'c', 6), {'a.b.c'}),
+    (lambda td: td.__setitem__('a.b.x', 6), {'a.b.x'}),
+    (lambda td: td.__delitem__('a.b.c'), {'a.b.c'}),
+    (lambda td: td.__delitem__('h'), {'h'}),
+    (lambda td: delattr(td.f, 'g'), {'f.g'}),
+    (lambda td: td.pop('a.e'), {'a.e'}),
+    (lambda td: td.setdefault('f.x', 1), {'f.x'}),
+    (lambda td: td.a.b.update(c=0, y=1), {'a.b.c', 'a.b.y'}),
+    (lambda td: td.update(iter([('h', 0)])), {'h'}),
+    (lambda td: td.f.clear(), {'f.g'}),
+    (lambda td: td.f.popitem(), {'f.g'}),
+    (lambda td: td.set_many({'a.b.c': 0, 'h': 0}), {'a.b.c', 'h'}),
+    (lambda td: td.deep_update({'a': {'b': {'d': 0}}, 'x': {}}),
+     {'a.b.d', 'x'}),
+    (lambda td: td.apply_patch([('remove', 'a.b.d', None)]), {'a.b.d'}),
+])
+def test_trackedudict_dirty_paths(change, paths):
+    td = _tracked()
+    change(td)
+    assert td.dirty_paths() == paths
+
+
+def test_trackedudict_pop_missing():
+    td = _tracked()
+    assert td.pop('missing', None) is None
+    assert td.pop('a.missing', 0) == 0
+    assert td.pop('x.y', 0) == 0
+    with pytest.raises(KeyError):
+        td.pop('a.b.missing')
+    assert td.dirty_paths() == set()
+
+
+def test_trackedudict_minimal_paths():
+    td = _tracked()
+    td.a.b.c = 0
+    td.a.e = 0
+    td.a = trackedudict(z=1)
+    td.f.g = 0
+    assert td.dirty_paths() == {'a', 'f.g'}
+    assert td.f.dirty_paths() == {'g'}
+    assert td.dirty_paths('/') == {'a', 'f/g'}
+
+
+def test_trackedudict_clear_dirty():
+    td = _tracked()
+    td.a.b.c = 0
+    td.h = 0
+    td.clear_dirty()
+    assert td.dirty_paths() == set()
+    assert td.a.b.dirty_paths() == set()
+    td.a.b.d = 0
+    assert td.dirty_paths() == {'a.b.d'}
+
+
+def test_trackedudict_added_children_tracked():
+    td = _tracked()
+    child = trackedudict.fromdict({'y': {'z': 1}})
+    td.x = child
+    td.clear_dirty()
+    child.y.z = 2
+    assert td.dirty_paths() == {'x.y.z'}
+
+
+def test_trackedudict_removed_child_not_tracked():
+    td = _tracked()
+    b = td.a.pop('b')
+    td.clear_dirty()
+    b.c = 0
+    assert td.dirty_paths() == set()
+    assert b.dirty_paths() == {'c'}
+
+
+def test_trackedudict_shared_child():
+    child = trackedudict(x=1)
+    td = trackedudict(a=child, b=child)
+    child.x = 2
+    assert td.dirty_paths() == {'a.x', 'b.x'}
+
+
+def test_trackedudict_constructors():
+    td = trackedudict.fromJSON('{"a": {"b": 1}}')
+    td.a.b = 2
+    assert td.dirty_paths() == {'a.b'}
+    td = trackedudict.unflatten({'a.b': 1})
+    td.a.b = 2
+    assert td.dirty_paths() == {'a.b'}
+    td = trackedudict({'a': trackedudict(b=1)})
+    td.a.b = 2
+    assert td.dirty_paths() == {'a.b'}
+    values = list(trackedudict.iter_json_lines(io.StringIO(u'{"a": {}}\n')))
+    values[0].a.b = 1
+    assert values[0].dirty_paths() == {'a.b'}
+    values = list(trackedudict.iter_json_array(io.StringIO(u'[{"a": {}}]')))
+    values[0].a.b = 1
+    assert values[0].dirty_paths() == {'a.b'}
+
+
+def test_trackedudict_copies():
+    td = _tracked()
+    for copied in (td.copy(), copy.deepcopy(td), td.merge({'h': 0})):
+        assert type(copied) is trackedudict
+        copied.clear_dirty()
+        copied.a.b.c = 0
+        assert copied.dirty_paths() == {'a.b.c'}
+    assert td.dirty_paths() == {'a.b.c'}  # via the shallow copy
+
+
+def test_trackedudict_non_string_keys():
+    td = trackedudict.fromdict({1: {2: 3}})
+    td[1][2] = 4
+    assert td.dirty_paths() == {'1.2'}
+
+
+def test_trackedudict_unicode_keys():
+    td = trackedudict.fromJSON('{"caf\\u00e9": {"b": 1}}')
+    td[u'caf\u00e9'].b = 2
+    td[u'\u00e9'] = 3
+    assert td.dirty_paths() == {u'caf\u00e9.b', u'\u00e9'}
+
+
+def test_trackedudict_fingerprint():
+    td = _tracked()
+    fp = td.fingerprint()
+    td.a.b.update(c=0)
+    assert td.dirty_paths() == {'a.b.c'}
+    assert td.fingerprint() != fp
+    assert td.fingerprint() == udict.fromdict(td.todict()).fingerprint()
+
+
+def test_trackedudict_deep():
+    depth = sys.getrecursionlimit() * 2
+    td = trackedudict.fromdict(_deep(depth))
+    node = td
+    for _ in range(depth):
+        node = node.child
+    node.level = -1
+    assert td.dirty_paths() == {'.'.join(['child'] * depth + ['level'])}
+    td.clear_dirty()
+    assert td.dirty_paths() == set()
+
+
+def _threaded(func, threads=8):
+    workers = [threading.Thread(target=func) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def test_lockedudict_is_udict():
+    lud = lockedudict.fromdict({'a': {'b-c': {'d': 1}}, 'e': [{'f': 2}]})
+    assert isinstance(lud, udict)
+    assert lud == {'a': {'b-c': {'d': 1}}, 'e': [{'f': 2}]}
+    assert lud['a.b-c.d'] == 1
+    lud['a.b-c.d'] = 2
+    assert lud.a['b-c'].d == 2
+    # the nested dicts are plain udicts, locked through the outer one
+    assert type(lud.a) is udict
+    assert type(lud.e[0]) is dict
+    assert lud.pop('a.b-c.d') == 2
+    assert 'a.b-c' in lud and 'a.b-c.d' not in lud
+    assert repr(lud) == repr(dict(lud))
+
+
+def test_lockedudict_constructors():
+    assert type(lockedudict(a=1)) is lockedudict
+    for lud in (lockedudict.fromJSON('{"a": {"b": 1}}'),
+                lockedudict.unflatten({'a.b': 1}),
+                list(lockedudict.iter_json_lines(
+                    io.StringIO(u'{"a": {"b": 1}}\n')))[0],
+                list(lockedudict.iter_json_array(
+                    io.StringIO(u'[{"a": {"b": 1}}]')))[0]):
+        assert type(lud) is lockedudict
+        assert type(lud.a) is udict
+        assert lud == {'a': {'b': 1}}
+    lst = lockedudict.fromJSON('[{"a": 1}, 2]')
+    assert lst == [{'a': 1}, 2]
+    assert type(lst[0]) is lockedudict
+
+
+def test_lockedudict_copies():
+    lud = lockedudict.fromdict({'a': {'b': 1}})
+    for copied in (lud.copy(), copy.deepcopy(lud), lud.merge({'c': 2})):
+        assert type(copied) is lockedudict
+        assert copied.a == {'b': 1}
+        with copied.writing():
+            copied.a = 2
+    assert lud.a == {'b': 1}
+
+
+def test_lockedudict_generators():
+    lud = lockedudict.fromdict({'a': {'b': 1}, 'c': [2]})
+    assert list(lud.flatten()) == [('a.b', 1), ('c', [2])]
+    assert ''.join(lud.iterJSON()) == lud.toJSON() == json.dumps(lud)
+
+
+def test_lockedudict_compare_and_set():
+    lud = lockedudict.fromdict({'a': {'b': 1}})
+    assert not lud.compare_and_set('a.b', 2, 3)
+    assert lud.a.b == 1
+    assert lud.compare_and_set('a.b', 1, 3)
+    assert lud.a.b == 3
+    assert not lud.compare_and_set('a.c', None, 3)
+    assert 'a.c' not in lud
+    assert not lud.compare_and_set('x.y', None, 1)
+
+
+def test_lockedudict_increment():
+    lud = lockedudict.fromdict({'a': {'b': 1}})
+    assert lud.increment('a.b') == 2
+    assert lud.increment('a.b', -5) == -3
+    assert lud.increment('a.c', 2.5) == 2.5
+    assert lud.increment('n') == 1
+    assert lud == {'a': {'b': -3, 'c': 2.5}, 'n': 1}
+    with pytest.raises(KeyError):
+        lud.increment('x.y')
+
+
+def test_lockedudict_update_paths():
+    lud = lockedudict.fromdict({'a': {'b': 1}})
+    lud.update_paths({'a.b': 2, 'a.c': 3, 'd': 4})
+    assert lud == {'a': {'b': 2, 'c': 3}, 'd': 4}
+
+
+def test_lockedudict_concurrent_increments():
+    lud = lockedudict.fromdict({'a': {'b': 0}})
+
+    def work():
+        for _ in range(500):
+            lud.increment('a.b')
+            lud.setdefault('a.c', []).append(1)
+            current = lud['a.b']
+            while not lud.compare_and_set('a.b', current, current + 1):
+                current = lud['a.b']
+
+    _threaded(work)
+    assert lud.a.b == 8000
+    assert len(lud.a.c) == 4000
+
+
+def test_lockedudict_update_paths_is_atomic():
+    lud = lockedudict.fromdict({'a': {'b': 0, 'c': 0}})
+    seen = []
+
+    def write():
+        for i in range(1, 500):
+            lud.update_paths({'a.b': i, 'a.c': -i})
+
+    def read():
+        for _ in range(500):
+            b, c = lud.get_many(['a.b', 'a.c'])
+            seen.append(b + c)
+            with lud.reading():
+                seen.append(lud.a.b + lud.a.c)
+
+    workers = [threading.Thread(target=write)]
+    workers += [threading.Thread(target=read) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert set(seen) == {0}
+
+
+def test_lockedudict_writing():
+    lud = lockedudict(a=1, b=2)
+    with lud.writing():
+        # reentrant, for reading and writing
+        lud.total = lud.a + lud.b
+        with lud.reading():
+            assert lud.total == 3
+    with lud.reading():
+        with lud.reading():
+            assert lud.total == 3
+        with pytest.raises(RuntimeError):
+            lud.c = 1
+    lud.c = 1
+    assert lud == {'a': 1, 'b': 2, 'total': 3, 'c': 1}
+
+
+def test_lockedudict_readers_share_the_lock():
+    lud = lockedudict(a=1)
+    reading = threading.Event()
+    done = threading.Event()
+
+    def read():
+        with lud.reading():
+            reading.set()
+            done.wait(5)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    assert reading.wait(5)
+    # another reader isn't blocked
+    assert lud.a == 1
+    done.set()
+    reader.join()
+
+
+def test_lockedudict_writer_blocks_readers():
+    lud = lockedudict(a=1)
+    started = threading.Event()
+    values = []
+
+    def read():
+        started.set()
+        values.append(lud.a)
+
+    with lud.writing():
+        lud.a = 2
+        reader = threading.Thread(target=read)
+        reader.start()
+        assert started.wait(5)
+        reader.join(0.05)
+        assert reader.is_alive()
+        lud.a = 3
+    reader.join()
+    assert values == [3]
+
+
+def test_lockedudict_waiting_writer_blocks_new_readers():
+    lud = lockedudict(a=1)
+    events = []
+
+    def write():
+        lud.a = 2
+        events.append('write')
+
+    def read():
+        events.append(('read', lud.a))
+
+    with lud.reading():
+        writer = threading.Thread(target=write)
+        writer.start()
+        while not lud.__dict__['_lock']._waiting:
+            writer.join(0.001)
+        reader = threading.Thread(target=read)
+        reader.start()
+        reader.join(0.05)
+        # the new reader waits for the waiting writer
+        assert reader.is_alive()
+        assert events == []
+    writer.join()
+    reader.join()
+    assert events == ['write', ('read', 2)]
+
+
+def test_to_bytes_round_trip():
+    ud = udict.fromdict({
+        'a-b': {'c': [0, 127, 128, -1, 2 ** 70, -2 ** 70, 1.5, -0.0]},
+        'd': [None, True, False, u'', u'\u00e9' * 40, b('\x00\xff')],
+        'e': (1, (2, [3]), {'f': ()}),
+        1: {(2, 3): u'x', None: []},
+        'g': {},
+    })
+    ud.h = {'i': 'plain'}
+    data = ud.to_bytes()
+    assert isinstance(data, bytes)
+    decoded = udict.from_bytes(data)
+    assert decoded == ud
+    assert list(decoded) == list(ud)
+    assert type(decoded) is udict
+    assert type(decoded['a-b']) is udict
+    assert type(decoded.e[2]) is dict
+    assert type(decoded.h) is dict
+    assert type(decoded.e) is tuple and type(decoded.e[1][1]) is list
+    assert type(decoded.d[5]) is bytes
+    assert udict.from_bytes(bytearray(data)) == ud
+
+
+def test_to_bytes_smaller_than_pickle_and_json():
+    # (with text keys, which python 2's str keys aren't)
+    ud = udict.fromdict({u'records': [{u'name': u'n%d' % i, u'value': i,
+                                       u'tags': [u'a', u'b']}
+                                      for i in range(100)]}, lists=True)
+    data = ud.to_bytes()
+    # (smaller even than the pickle of the plain dicts)
+    assert len(data) < len(pickle.dumps(ud.todict(lists=True), -1)) * 0.75
+    assert len(data) < len(ud.toJSON()) / 2
+
+
+def test_to_bytes_shares_keys():
+    ud = udict.fromdict({u'k' * 40: {u'k' * 40: {u'k' * 40: 1}}})
+    assert udict.from_bytes(ud.to_bytes()) == ud
+    assert len(ud.to_bytes()) < 60
+    keys = [u'key%d' % i for i in range(300)]
+    ud = udict.fromdict(dict((key, {key: i}) for i, key in enumerate(keys)))
+    assert udict.from_bytes(ud.to_bytes()) == ud
+
+
+def test_to_bytes_str_subclass_keys():
+    enum = pytest.importorskip('enum')
+
+    class Key(str, enum.Enum):
+        a = 'a'
+
+    ud = udict(x=udict.verbatim([('a', 1)]), y=udict.verbatim([(Key.a, 2)]),
+               z=udict(b=5), w=udict(b=6))
+    decoded = udict.from_bytes(ud.to_bytes())
+    assert decoded == ud
+    assert decoded.w == {'b': 6} and decoded.z == {'b': 5}
+    assert type(list(decoded.y)[0]) is str
+    assert udict.from_bytes(udict(v=Key.a).to_bytes()) == {'v': 'a'}
+
+
+def test_to_bytes_deep():
+    depth = sys.getrecursionlimit() * 2
+    node = udict.from_bytes(udict.fromdict(_deep(depth)).to_bytes())
+    for level in range(depth):
+        node = node.child
+        assert node.level == level
+    assert node == {'level': depth - 1}
+
+
+def test_to_bytes_unsupported():
+    with pytest.raises(TypeError):
+        udict(a=set()).to_bytes()
+
+    class Count(int):
+        pass
+    decoded = udict.from_bytes(udict(a=Count(1)).to_bytes())
+    assert decoded == {'a': 1} and type(decoded.a) is int
+
+
+def test_from_bytes_invalid():
+    data = udict(a=[1, u'abc']).to_bytes()
+    for invalid in (b(''), b('{}'), data[:-1], data[:-3], data + data[3:],
+                    data[:3] + b('\x3f')):
+        with pytest.raises(ValueError):
+            udict.from_bytes(invalid)
+
+
+def test_to_bytes_many():
+    records = [udict.fromdict({'id': i, 'user': {'name': u'n%d' % i}})
+               for i in range(10)]
+    data = udict.to_bytes_many(iter(records + [None, [udict(id=1)]]))
+    assert len(data) < sum(len(record.to_bytes()) for record in records)
+    decoded = udict.from_bytes_many(data)
+    assert decoded == records + [None, [udict(id=1)]]
+    assert type(decoded[3].user) is udict
+    assert udict.from_bytes_many(udict.to_bytes_many([])) == []
+    assert udict.from_bytes_many(records[0].to_bytes()) == [records[0]]
+    with pytest.raises(ValueError):
+        udict.from_bytes(data)
+
+
+def test_from_bytes_subclasses():
+    data = udict.fromdict({'a': {'b': [1, {'c': 2}]}}).to_bytes()
+    fu = frozenudict.from_bytes(data)
+    assert fu == {'a': {'b': (1, {'c': 2})}}
+    assert type(fu['a.b'][1]) is frozenudict
+    assert frozenudict.from_bytes(fu.to_bytes()) == fu
+    td = trackedudict.from_bytes(data)
+    td.a.b[1]['c'] = 3
+    assert td.dirty_paths() == set()  # (in a list, so not tracked)
+    td.a.d = 4
+    assert td.dirty_paths() == {'a.d'}
+    lud = lockedudict.from_bytes(data)
+    assert type(lud) is lockedudict and type(lud.a) is udict
+    assert lockedudict.from_bytes(lud.to_bytes()) == lud
+    values = trackedudict.from_bytes_many(udict.to_bytes_many([td, td]))
+    assert [type(value) for value in values] == [trackedudict] * 2
+    values = frozenudict.from_bytes_many(udict.to_bytes_many([td]))
+    assert type(values[0]) is frozenudict
+    values = lockedudict.from_bytes_many(udict.to_bytes_many([td]))
+    assert type(values[0]) is lockedudict
+
+
+def test_fromJSON_many_in_process():
+    docs = ['{"a-b": %d}' % i for i in range(10)]
+    with mock.patch('multiprocessing.Pool') as pool:
+        values = list(udict.fromJSON_many(docs, workers=4, chunksize=11))
+        assert values == [udict(a_b=i) for i in range(10)]
+        values = list(udict.fromJSON_many(iter(docs), workers=1,
+                                          chunksize=2))
+        assert values == [udict(a_b=i) for i in range(10)]
+    assert not pool.called
+
+
+def test_fromJSON_many_processes():
+    docs = ['{"a-b": {"c": [%d, {"d": 1}]}, "e": 2}' % i for i in range(50)]
+    values = frozenudict.fromJSON_many(docs, workers=2, chunksize=3,
+                                       drop=['e'])
+    assert list(values) == [frozenudict.fromJSON(doc, drop=['e'])
+                            for doc in docs]
+    values = list(udict.fromJSON_many(docs, workers=2, chunksize=4,
+                                      backend='json', parse_int=str))
+    assert values[7] == {'a_b': {'c': ['7', {'d': '1'}]}, 'e': '2'}
+    assert type(values[7].a_b.c[1]) is udict
+
+
+def test_fromJSON_many_error():
+    docs = ['{"a": 1}'] * 10 + ['{']
+    with pytest.raises(ValueError):
+        list(udict.fromJSON_many(docs, workers=2, chunksize=2))
+
+
+def test_fromJSON_many_reads_ahead_lazily():
+    docs = ('{"a": %d}' % i for i in itertools.count())
+    values = udict.fromJSON_many(docs, workers=2, chunksize=5)
+    assert [value.a for value in itertools.islice(values, 12)] == list(
+        range(12))
+    values.close()
+    # only 2 chunks per process were read, counting the one being generated
+    assert next(docs) == '{"a": 30}'
+
+
+def test_fromdict_many():
+    mappings = [{'a': {'b': i, 'c': [{'d': i}]}} for i in range(20)]
+    for workers in (1, 2):
+        values = list(udict.fromdict_many(mappings, workers=workers,
+                                          chunksize=3, lists=True,
+                                          drop=['a.b']))
+        assert values == [{'a': {'c': [{'d': i}]}} for i in range(20)]
+        assert type(values[3].a.c[0]) is udict
+
+
+def test_fromJSON_many_chunksize():
+    with pytest.raises(ValueError):
+        udict.fromJSON_many(['{}'], chunksize=0)
+    with pytest.raises(ValueError):
+        udict.fromdict_many([{}], chunksize=-1)
@@ -1,10 +1,46 @@
+import codecs
+import collections
+import contextlib
+import functools
+import hashlib
+import itertools
 import json
+import multiprocessing
+import re
+import struct
 import sys
+import threading
+import weakref
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # pragma: no cover
+    from collections import MutableMapping
+
+try:
+    from threading import get_ident
+except ImportError:  # pragma: no cover
+    from thread import get_ident
 
 __version_info__ = (0, 4, 3)
 __version__ = ".".join(map(str, __version_info__))
 
-ALL = ["udict"]
+ALL = [
+    "udict",
+    "lazyudict",
+    "frozenudict",
+    "overlayudict",
+    "trackedudict",
+    "lockedudict",
+    "dotpath",
+    "JSONBackend",
+    "StdlibJSONBackend",
+    "register_json_backend",
+    "get_json_backend",
+    "set_json_backend",
+    "json_backends",
+    "JSONArrayParser",
+]
 
 # py2/py3 compatibility
 if sys.version_info.major == 2:
@@ -12,12 +48,31 @@ if sys.version_info.major == 2:
     def iteritems(d):
         return d.iteritems()
 
+    def _json_encoder(encode):
+        # python 2's C JSON encoder looks up the values of a dict with
+        # `__getitem__` (which takes a dotted key of a udict as a path),
+        # and returns `str` bytes for ASCII output, so encode copies of
+        # the udicts as plain dicts, and always return text
+        def encode_text(obj, **kwargs):
+            return _json_text(encode(_convert(obj, dict, dict, True),
+                                     **kwargs))
+        return encode_text
+
+    def _json_text(text):
+        return text.decode("utf-8") if isinstance(text, str) else text
+
 
 else:
 
     def iteritems(d):
         return d.items()
 
+    def _json_encoder(encode):
+        return encode
+
+    def _json_text(text):
+        return text
+
 
 # For internal use only as a value that can be used as a default
 # and should never exist in a dict.
@@ -52,16 +107,28 @@ class udict(dict):
         Likewise, dotted keys will not be treated specially, so something
         like `udict({'a.b': 'a.b'})` is equivalent to `ud = udict()` followed
         by `setattr(ud, 'a.b', 'a.b')`.
+
+        Each '-' in the (string) keys of a dict arg is replaced by '_' in
+        the new `udict`, leaving the dict arg itself unchanged. To create a
+        `udict` with the keys as they are, use `udict.verbatim`.
+        """
+        if not args or not isinstance(args[0], dict) or not args[0]:
+            dict.__init__(self, *args, **kwargs)
+            return
+        dict.__init__(self, *args)
+        _unhyphenate(self)
+        if kwargs:
+            dict.update(self, kwargs)
+
+    @classmethod
+    def verbatim(cls, *args, **kwargs):
+        """
+        Create a new `udict` like `dict(*args, **kwargs)` does, without
+        replacing the '-' in any keys (see `__init__`).
         """
-        if isinstance(args, tuple):
-            for i in range(0, len(args)):
-                if isinstance(args[i], dict):
-                    for k, v in list(args[i].items()):
-                        if "-" in k:
-                            nk = k.replace("-", "_")
-                            args[i][nk] = args[i][k]
-                            args[i].pop(k)
-        dict.__init__(self, *args, **kwargs)
+        obj = dict.__new__(cls)
+        dict.__init__(obj, *args, **kwargs)
+        return obj
 
     def __getitem__(self, key):
         """
@@ -84,8 +151,7 @@ class udict(dict):
         """
         if not isinstance(key, str) or "." not in key:
             return dict.__getitem__(self, key)
-        obj, token = _descend(self, key)
-        return _get(obj, token)
+        return _compile(key)(self)
 
     def __setitem__(self, key, value):
         """
@@ -95,10 +161,11 @@ class udict(dict):
         dotted key and for exceptions that may be raised.
         """
         if not isinstance(key, str) or "." not in key:
-            return dict.__setitem__(self, key, value)
-
-        obj, token = _descend(self, key)
-        return dict.__setitem__(obj, token, value)
+            dict.__setitem__(self, key, value)
+            if self.__dict__.get("_memo") is not None:
+                _invalidate(self)
+            return
+        _compile(key).set(self, value)
 
     def __delitem__(self, key):
         """
@@ -109,9 +176,10 @@ class udict(dict):
         """
         if not isinstance(key, str) or "." not in key:
             dict.__delitem__(self, key)
+            if self.__dict__.get("_memo") is not None:
+                _invalidate(self)
             return
-        obj, token = _descend(self, key)
-        del obj[token]
+        _compile(key).delete(self)
 
     def __getattr__(self, key):
         # no special treatement for dotted keys, but we need to use
@@ -127,6 +195,8 @@ class udict(dict):
         # instead of setting an attribute (i.e., dotted keys are
         # treated as plain keys)
         dict.__setitem__(self, key, value)
+        if self.__dict__.get("_memo") is not None:
+            _invalidate(self)
 
     def __delattr__(self, key):
         try:
@@ -134,13 +204,38 @@ class udict(dict):
             dict.__delitem__(self, key)
         except KeyError as e:
             raise AttributeError("no attribute '%s'" % (e.args[0]))
+        if self.__dict__.get("_memo") is not None:
+            _invalidate(self)
+
+    # the other methods that change a dict, which need to invalidate the
+    # cached values (see `fingerprint`), as do those above (`trackedudict`
+    # extends them all to track the changed keys too)
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        if self.__dict__.get("_memo") is not None:
+            _invalidate(self)
+
+    def popitem(self):
+        item = dict.popitem(self)
+        if self.__dict__.get("_memo") is not None:
+            _invalidate(self)
+        return item
+
+    def clear(self):
+        dict.clear(self)
+        if self.__dict__.get("_memo") is not None:
+            _invalidate(self)
+
+    if hasattr(dict, "__ior__"):
+        def __ior__(self, other):
+            self.update(other)
+            return self
 
     def __reduce__(self):
-        # pickle the contents of a udict as a list of items;
-        # __getstate__ and __setstate__ aren't needed
-        constructor = self.__class__
-        instance_args = (list(iteritems(self)),)
-        return constructor, instance_args
+        # pickle the contents of a udict as a plain dict, which is rebuilt
+        # in bulk by `_new`; __getstate__ and __setstate__ aren't needed
+        return _new, (self.__class__, dict(self))
 
     def get(self, key, default=None):
         # We can't use self[key] to support `get` here, because a missing key
@@ -148,26 +243,370 @@ class udict(dict):
         # method if one is defined (as happens for self[key]).
         if not isinstance(key, str) or "." not in key:
             return dict.get(self, key, default)
-        try:
-            obj, token = _descend(self, key)
-            return _get(obj, token)
-        except KeyError:
-            return default
+        return _compile(key).get(self, default)
+
+    def get_many(self, keys, default=None):
+        """
+        Return a list with the value for each key in `keys`, in order,
+        using `default` for any key that has no mapping.
+
+        The result is the same as `[self.get(key, default) for key in keys]`,
+        but dotted keys that share a common prefix (like 'result.status.code'
+        and 'result.status.reason') traverse the shared prefix only once.
+        """
+        keys = list(keys)
+        values = [default] * len(keys)
+        pending = [(self, _trie(keys), True)]
+        while pending:
+            obj, node, toplevel = pending.pop()
+            for token, (indexes, children) in iteritems(node):
+                if toplevel and indexes:
+                    # a plain key doesn't use `__missing__` (see `get`)
+                    value = dict.get(obj, token, default)
+                    for i in indexes:
+                        values[i] = value
+                    if not children:
+                        continue
+                try:
+                    value = _get(obj, token)
+                except KeyError:
+                    continue
+                if not toplevel:
+                    for i in indexes:
+                        values[i] = value
+                if children:
+                    pending.append((value, children, False))
+        return values
+
+    def set_many(self, mapping):
+        """
+        Set the value for each key in the `mapping` dict, traversing the
+        common prefix of dotted keys only once (see `get_many`).
+
+        At each level, the keys that end at that level are set before
+        descending any further, so if `mapping` contains both 'a' and
+        'a.b', then 'b' is set on the new value of 'a'. As with
+        `__setitem__`, `KeyError` is raised if the parent of some key
+        doesn't exist, in which case the keys set before the failure
+        remain set.
+        """
+        items = list(iteritems(mapping))
+        pending = [(self, _trie([key for key, _ in items]))]
+        while pending:
+            obj, node = pending.pop()
+            _mutable(obj)
+            for token, (indexes, children) in iteritems(node):
+                for i in indexes:
+                    dict.__setitem__(obj, token, items[i][1])
+            _touch(obj, [token for token, (indexes, _) in iteritems(node)
+                         if indexes])
+            for token, (indexes, children) in iteritems(node):
+                if children:
+                    pending.append((_get(obj, token), children))
+
+    @classmethod
+    def fromkeys(cls, seq, value=None):
+        return _new(cls, dict.fromkeys(seq, value))
+
+    @classmethod
+    def fromJSON(cls, json_string, backend=None, keep=None, drop=None,
+                 **kwargs):
+        """
+        Create a new `udict` from the given JSON `str` (or `bytes`).
+
+        Every JSON object in the document, including those inside arrays,
+        is decoded to an instance of this class, with each '-' in its keys
+        replaced by '_' (as is done by `__init__`). If the document isn't
+        a JSON object, the decoded value is returned.
+
+        If `keep` or `drop` is given, only the parts of the document that
+        they select are converted, as described for `fromdict`, and the
+        rest is discarded as soon as the document is decoded.
+
+        The document is decoded by the JSON backend registered with the
+        given `backend` name, or by the default backend (see
+        `set_json_backend`), and any keyword arguments are passed to it.
+        """
+        backend = get_json_backend(backend)
+        if keep is None and drop is None:
+            return backend.decode(json_string, cls, **kwargs)
+        return _project(backend.loads(json_string, **kwargs), cls, True,
+                        keep, drop, True)
+
+    @classmethod
+    def fromJSON_many(cls, documents, workers=None, chunksize=1000,
+                      backend=None, **kwargs):
+        """
+        Generate the `udict` (see `fromJSON`) for each JSON document in the
+        iterable `documents`, in order, decoding them in a pool of
+        `workers` processes (by default, one per CPU), `chunksize`
+        documents at a time.
+
+        Only a few chunks per process are read ahead of the udicts that
+        have been generated, so `documents` may be a long (or endless)
+        stream. If it has fewer than `chunksize` documents, or `workers`
+        is 1, they're decoded in this process instead, as starting the
+        processes would take longer.
+
+        The udicts are pickled to return them from the processes, so the
+        class must be importable by the processes, as must the JSON
+        backend (registered in them with the same name) and the values of
+        the other arguments, which are passed to `fromJSON`.
+        """
+        if backend is None:
+            backend = _json_backend
+        kwargs["backend"] = backend
+        return _many(cls, "fromJSON", documents, workers, chunksize, kwargs)
+
+    @classmethod
+    def fromJSONfile(cls, fp, **kwargs):
+        """
+        Create a new `udict` from the JSON document read from the
+        file-like object `fp`, which may be opened in text or binary mode.
+
+        See `fromJSON` for details.
+        """
+        return cls.fromJSON(fp.read(), **kwargs)
+
+    @classmethod
+    def iter_json_lines(cls, fp, batch_size=None, backend=None, start=1,
+                        **kwargs):
+        """
+        Generate the udict (see `fromJSON`) for each line of the JSON Lines
+        (or NDJSON) document read from the file-like object `fp`, which may
+        be opened in text or binary mode. Blank lines are skipped.
+
+        If `batch_size` is given, lists of up to `batch_size` udicts are
+        generated instead of single udicts.
+
+        Only one line at a time is read, and a single decoder is reused for
+        every line. A line that can't be decoded raises `ValueError` with a
+        message that includes the line number, counting the first line as
+        `start` (e.g., when `fp` holds the rest of a partly read document).
+
+        See `fromJSON` for the meaning of the other arguments.
+        """
+        decode = get_json_backend(backend).decoder(cls, **kwargs)
+        batch = []
+        for lineno, line in enumerate(fp, start):
+            if not line.strip():
+                continue
+            try:
+                value = decode(line)
+            except ValueError as e:
+                raise ValueError("line %d: %s" % (lineno, e))
+            if batch_size is None:
+                yield value
+                continue
+            batch.append(value)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @classmethod
+    def iter_json_array(cls, fp, path=None, chunk_size=65536, backend=None,
+                        **kwargs):
+        """
+        Generate the value (see `fromJSON`) of each element of a JSON array
+        in the document read from the file-like object `fp`, which may be
+        opened in text or binary mode, as soon as each one is complete.
+
+        The array is the top-level value of the document, or the one at the
+        given dotted `path` (like 'data.items') through its objects. Since
+        the document is read `chunk_size` characters (or bytes) at a time
+        using a `JSONArrayParser`, only about one element at a time is ever
+        held in memory, and reading stops when the end of the array is
+        reached.
+
+        See `fromJSON` for the meaning of the other arguments.
+        """
+        parser = JSONArrayParser(path, cls, backend, **kwargs)
+        while not parser.done:
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                break
+            for value in parser.feed(chunk):
+                yield value
+        parser.close()
+
+    @classmethod
+    def afromJSON(cls, reader, chunk_size=65536, executor=None,
+                  offload_size=65536, **kwargs):
+        """
+        Return a coroutine that creates a new `udict` from the JSON document
+        read from the `asyncio.StreamReader` (or any object with a `read`
+        coroutine method, such as an aiohttp request's `content`) `reader`,
+        `chunk_size` bytes at a time, until the end of the stream:
+
+            ud = await udict.afromJSON(request.content)
+
+        Decoding a document of `offload_size` bytes or more is done in
+        `executor` (or the event loop's default executor) rather than in
+        the event loop, so the loop isn't blocked by large documents. If
+        `offload_size` is `None`, documents are always decoded in the
+        event loop.
+
+        The other keyword arguments are passed to `fromJSON`. This needs
+        python 3.6 or later.
+        """
+        from uberdict._aio import afromJSON
+        return afromJSON(cls, reader, chunk_size, executor, offload_size,
+                         kwargs)
+
+    @classmethod
+    def aiter_json_lines(cls, reader, batch_size=None, chunk_size=65536,
+                         executor=None, offload_size=65536, **kwargs):
+        """
+        Return an asynchronous iterator over the udicts (or batches of
+        udicts) for the lines of the JSON Lines document read from the
+        `asyncio.StreamReader` `reader`, as `iter_json_lines` does for a
+        file, with each line decoded as soon as it has been read:
+
+            async for ud in udict.aiter_json_lines(reader):
+                ...
+
+        The document is read `chunk_size` bytes at a time, and the lines
+        completed by a chunk are decoded together, in `executor` if they
+        add up to `offload_size` bytes or more (see `afromJSON`), so a long
+        line doesn't block the event loop. The other arguments are those of
+        `iter_json_lines`. This needs python 3.6 or later.
+        """
+        from uberdict._aio import aiter_json_lines
+        return aiter_json_lines(cls, reader, batch_size, chunk_size,
+                                executor, offload_size, kwargs)
+
+    @staticmethod
+    def write_json_lines(iterable, fp, batch_size=1000, backend=None,
+                         **kwargs):
+        """
+        Write each value (usually a `udict`) in `iterable` encoded as JSON
+        on its own line to the text file-like object `fp`, making a JSON
+        Lines (or NDJSON) document, and return the number of lines written.
+
+        The lines are written in batches of up to `batch_size` lines at a
+        time, and a single encoder is reused for every value. See `toJSON`
+        for the meaning of the other arguments, except that `indent` isn't
+        supported (as each value must be on a single line), so `ValueError`
+        is raised if it is given.
+        """
+        if kwargs.get("indent") is not None:
+            raise ValueError("indent isn't supported in JSON Lines")
+        encode = get_json_backend(backend).encoder(**kwargs)
+        count = 0
+        batch = []
+        for value in iterable:
+            batch.append(encode(value))
+            if len(batch) >= batch_size:
+                fp.write(_json_text("\n".join(batch) + "\n"))
+                count += len(batch)
+                batch = []
+        if batch:
+            fp.write(_json_text("\n".join(batch) + "\n"))
+            count += len(batch)
+        return count
+
+    def toJSON(self, backend=None, cache=False, **kwargs):
+        """
+        Return this `udict` encoded as a JSON `str`.
+
+        The JSON backend registered with the given `backend` name (or the
+        default backend) is used, and any keyword arguments are passed to
+        it.
+
+        If `cache` is true, the encoding of each nested udict that
+        doesn't contain a plain `dict`, `list` or other mutable value is
+        cached until it (or a udict in it) changes, so encoding a large
+        udict again after a few changes only encodes the changed paths
+        (and the dicts and lists that aren't cached). The keyword
+        arguments must then be hashable, and `indent` isn't supported.
+        """
+        backend = get_json_backend(backend)
+        if cache:
+            return _encode_cached(self, backend, kwargs)
+        return backend.dumps(self, **kwargs)
+
+    def dump(self, fp, backend=None, **kwargs):
+        """
+        Write this `udict` encoded as JSON to the (text) file-like object
+        `fp`, as a sequence of chunks (see `iterJSON`).
+
+        See `toJSON` for the meaning of the other arguments.
+        """
+        get_json_backend(backend).dump(self, fp, **kwargs)
+
+    def iterJSON(self, backend=None, **kwargs):
+        """
+        Return an iterator over the chunks of `str` that make up the
+        encoding of this `udict` as JSON, so a large `udict` can be written
+        without first building the complete encoded document.
+
+        See `toJSON` for the meaning of the arguments.
+        """
+        return get_json_backend(backend).iterencode(self, **kwargs)
+
+    def to_bytes(self):
+        """
+        Return this `udict` encoded in a compact binary format, which
+        `from_bytes` decodes.
+
+        The format supports the values that JSON does, plus `tuple`,
+        `bytes`, and keys that aren't strings, and it keeps the difference
+        between the udicts and the plain dicts in this `udict`. Each key
+        is only written once, no matter how many dicts it is used by, so
+        the result is usually much smaller than the JSON encoding or the
+        pickle. To share the keys between many udicts, see `to_bytes_many`.
+
+        The format is encoded and decoded in pure Python, so it's slower
+        than `pickle` and `toJSON` (and `from_bytes` is slower than
+        `fromJSON`): it's for when the size of the encoding matters more
+        than the time taken to produce or read it, such as for a cache or
+        for sending over a network.
+
+        `TypeError` is raised for values of any other type.
+        """
+        out = bytearray(_BINARY_HEADER)
+        _encode_binary((self,), out, {})
+        return bytes(out)
 
     @classmethod
-    def fromkeys(self, seq, value=None):
-        return udict((elem, value) for elem in seq)
+    def from_bytes(cls, data):
+        """
+        Create a new `udict` from the `bytes` `data` returned by `to_bytes`,
+        with each encoded `udict` (at any depth) decoded to an instance of
+        this class, keeping its keys as they are (see `verbatim`).
+
+        `ValueError` is raised if `data` isn't a valid encoding of a single
+        value.
+        """
+        values = list(_iter_binary(data, cls))
+        if len(values) != 1:
+            raise ValueError("expected 1 encoded value, found %d" %
+                             len(values))
+        return values[0]
+
+    @staticmethod
+    def to_bytes_many(values):
+        """
+        Return the values (usually udicts) in the iterable `values`
+        encoded together in the binary format of `to_bytes`, with a key
+        table shared by all of them, which `from_bytes_many` decodes.
+        """
+        out = bytearray(_BINARY_HEADER)
+        _encode_binary(values, out, {})
+        return bytes(out)
 
     @classmethod
-    def fromJSON(cls, json_string):
+    def from_bytes_many(cls, data):
         """
-        creates a dictionary json string
+        Return the list of the values encoded in the `bytes` `data` by
+        `to_bytes_many` (or `to_bytes`), decoded as `from_bytes` does.
         """
-        jmsg = json.loads(json_string)
-        return cls.fromdict(jmsg)
+        return list(_iter_binary(data, cls))
 
     @classmethod
-    def fromdict(cls, mapping):
+    def fromdict(cls, mapping, lists=False, keep=None, drop=None):
         """
         Create a new `udict` from the given `mapping` dict.
 
@@ -176,39 +615,234 @@ class udict(dict):
         converted to an `udict` instance.  If you don't want
         this behavior (i.e., you want sub-dicts to remain plain dicts),
         use `udict(mapping)` instead.
+
+        If `lists` is true, then `list` and `tuple` values are copied
+        too, with any dicts they contain (at any depth) also converted.
+        The conversion doesn't recurse, so it works for arbitrarily
+        deep nesting.
+
+        If `keep` is given, it is a list of dotted keys (like
+        'result.status.code') and only the values at those keys (and the
+        dicts containing them) are converted, while everything else is
+        left out. If `drop` is given, it is likewise a list of dotted keys
+        whose values are left out. A dotted key applies to every element of
+        a list it passes through (e.g., 'items.id' with a list of `items`),
+        whose elements that aren't dicts are kept as they are.
+        """
+        if keep is None and drop is None:
+            return _convert(mapping, cls, dict, lists)
+        return _project(mapping, cls, lists, keep, drop)
+
+    @classmethod
+    def fromdict_many(cls, mappings, workers=None, chunksize=1000,
+                      **kwargs):
+        """
+        Generate the `udict` (see `fromdict`) for each dict in the iterable
+        `mappings`, in order, converting them in a pool of processes as
+        described for `fromJSON_many`. The other keyword arguments are
+        passed to `fromdict`.
+
+        As the dicts are pickled to send them to the processes, and the
+        udicts to return them, this is only faster than `fromdict` when
+        the dicts are large, or when they come from a generator that does
+        more work than `fromdict` in the processes.
         """
-        ud = cls()
-        for k in mapping:
-            v = dict.__getitem__(mapping, k)  # okay for py2/py3
-            if isinstance(v, dict):
-                v = cls.fromdict(v)
-            dict.__setitem__(ud, k, v)
-        return ud
+        return _many(cls, "fromdict", mappings, workers, chunksize, kwargs)
 
-    def todict(self):
+    def todict(self, lists=False):
         """
         Create a plain `dict` from this `udict`.
 
         The resulting `dict` will be equivalent to this `udict`
         but with every `udict` value (recursively) converted to
         a plain `dict` instance.
+
+        If `lists` is true, then `list` and `tuple` values are copied
+        too, with any `udict` instances they contain also converted.
+        """
+        return _convert(self, dict, udict, lists)
+
+    def flatten(self, sep="."):
+        """
+        Generate a (dotted key, value) pair for each value in this `udict`
+        that isn't a non-empty dict, at any depth, where the dotted key
+        joins the keys of the path to the value with `sep`. For example,
+        `udict.fromdict({'a': {'b': 1}, 'c': {}})` generates ('a.b', 1) and
+        ('c', {}). Keys that aren't strings are converted with `str`.
+
+        The values are generated depth-first, in the order of each dict,
+        without recursing, and `unflatten` reverses the flattening (as
+        long as no key contains `sep`).
+        """
+        stack = [("", iter(iteritems(self)))]
+        while stack:
+            prefix, items = stack[-1]
+            for key, value in items:
+                key = prefix + (key if isinstance(key, _STRINGS)
+                                else str(key))
+                if isinstance(value, dict) and value:
+                    stack.append((key + sep, iter(iteritems(value))))
+                    break
+                yield key, value
+            else:
+                stack.pop()
+
+    @classmethod
+    def unflatten(cls, pairs, sep="."):
+        """
+        Create a new `udict` from the (dotted key, value) pairs of the
+        iterable (or dict) `pairs`, as generated by `flatten`, with a
+        nested `udict` for each distinct prefix of the keys.
+
+        Each nested `udict` is created once and then found by its prefix,
+        so each pair costs about one dictionary lookup, however deep its
+        key. `ValueError` is raised if a key is also the prefix of
+        another key, and `TypeError` if a key isn't a string.
+        """
+        if isinstance(pairs, dict):
+            pairs = iteritems(pairs)
+        result = _new(cls)
+        # (the prefix of the keys without `sep` is `None` rather than "",
+        # which is the prefix of those in a nested dict with an empty key)
+        nodes = {None: result}
+        for key, value in pairs:
+            if not isinstance(key, _STRINGS):
+                raise TypeError("can't unflatten a '%s' key"
+                                % type(key).__name__)
+            prefix, found, token = key.rpartition(sep)
+            node = nodes.get(prefix if found else None)
+            if node is None:
+                node = _prefix(nodes, prefix, sep, cls)
+            if key in nodes:
+                raise ValueError("'%s' is both a key and a prefix" % (key,))
+            dict.__setitem__(node, token, value)
+        return result
+
+    def fingerprint(self):
+        """
+        Return a hash of the contents of this `udict` (a hex `str`), which
+        is the same for any dicts whose keys and values have equal types
+        and values (so `udict(a=1)` and `udict(a=1.0)` differ), however
+        their items are ordered, and which is stable across processes.
+        Nested dicts and sequences are hashed by their contents too, and
+        the other values must be `None`, numbers, strings, or (frozen) sets
+        of these. `TypeError` is raised for any other value.
+
+        The fingerprint of each nested `udict` is cached (in the `udict`)
+        and reused, as long as the `udict` doesn't change, so computing the
+        fingerprint again after a change only costs rehashing the parents
+        of the change. A `udict` containing a plain `dict` or a `list`,
+        whose changes can't be detected, isn't cached, however.
+        """
+        return _fingerprint(self)
+
+    def diff(self, other):
         """
-        d = dict()
-        for k in self:
-            v = dict.__getitem__(self, k)
-            if isinstance(v, udict):
-                v = v.todict()
-            d[k] = v
-        return d
+        Return the list of changes that turn this `udict` into the `other`
+        dict, comparing nested dicts key by key, at any depth. Each change
+        is an ('add', key, value), ('change', key, value), or ('remove',
+        key, None) tuple, where `key` is the dotted key of the change (or
+        the tuple of its keys if one of them isn't a string or contains a
+        '.'), and `value` is the new value. `apply_patch` applies them.
+
+        A nested value that is the same object in both dicts is skipped
+        without being compared, and nested dicts that are equal are skipped
+        after a single comparison (made by `dict` itself), or at once if
+        both have a cached `fingerprint`. Two `frozenudict` instances with
+        different (cached) hashes are known to differ, and so are compared
+        key by key straight away.
+        """
+        patch = []
+        pending = [(self, other, ())]
+        while pending:
+            old, new, path = pending.pop()
+            for key, value in iteritems(old):
+                other_value = dict.get(new, key, _MISSING)
+                if other_value is value:
+                    continue
+                if other_value is _MISSING:
+                    patch.append(("remove", _dotted(path + (key,)), None))
+                elif isinstance(value, dict) and isinstance(other_value,
+                                                            dict):
+                    if not _same(value, other_value):
+                        pending.append((value, other_value, path + (key,)))
+                elif value != other_value:
+                    patch.append(("change", _dotted(path + (key,)),
+                                  other_value))
+            for key, value in iteritems(new):
+                if not dict.__contains__(old, key):
+                    patch.append(("add", _dotted(path + (key,)), value))
+        return patch
+
+    def apply_patch(self, patch):
+        """
+        Apply the changes in the `patch` list (as returned by `diff`) to
+        this `udict` in place. Added dicts are copied as for `deep_update`.
+        `KeyError` is raised if the parent of a changed key doesn't exist,
+        or if a removed key doesn't exist.
+        """
+        for op, key, value in patch:
+            if isinstance(key, _STRINGS):
+                tokens = _compile(key).tokens if "." in key else (key,)
+            else:
+                tokens = tuple(key)
+            obj = self
+            for token in tokens[:-1]:
+                obj = _get(obj, token)
+            _mutable(obj)
+            if op == "remove":
+                dict.__delitem__(obj, tokens[-1])
+            elif op in ("add", "change"):
+                dict.__setitem__(obj, tokens[-1], _adopt(obj, value))
+            else:
+                raise ValueError("unknown patch operation: %r" % (op,))
+            _touch(obj, tokens[-1:])
+
+    def deep_update(self, other, strategy="replace"):
+        """
+        Update this `udict` in place with the mappings of the `other` dict,
+        merging nested dicts rather than replacing them.
+
+        Where both this `udict` and `other` have a dict for the same key,
+        the two dicts are merged key by key, at any depth (a nested
+        `frozenudict` is replaced by a merged copy, as it can't be changed).
+        Each other value of `other` is set where there's no mapping yet,
+        with a dict copied (as for `fromdict`, but with the class of the
+        dict it is added to). Otherwise `strategy` decides which value to
+        keep:
+
+        - 'replace': the value from `other` (like `dict.update`).
+        - 'keep': the existing value.
+        - 'append': the concatenation of the two values if both are a
+          `list` or `tuple`, or else the value from `other`.
+        - a callable: the result of calling it with the dotted key of the
+          conflict (as a `str`), the existing value, and the value from
+          `other`.
+        - a dict: the strategy (any of the above) mapped to the dotted key
+          of the conflict, or else to its nearest parent, or else 'replace'.
+
+        The merge doesn't recurse, so it works for arbitrarily deep dicts.
+        """
+        _merge(_mutable(self), other, strategy, False)
+
+    def merge(self, other, strategy="replace"):
+        """
+        Return a copy of this `udict` updated by `deep_update`, without
+        changing this `udict`. Only the dicts that are changed by the merge
+        are copied, and every other value is shared with this `udict`.
+        """
+        result = _new(type(self), self)
+        _merge(result, other, strategy, True)
+        return result
 
     def copy(self):
         """
-        Return a shallow copy of this `udict`.
+        Return a shallow copy of this `udict`, of the same class.
 
         For a deep copy, use `udict.fromdict` (as long as there aren't
         plain dict values that you don't want converted to `udict`).
         """
-        return udict(self)
+        return _new(self.__class__, self)
 
     def setdefault(self, key, default=None):
         """
@@ -227,15 +861,22 @@ class udict(dict):
 
     def pop(self, key, *args):
         if not isinstance(key, str) or "." not in key:
-            return dict.pop(self, key, *args)
-        try:
-            obj, token = _descend(self, key)
-        except KeyError:
+            obj, token = self, key
+        else:
+            try:
+                obj, token = _descend(self, key)
+            except KeyError:
+                if args:
+                    return args[0]
+                raise
+        value = dict.pop(_mutable(obj), token, _MISSING)
+        if value is _MISSING:
+            # nothing changed
             if args:
                 return args[0]
-            raise
-        else:
-            return dict.pop(obj, token, *args)
+            raise KeyError(token)
+        _touch(obj, (token,))
+        return value
 
     def __dir__(self):
         """
@@ -246,43 +887,2734 @@ class udict(dict):
         return sorted(set(dir(udict)) | set(self.keys()))
 
 
-# helper to do careful and consistent `obj[name]`
-def _get(obj, name):
+class lazyudict(udict):
+
     """
-    Get the indexable value with given `name` from `obj`, which may be
-    a `dict` (or subclass) or a non-dict that has a `__getitem__` method.
+    A `udict` that converts its nested plain dicts on first access.
+
+    Creating a `lazyudict(mapping)` is as cheap as `udict(mapping)`, but
+    whenever a plain `dict` value is returned by `__getitem__`, `get`,
+    `get_many`, `setdefault`, or attribute-style access, it is first
+    converted to a `lazyudict`, which replaces the plain `dict` in its
+    parent. So only the parts of a large document that are actually used
+    are ever converted, unlike with `udict.fromdict`.
+
+    Values seen by iterating (e.g., with `values` or `items`) are not
+    converted.
     """
-    try:
-        # try to get value using dict's __getitem__ descriptor first
-        return dict.__getitem__(obj, name)
-    except TypeError:
-        # if it's a dict, then preserve the TypeError
-        if isinstance(obj, dict):
-            raise
-        # otherwise try one last time, relying on __getitem__ if any
-        return obj[name]
 
+    def __getitem__(self, key):
+        if not isinstance(key, str) or "." not in key:
+            return _lazy(type(self), self, key, dict.__getitem__(self, key))
+        return _lazy_path(type(self), self, _compile(key).tokens)
+
+    def __getattr__(self, key):
+        return _lazy(type(self), self, key, udict.__getattr__(self, key))
+
+    def get(self, key, default=None):
+        if not isinstance(key, str) or "." not in key:
+            value = dict.get(self, key, _MISSING)
+            if value is _MISSING:
+                return default
+            return _lazy(type(self), self, key, value)
+        try:
+            return _lazy_path(type(self), self, _compile(key).tokens)
+        except KeyError:
+            return default
+
+    def get_many(self, keys, default=None):
+        keys = list(keys)
+        values = udict.get_many(self, keys, _MISSING)
+        for i, value in enumerate(values):
+            if value is _MISSING:
+                values[i] = default
+            elif type(value) is dict:
+                values[i] = self.get(keys[i], default)
+        return values
+
+    def pop(self, key, *args):
+        return _lazy(type(self), None, key, udict.pop(self, key, *args))
+
+    def __contains__(self, key):
+        # a membership test shouldn't convert anything
+        return udict.get(self, key, _MISSING) is not _MISSING
+
+
+class frozenudict(udict):
 
-# helper for common use case of traversing a path like 'a.b.c.d'
-# to get the 'a.b.c' object and do something to it with the 'd' token
-def _descend(obj, key):
     """
-    Descend on `obj` by splitting `key` on '.' (`key` must contain at least
-    one '.') and using `get` on each token that results from splitting
-    to fetch the successive child elements, stopping on the next-to-last.
+    An immutable, hashable `udict`.
 
-     A `__getitem__` would do `dict.__getitem__(value, token)` with the
-     result, and a `__setitem__` would do `dict.__setitem__(value, token, v)`.
+    A `frozenudict` is deep-frozen: when one is created, every nested dict
+    is converted to a `frozenudict` and every `list` and `tuple` (at any
+    depth) to a `tuple`. So it can be used as a dict key or a set member,
+    and shared between threads, as long as its other values are hashable.
+    Its hash is computed only once and then cached.
 
-    :returns:
-    (value, token) - `value` is the next-to-last object found, and
-    `token` is the last token in the `key` (the only one that wasn't consumed
-    yet).
+    Reading works as for a `udict`, including attribute-style access and
+    dotted keys, but any attempt to modify a `frozenudict` raises
+    `TypeError`. Instead, `set`, `remove`, and `evolve` return modified
+    copies, which share every nested value not on the path to a change
+    (so a version can be kept as a snapshot for free, and each new
+    version costs only a shallow copy of each dict on the path to the
+    change). Use `thaw` to get an ordinary, mutable `udict`.
+
+    `fromdict` and `fromJSON` create a `frozenudict` directly (their
+    `lists` argument is ignored, as lists are always frozen).
     """
-    tokens = key.split(".")
-    if len(tokens) < 2:
-        raise ValueError(key)
-    value = obj
-    for token in tokens[:-1]:
-        value = _get(value, token)
-    return value, tokens[-1]
+
+    def __new__(cls, *args, **kwargs):
+        # the contents are set here rather than in `__init__`, which can
+        # be called again on an existing instance
+        self = udict.__new__(cls)
+        udict.__init__(self, *args, **kwargs)
+        for key, value in list(iteritems(self)):
+            frozen = _freeze(value, cls)
+            if frozen is not value:
+                dict.__setitem__(self, key, frozen)
+        return self
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __hash__(self):
+        try:
+            return self.__dict__["_hash"]
+        except KeyError:
+            value = self.__dict__["_hash"] = hash(frozenset(iteritems(self)))
+            return value
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("'%s' object is immutable" % type(self).__name__)
+
+    __setitem__ = __delitem__ = __setattr__ = __delattr__ = _immutable
+    setdefault = pop = popitem = clear = update = set_many = _immutable
+    deep_update = apply_patch = _immutable
+    __ior__ = _immutable
+
+    @classmethod
+    def verbatim(cls, *args, **kwargs):
+        return _freeze(dict(*args, **kwargs), cls)
+
+    @classmethod
+    def fromkeys(cls, seq, value=None):
+        return _new(cls, dict.fromkeys(seq, _freeze(value, cls)))
+
+    @classmethod
+    def fromdict(cls, mapping, lists=False, keep=None, drop=None):
+        if keep is not None or drop is not None:
+            mapping = _project(mapping, dict, True, keep, drop)
+        return _freeze(mapping, cls)
+
+    @classmethod
+    def fromJSON(cls, json_string, backend=None, keep=None, drop=None,
+                 **kwargs):
+        value = get_json_backend(backend).loads(json_string, **kwargs)
+        if keep is None and drop is None:
+            return _freeze(value, cls, True)
+        return _freeze(_project(value, dict, True, keep, drop, True), cls)
+
+    @classmethod
+    def iter_json_lines(cls, fp, batch_size=None, backend=None, **kwargs):
+        values = udict.iter_json_lines(fp, batch_size, backend, **kwargs)
+        for value in values:
+            if batch_size is None:
+                yield _freeze(value, cls)
+            else:
+                yield [_freeze(item, cls) for item in value]
+
+    @classmethod
+    def iter_json_array(cls, fp, path=None, chunk_size=65536, backend=None,
+                        **kwargs):
+        values = udict.iter_json_array(fp, path, chunk_size, backend,
+                                       **kwargs)
+        for value in values:
+            yield _freeze(value, cls)
+
+    @classmethod
+    def unflatten(cls, pairs, sep="."):
+        return _freeze(udict.unflatten(pairs, sep), cls)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return _freeze(udict.from_bytes(data), cls)
+
+    @classmethod
+    def from_bytes_many(cls, data):
+        return [_freeze(value, cls) for value in udict.from_bytes_many(data)]
+
+    def copy(self):
+        # there's no need to copy something that can't change
+        return self
+
+    def thaw(self):
+        """
+        Return a mutable deep copy of this `frozenudict`, in which every
+        nested `frozenudict` is converted to a `udict`. The tuples (which
+        may have been lists before being frozen) remain tuples.
+        """
+        return _convert(self, udict, frozenudict, True)
+
+    def evolve(self, mapping=None, **kwargs):
+        """
+        Return a copy of this `frozenudict` with the value for each (maybe
+        dotted) key in the `mapping` dict and in the keyword arguments set,
+        like `udict.set_many` would do.
+
+        Only the nested `frozenudict` instances on the path to each of these
+        keys are copied (shallowly), and every other value is shared with
+        this one, so it takes time proportional to the sizes of those dicts
+        rather than to the size of the whole `frozenudict`.
+        """
+        changes = list(iteritems(mapping)) if mapping else []
+        changes.extend(iteritems(kwargs))
+        return _evolve(self, [(key, _freeze(value, type(self)))
+                              for key, value in changes])
+
+    def set(self, key, value):
+        """
+        Return a copy of this `frozenudict` with `value` set for the (maybe
+        dotted) `key`, sharing everything else (see `evolve`).
+
+        As with `udict.__setitem__`, `KeyError` is raised if the parent of
+        a dotted key doesn't exist.
+        """
+        return _evolve(self, [(key, _freeze(value, type(self)))])
+
+    def remove(self, key):
+        """
+        Return a copy of this `frozenudict` without the mapping for the
+        (maybe dotted) `key`, sharing everything else (see `evolve`).
+
+        As with `udict.__delitem__`, `KeyError` is raised if there is no
+        such mapping.
+        """
+        return _evolve(self, [(key, _MISSING)])
+
+
+def _mutable(obj):
+    """
+    Return `obj`, raising `TypeError` if it is a `frozenudict`.
+    """
+    if isinstance(obj, frozenudict):
+        obj._immutable()
+    return obj
+
+
+def _freeze(root, cls=frozenudict, hyphens=False):
+    """
+    Return a deep-frozen copy of `root`, in which each dict (at any depth,
+    including `root`) is converted to a `cls` instance, and each `list` and
+    `tuple` to a `tuple`. If `hyphens` is true, each '-' in the (string)
+    keys of the converted dicts is replaced by '_'.
+
+    A `frozenudict` is already frozen, so it is used as is rather than
+    copied. Like `_convert`, this uses an explicit stack of the containers
+    still to be scanned rather than recursion.
+    """
+    def copy(value):
+        if isinstance(value, frozenudict) or not (
+                isinstance(value, dict) or type(value) in _SEQUENCES):
+            return value
+        if isinstance(value, dict):
+            obj = _new(cls, value)
+            if hyphens:
+                _unhyphenate(obj)
+        else:
+            obj = list(value)
+        pending.append(obj)
+        return obj
+
+    pending = []
+    lists = []
+    result = copy(root)
+    while pending:
+        obj = pending.pop()
+        if type(obj) is list:
+            for index, value in enumerate(obj):
+                obj[index] = value = copy(value)
+                if type(value) is list:
+                    lists.append((obj, index))
+        else:
+            for key, value in iteritems(obj):
+                frozen = copy(value)
+                if frozen is not value:
+                    dict.__setitem__(obj, key, frozen)
+                    if type(frozen) is list:
+                        lists.append((obj, key))
+    # as in `_convert`, inner lists are converted before outer ones
+    for obj, key in reversed(lists):
+        if type(obj) is list:
+            obj[key] = tuple(obj[key])
+        else:
+            dict.__setitem__(obj, key, tuple(dict.__getitem__(obj, key)))
+    if type(result) is list:
+        result = tuple(result)
+    return result
+
+
+def _evolve(root, changes):
+    """
+    Return a copy of the `frozenudict` `root` with the value for each
+    (maybe dotted) key in the list of (key, value) `changes` set (or the
+    key removed if the value is `_MISSING`), copying only the nested
+    `frozenudict` instances on the path to each key.
+    """
+    result = _new(type(root), root)
+    # the copies made so far, by the tokens of their paths
+    copies = {}
+    for key, value in changes:
+        if isinstance(key, str) and "." in key:
+            tokens = _compile(key).tokens
+        else:
+            tokens = (key,)
+        obj = result
+        for i in range(len(tokens) - 1):
+            token = tokens[i]
+            child = copies.get(tokens[:i + 1])
+            # (the copy is stale if something has since replaced it)
+            if child is None or dict.get(obj, token) is not child:
+                child = _get(obj, token)
+                if not isinstance(child, frozenudict):
+                    raise TypeError("'%s' is not a frozenudict"
+                                    % ".".join(tokens[:i + 1]))
+                child = _new(type(child), child)
+                dict.__setitem__(obj, token, child)
+                copies[tokens[:i + 1]] = child
+            obj = child
+        if value is _MISSING:
+            dict.__delitem__(obj, tokens[-1])
+        else:
+            dict.__setitem__(obj, tokens[-1], value)
+    return result
+
+
+class overlayudict(MutableMapping):
+
+    """
+    A stack of udicts (or other dicts) that is used like a single `udict`,
+    in the manner of `collections.ChainMap`.
+
+    The layers are given from the top down, e.g.,
+    `overlayudict(request, tenant, environment, defaults)`, and are kept
+    as the `maps` list. Creating an overlay takes constant time, as
+    nothing is merged or copied up front. Instead, a key is looked up in
+    each layer in turn, when it is used. Attribute-style access and dotted
+    keys work as for a `udict`:
+
+    - The value of a key is the one in the topmost layer that has the key.
+
+    - When that value is a dict, the dicts for the key in the lower layers
+      are merged into it (down to a layer where the key has a value that
+      isn't a dict), and the result is an `overlayudict` of those dicts.
+
+    Writes and deletions only ever change the top layer, and nested dicts
+    are created in it as needed. So setting `ov['a.b']` when only a lower
+    layer has an 'a' adds an 'a' dict holding only 'b' to the top layer.
+
+    If `cache` is true, the value resolved for each key (or path of keys)
+    is remembered until the next write through the overlay. Changes made
+    directly to the layers then aren't seen until that write.
+    """
+
+    def __init__(self, *maps, **kwargs):
+        cache = kwargs.pop("cache", False)
+        if kwargs:
+            raise TypeError("unexpected keyword arguments: %s"
+                            % ", ".join(sorted(kwargs)))
+        self.__dict__.update(
+            maps=list(maps) or [udict()],
+            _cache={} if cache else None,
+            _path=(),
+            # the overlay and key this is the value of, if any, and whether
+            # the first of `maps` is (part of) the top layer
+            _parent=None,
+            _key=None,
+            _top=True,
+        )
+
+    def _child(self, key, maps, top):
+        child = object.__new__(type(self))
+        child.__dict__.update(maps=maps, _cache=self._cache,
+                              _path=self._path + (key,), _parent=self,
+                              _key=key, _top=top)
+        return child
+
+    def _resolve(self, key):
+        found = []
+        for obj in self.maps:
+            if isinstance(obj, dict):
+                value = dict.get(obj, key, _MISSING)
+            else:
+                value = obj.get(key, _MISSING)
+            if value is _MISSING:
+                continue
+            if not isinstance(value, dict):
+                if found:
+                    break
+                return value
+            if not found:
+                top = self._top and obj is self.maps[0]
+            found.append(value)
+        if not found:
+            raise KeyError(key)
+        if top and len(found) == 1 and isinstance(found[0], udict):
+            # there's nothing to merge, and writes go to the top layer
+            return found[0]
+        return self._child(key, found, top)
+
+    def _lookup(self, key):
+        cache = self._cache
+        if cache is None:
+            return self._resolve(key)
+        path = self._path + (key,)
+        try:
+            return cache[path]
+        except KeyError:
+            value = cache[path] = self._resolve(key)
+            return value
+
+    def _writable(self):
+        # Return the (top layer) dict that writes to this overlay go to,
+        # creating it (and its parents) in the top layer if needed.
+        if not self._top:
+            parent = self._parent._writable()
+            obj = parent.get(self._key)
+            if not isinstance(obj, dict):
+                obj = parent[self._key] = udict()
+            self.maps.insert(0, obj)
+            self.__dict__["_top"] = True
+        return self.maps[0]
+
+    def _changed(self):
+        if self._cache:
+            self._cache.clear()
+
+    def __getitem__(self, key):
+        if not isinstance(key, str) or "." not in key:
+            return self._lookup(key)
+        return _compile(key)(self)
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, str) or "." not in key:
+            self._writable()[key] = value
+        else:
+            path = _compile(key)
+            path.parent(self)[path.token] = value
+        self._changed()
+
+    def __delitem__(self, key):
+        if isinstance(key, str) and "." in key:
+            path = _compile(key)
+            del path.parent(self)[path.token]
+        elif not self._top:
+            raise KeyError(key)
+        else:
+            del self.maps[0][key]
+        self._changed()
+
+    def __getattr__(self, key):
+        if key.startswith("__"):
+            raise AttributeError(key)
+        try:
+            return self._lookup(key)
+        except KeyError:
+            raise AttributeError("no attribute '%s'" % (key,))
+
+    def __setattr__(self, key, value):
+        self._writable()[key] = value
+        self._changed()
+
+    def __delattr__(self, key):
+        try:
+            if not self._top:
+                raise KeyError(key)
+            del self.maps[0][key]
+        except KeyError:
+            raise AttributeError("no attribute '%s'" % (key,))
+        self._changed()
+
+    def __iter__(self):
+        seen = set()
+        for obj in self.maps:
+            for key in obj:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return len(set().union(*self.maps))
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__,
+                           ", ".join(repr(obj) for obj in self.maps))
+
+    def new_child(self, mapping=None):
+        """
+        Return a new `overlayudict` with `mapping` (or a new empty `udict`)
+        as its top layer, on top of the layers of this one.
+        """
+        if mapping is None:
+            mapping = udict()
+        return type(self)(mapping, *self.maps, cache=self._cache is not None)
+
+    def todict(self, lists=False):
+        """
+        Return the merged contents of all the layers as a new plain dict,
+        converting every nested dict (and with `lists` true, copying every
+        `list` and `tuple`) as `udict.todict` does.
+        """
+        result = {}
+        pending = [(self, result)]
+        while pending:
+            overlay, obj = pending.pop()
+            for key in overlay:
+                value = overlay._lookup(key)
+                if isinstance(value, overlayudict):
+                    obj[key] = {}
+                    pending.append((value, obj[key]))
+                elif isinstance(value, dict) or (lists and
+                                                 type(value) in _SEQUENCES):
+                    obj[key] = _convert(value, dict, dict, lists)
+                else:
+                    obj[key] = value
+        return result
+
+
+def _prefix(nodes, prefix, sep, cls):
+    """
+    Return the `cls` instance for the `prefix` of the keys given to
+    `udict.unflatten`, creating it, and any of its parents that don't
+    exist yet in the `nodes` dict of the instances by prefix.
+    """
+    missing = []
+    while prefix not in nodes:
+        missing.append(prefix)
+        prefix, found, _ = prefix.rpartition(sep)
+        if not found:
+            prefix = None
+    node = nodes[prefix]
+    for prefix in reversed(missing):
+        token = prefix.rpartition(sep)[2]
+        if token in node:
+            raise ValueError("'%s' is both a key and a prefix" % (prefix,))
+        child = _new(cls)
+        dict.__setitem__(node, token, child)
+        nodes[prefix] = node = child
+    return node
+
+
+def _dotted(tokens):
+    """
+    Return the dotted key for the path of keys `tokens`, or `tokens` itself
+    if a dotted key can't represent them.
+    """
+    for token in tokens:
+        if not isinstance(token, _STRINGS) or "." in token:
+            return tokens
+    return ".".join(tokens)
+
+
+class _Memo(object):
+
+    """
+    The values cached in a `udict` (in its `__dict__`), which are only
+    valid until it changes.
+    """
+
+    __slots__ = ("fingerprint", "fragments", "parents")
+
+    def __init__(self):
+        self.fingerprint = None
+        # the JSON encodings, by backend and encoding options
+        self.fragments = {}
+        # the udicts with cached values that depend on this one, by id
+        self.parents = weakref.WeakValueDictionary()
+
+
+def _memo_of(obj):
+    # the memo of the udict `obj`, which is created if it has none
+    memo = obj.__dict__.get("_memo")
+    if memo is None:
+        memo = obj.__dict__["_memo"] = _Memo()
+    return memo
+
+
+def _touch(obj, keys=()):
+    """
+    Record a change to the `keys` of the dict `obj`, which may be any
+    dict: if it is a `trackedudict`, they are marked as dirty in it, and
+    if it has cached values, they are invalidated (see `_invalidate`).
+    """
+    if isinstance(obj, trackedudict):
+        _mark(obj, keys)
+    if isinstance(obj, udict) and obj.__dict__.get("_memo") is not None:
+        _invalidate(obj)
+
+
+def _invalidate(obj):
+    """
+    Invalidate the values cached in the changed udict `obj`, and in the
+    udicts that depend on it. Every udict that has a cached value has a
+    cached value in its parents too (as they are cached together), so the
+    invalidation stops at udicts that have nothing cached.
+    """
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        memo = obj.__dict__.get("_memo")
+        if memo is None or (memo.fingerprint is None and
+                            not memo.fragments):
+            continue
+        memo.fingerprint = None
+        memo.fragments.clear()
+        pending.extend(memo.parents.values())
+
+
+_SCALARS = (type(None), bool, int, type(2 ** 64), float, complex, str,
+            type(u""), bytes)
+_STRINGS = (str, type(u""))
+
+
+def _token(value):
+    """
+    Return the `str` representing the value `value`, which isn't a
+    container, in a fingerprint.
+    """
+    if isinstance(value, (set, frozenset)):
+        tokens = sorted(_token(item) for item in value)
+        return "%s{%s}" % (type(value).__name__, ",".join(tokens))
+    if not isinstance(value, _SCALARS):
+        raise TypeError("can't fingerprint a '%s' value"
+                        % type(value).__name__)
+    text = "%s:%r" % (type(value).__name__, value)
+    return "%d:%s" % (len(text), text)
+
+
+def _fingerprint(root):
+    """
+    Return the fingerprint of the dict or sequence `root`, as described by
+    `udict.fingerprint`, caching the fingerprints of the nested udicts
+    that don't contain a plain `dict`, `list`, or `set` (at any depth).
+
+    The containers are hashed after their contents, using an explicit
+    stack of the containers still to be hashed rather than recursion.
+    """
+    # the (fingerprint, cacheable) pair for each container by id
+    done = {}
+    stack = [root]
+    while stack:
+        obj = stack[-1]
+        if id(obj) in done:
+            stack.pop()
+            continue
+        memo = obj.__dict__.get("_memo") if isinstance(obj, udict) else None
+        if memo is not None and memo.fingerprint is not None:
+            done[id(obj)] = (memo.fingerprint, True)
+            stack.pop()
+            continue
+        values = obj.values() if isinstance(obj, dict) else obj
+        children = [value for value in values
+                    if (isinstance(value, dict) or
+                        type(value) in _SEQUENCES) and id(value) not in done]
+        if children:
+            stack.extend(children)
+            continue
+        stack.pop()
+        cacheable = isinstance(obj, udict) or type(obj) is tuple
+        if isinstance(obj, dict):
+            items = sorted(((_token(key), value)
+                            for key, value in iteritems(obj)),
+                           key=lambda item: item[0])
+            prefix = "dict"
+        else:
+            items = enumerate(obj)
+            prefix = "tuple" if type(obj) is tuple else "list"
+        parts = [prefix]
+        for key, value in items:
+            if id(value) in done:
+                token, ok = done[id(value)]
+            else:
+                token, ok = _token(value), not isinstance(value, set)
+            cacheable = cacheable and ok
+            parts.append("%s=%s" % (key, token))
+        digest = hashlib.sha1(";".join(parts).encode("utf-8")).hexdigest()
+        done[id(obj)] = (digest, cacheable)
+        if cacheable and isinstance(obj, udict):
+            _memo_of(obj).fingerprint = digest
+            _depend(obj)
+    return done[id(root)][0]
+
+
+def _separators(encode):
+    """
+    Return the (item separator, key separator) pair that the JSON
+    `encode` function puts between the members of an object.
+    """
+    text = encode({"a": 0, "b": 0})
+    start = text.index('"a"') + 3
+    end = text.index("0", start)
+    return text[end + 1:text.index('"b"', end)], text[start:end]
+
+
+def _encode_cached(root, backend, kwargs):
+    """
+    Return the udict `root` encoded as JSON by `backend` with the given
+    keyword arguments, as described for `udict.toJSON` with `cache`.
+
+    The udicts are encoded after the udicts in them, like `_fingerprint`,
+    with each run of other values encoded by a single call to the encoder.
+    """
+    if kwargs.get("indent") is not None:
+        raise ValueError("indent isn't supported when caching the encoding")
+    key = (backend, tuple(sorted(iteritems(kwargs))))
+    encode = backend.encoder(**kwargs)
+    item_sep, key_sep = _separators(encode)
+    # the (fragment, cacheable) pair for each udict by id
+    done = {}
+    stack = [root]
+    while stack:
+        obj = stack[-1]
+        if id(obj) in done:
+            stack.pop()
+            continue
+        memo = obj.__dict__.get("_memo")
+        fragment = memo.fragments.get(key) if memo is not None else None
+        if fragment is not None:
+            done[id(obj)] = (fragment, True)
+            stack.pop()
+            continue
+        children = [value for value in obj.values()
+                    if isinstance(value, udict) and id(value) not in done]
+        if children:
+            stack.extend(children)
+            continue
+        stack.pop()
+        if not all(isinstance(name, _STRINGS) for name in obj):
+            # leave the conversion of the keys to the encoder
+            done[id(obj)] = (encode(obj), False)
+            continue
+        items = list(iteritems(obj))
+        if kwargs.get("sort_keys"):
+            items.sort(key=lambda item: item[0])
+        frozen = isinstance(obj, frozenudict)
+        cacheable = True
+        parts = []
+        run = []
+        for name, value in items:
+            if isinstance(value, udict):
+                if run:
+                    parts.append(encode(dict(run))[1:-1])
+                    del run[:]
+                fragment, ok = done[id(value)]
+                parts.append(encode(name) + key_sep + fragment)
+                cacheable = cacheable and ok
+            else:
+                run.append((name, value))
+                cacheable = cacheable and (
+                    type(value) in _SCALARS or
+                    frozen and type(value) is tuple)
+        if run:
+            parts.append(encode(dict(run))[1:-1])
+        fragment = "{" + item_sep.join(parts) + "}"
+        done[id(obj)] = (fragment, cacheable)
+        if cacheable:
+            _memo_of(obj).fragments[key] = fragment
+            _depend(obj)
+    return done[id(root)][0]
+
+
+def _depend(obj):
+    """
+    Record that the values cached in the udict `obj` depend on the udicts
+    in it (or in its tuples), so that a change to any of them invalidates
+    them.
+    """
+    values = list(obj.values())
+    while values:
+        value = values.pop()
+        if isinstance(value, udict):
+            _memo_of(value).parents[id(obj)] = obj
+        elif type(value) is tuple:
+            values.extend(value)
+
+
+def _same(a, b):
+    """
+    Return whether the dicts `a` and `b` are known to be equal without
+    comparing them key by key, which `udict.diff` would otherwise do.
+    """
+    if isinstance(a, udict) and isinstance(b, udict):
+        # cached fingerprints (see `udict.fingerprint`) settle it
+        memo_a, memo_b = a.__dict__.get("_memo"), b.__dict__.get("_memo")
+        if memo_a is not None and memo_b is not None and (
+                memo_a.fingerprint is not None and
+                memo_b.fingerprint is not None):
+            return memo_a.fingerprint == memo_b.fingerprint
+    if isinstance(a, frozenudict) and isinstance(b, frozenudict):
+        # different hashes can only be those of different values
+        if hash(a) != hash(b):
+            return False
+    return a == b
+
+
+class trackedudict(udict):
+
+    """
+    A `udict` that records which (dotted) keys have changed.
+
+    Each change made by any method of a `trackedudict` (setting, deleting,
+    `pop`, `update`, `deep_update`, and so on, including by dotted key
+    or attribute) marks the changed key as dirty. So does a change to a
+    nested `trackedudict`, at any depth, from the time when it is added to
+    the outer one (or from when the outer one is created, e.g., by
+    `fromdict` or `fromJSON`). `dirty_paths` returns the dotted keys of the
+    changes, and `clear_dirty` forgets them, so a large document can be
+    saved by writing only the parts that changed.
+
+    Finding the dirty keys, and forgetting them, takes time proportional
+    to the number of changes rather than to the size of the document.
+    Changes to nested plain dicts and lists can't be seen, though.
+    """
+
+    def __init__(self, *args, **kwargs):
+        udict.__init__(self, *args, **kwargs)
+        _link(self)
+
+    def __reduce__(self):
+        return _linked, (self.__class__, dict(self))
+
+    # the methods of `udict` that change it directly, rather than through
+    # `_touch` (as a dotted key, `pop`, and `deep_update` do), are extended
+    # to mark the changed keys
+
+    def __setitem__(self, key, value):
+        udict.__setitem__(self, key, value)
+        if not isinstance(key, str) or "." not in key:
+            _mark(self, (key,))
+
+    def __delitem__(self, key):
+        udict.__delitem__(self, key)
+        if not isinstance(key, str) or "." not in key:
+            _mark(self, (key,))
+
+    def __setattr__(self, key, value):
+        udict.__setattr__(self, key, value)
+        _mark(self, (key,))
+
+    def __delattr__(self, key):
+        udict.__delattr__(self, key)
+        _mark(self, (key,))
+
+    def update(self, *args, **kwargs):
+        items = dict(*args, **kwargs)
+        udict.update(self, items)
+        _mark(self, items)
+
+    def popitem(self):
+        item = udict.popitem(self)
+        _mark(self, item[:1])
+        return item
+
+    def clear(self):
+        keys = list(self)
+        udict.clear(self)
+        _mark(self, keys)
+
+    @classmethod
+    def verbatim(cls, *args, **kwargs):
+        return _link(super(trackedudict, cls).verbatim(*args, **kwargs))
+
+    @classmethod
+    def fromkeys(cls, seq, value=None):
+        return _link(super(trackedudict, cls).fromkeys(seq, value))
+
+    @classmethod
+    def fromdict(cls, *args, **kwargs):
+        return _link(super(trackedudict, cls).fromdict(*args, **kwargs))
+
+    @classmethod
+    def fromJSON(cls, *args, **kwargs):
+        return _link(super(trackedudict, cls).fromJSON(*args, **kwargs))
+
+    @classmethod
+    def unflatten(cls, *args, **kwargs):
+        return _link(super(trackedudict, cls).unflatten(*args, **kwargs))
+
+    @classmethod
+    def from_bytes(cls, data):
+        return _link(super(trackedudict, cls).from_bytes(data))
+
+    @classmethod
+    def from_bytes_many(cls, data):
+        return _link(super(trackedudict, cls).from_bytes_many(data))
+
+    @classmethod
+    def iter_json_lines(cls, *args, **kwargs):
+        for value in super(trackedudict, cls).iter_json_lines(*args,
+                                                              **kwargs):
+            yield _link(value)
+
+    @classmethod
+    def iter_json_array(cls, *args, **kwargs):
+        for value in super(trackedudict, cls).iter_json_array(*args,
+                                                              **kwargs):
+            yield _link(value)
+
+    def copy(self):
+        return _link(udict.copy(self))
+
+    def merge(self, other, strategy="replace"):
+        return _link(udict.merge(self, other, strategy))
+
+    def dirty_paths(self, sep="."):
+        """
+        Return the set of the dotted keys (joined with `sep`) that have
+        changed since this `trackedudict` was created or `clear_dirty` was
+        last called. A key whose value was replaced or removed as a whole
+        hides the changes inside that value, so no key in the set is a
+        prefix of another one. Keys that aren't strings are converted
+        with `str`.
+        """
+        paths = set()
+        pending = [(self, "")]
+        while pending:
+            obj, prefix = pending.pop()
+            dirty = obj.__dict__.get("_dirty", ())
+            for key in dirty:
+                paths.add(prefix + (key if isinstance(key, _STRINGS)
+                                    else str(key)))
+            for key in obj.__dict__.get("_changed", ()):
+                child = dict.get(obj, key)
+                if key not in dirty and isinstance(child, trackedudict):
+                    key = key if isinstance(key, _STRINGS) else str(key)
+                    pending.append((child, prefix + key + sep))
+        return paths
+
+    def clear_dirty(self):
+        """
+        Forget the changes (see `dirty_paths`) in this `trackedudict` and
+        in the nested ones.
+        """
+        pending = [self]
+        while pending:
+            obj = pending.pop()
+            obj.__dict__.pop("_dirty", None)
+            for key in obj.__dict__.pop("_changed", ()):
+                child = dict.get(obj, key)
+                if isinstance(child, trackedudict):
+                    pending.append(child)
+
+
+def _link(root, parent=None, key=None):
+    """
+    Record each `trackedudict` in `root` (or in the items of `root` if it
+    is a list or tuple), at any depth, as a child of the `trackedudict`
+    that holds it, so that its changes can be marked in its parents (see
+    `_mark`). If `parent` is given, `root` is its value for `key`.
+    Each `trackedudict` is only scanned once, and `root` is returned.
+    """
+    pending = [(root, parent, key)]
+    while pending:
+        obj, parent, key = pending.pop()
+        if isinstance(obj, trackedudict):
+            if parent is not None:
+                parents = obj.__dict__.setdefault("_parents", {})
+                parents[id(parent), key] = (weakref.ref(parent), key)
+            if obj.__dict__.get("_linked"):
+                continue
+            obj.__dict__["_linked"] = True
+            # (its changes can only be marked in a parent that tracks
+            # them, so there's no need to look inside other values)
+            for key, value in iteritems(obj):
+                if isinstance(value, trackedudict):
+                    pending.append((value, obj, key))
+        elif type(obj) in _SEQUENCES and parent is None:
+            pending.extend((value, None, None) for value in obj)
+    return root
+
+
+def _linked(cls, items):
+    # (how a pickled `trackedudict` is recreated)
+    return _link(_new(cls, items))
+
+
+def _mark(obj, keys):
+    """
+    Mark the `keys` of the `trackedudict` `obj` as dirty, and the keys of
+    `obj` in its parents (and theirs, and so on) as having dirty values.
+    """
+    dirty = obj.__dict__.setdefault("_dirty", set())
+    for key in keys:
+        dirty.add(key)
+        value = dict.get(obj, key, _MISSING)
+        if isinstance(value, trackedudict):
+            _link(value, obj, key)
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        parents = obj.__dict__.get("_parents")
+        if not parents:
+            continue
+        for link, (ref, key) in list(iteritems(parents)):
+            parent = ref()
+            if parent is None or dict.get(parent, key, _MISSING) is not obj:
+                # it has since been removed from that parent
+                del parents[link]
+                continue
+            changed = parent.__dict__.setdefault("_changed", set())
+            if key not in changed:
+                changed.add(key)
+                pending.append(parent)
+
+
+class _RWLock(object):
+
+    """
+    A reader-writer lock: any number of threads can hold it for reading
+    at once, or one thread can hold it for writing. It prefers writers,
+    so a thread waiting to write isn't starved by a stream of readers.
+
+    It is reentrant: a thread holding it for reading can acquire it for
+    reading again (even while a writer waits), and a thread holding it
+    for writing can acquire it for reading or writing again. A thread
+    holding it only for reading can't acquire it for writing, though, as
+    two threads doing that would wait for each other forever, so this
+    raises `RuntimeError` instead.
+    """
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._cond = threading.Condition(self._mutex)
+        # the number of times each reading thread holds it, by thread id
+        self._readers = {}
+        self._writer = None
+        self._depth = 0
+        # the number of threads waiting to write, and to read or write
+        self._waiting = 0
+        self._sleeping = 0
+
+    # (these use the mutex rather than the condition as a context
+    # manager, and only notify the condition when a thread is waiting,
+    # as that is much slower and they run for every method call)
+
+    def _wait(self):
+        self._sleeping += 1
+        try:
+            self._cond.wait()
+        finally:
+            self._sleeping -= 1
+
+    def acquire_read(self):
+        ident = get_ident()
+        with self._mutex:
+            if self._writer == ident:
+                self._depth += 1
+            elif ident in self._readers:
+                self._readers[ident] += 1
+            else:
+                while self._writer is not None or self._waiting:
+                    self._wait()
+                self._readers[ident] = 1
+
+    def release_read(self):
+        ident = get_ident()
+        with self._mutex:
+            if self._writer == ident:
+                self._depth -= 1
+                return
+            count = self._readers.pop(ident) - 1
+            if count:
+                self._readers[ident] = count
+            elif not self._readers and self._waiting:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        ident = get_ident()
+        with self._mutex:
+            if self._writer == ident:
+                self._depth += 1
+                return
+            if ident in self._readers:
+                raise RuntimeError("can't write while holding the lock "
+                                   "for reading")
+            self._waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._wait()
+            finally:
+                self._waiting -= 1
+            self._writer = ident
+            self._depth = 1
+
+    def release_write(self):
+        with self._mutex:
+            self._depth -= 1
+            if not self._depth:
+                self._writer = None
+                if self._sleeping:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def reading(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+# Guards the creation of the lock of each `lockedudict`.
+_locks_lock = threading.Lock()
+
+
+def _rwlock(obj):
+    """
+    Return the lock of the `lockedudict` `obj`, creating it the first time
+    (as a `lockedudict` may be created without calling `__init__`).
+    """
+    lock = obj.__dict__.get("_lock")
+    if lock is None:
+        with _locks_lock:
+            lock = obj.__dict__.setdefault("_lock", _RWLock())
+    return lock
+
+
+def _reading(method):
+    """
+    Return a version of `method` (of a `udict`) that holds the lock of the
+    `lockedudict` for reading while it runs.
+    """
+    def locked(self, *args, **kwargs):
+        lock = _rwlock(self)
+        lock.acquire_read()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            lock.release_read()
+    return _named(locked, method)
+
+
+def _writing(method):
+    """
+    Return a version of `method` (of a `udict`) that holds the lock of the
+    `lockedudict` for writing while it runs.
+    """
+    def locked(self, *args, **kwargs):
+        lock = _rwlock(self)
+        lock.acquire_write()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            lock.release_write()
+    return _named(locked, method)
+
+
+def _iterating(method):
+    """
+    Return a version of the generator `method` (of a `udict`) that
+    produces all of its values while holding the lock of the `lockedudict`
+    for reading, so they are consistent.
+    """
+    def locked(self, *args, **kwargs):
+        lock = _rwlock(self)
+        lock.acquire_read()
+        try:
+            values = list(method(self, *args, **kwargs))
+        finally:
+            lock.release_read()
+        return iter(values)
+    return _named(locked, method)
+
+
+def _named(wrapper, method):
+    # (`functools.wraps` fails for the methods of `dict` in python 2)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class lockedudict(udict):
+
+    """
+    A `udict` that can be shared by several threads.
+
+    Each method of a `lockedudict` holds its lock, for reading or for
+    writing, while it runs, including any traversal of dotted keys. So
+    `ud['a.b.c'] = 1` can't find 'a.b' and then set 'c' after another
+    thread has replaced 'a', and `get_many` or `todict` never see half of
+    an `update_paths`. Any number of threads can read at once.
+
+    `setdefault`, `compare_and_set`, `increment`, and `update_paths` are
+    atomic, and other compound operations can be made atomic with the
+    `reading` and `writing` context managers:
+
+        with ud.writing():
+            ud.total = ud.a + ud.b
+
+    Iterating over a `lockedudict` (or its keys, values, or items) while
+    another thread changes it fails as it does for a `dict`, so it should
+    be done in a `with ud.reading():` block.
+
+    The nested dicts of a `lockedudict` created by `fromdict` (or
+    `fromJSON`, and so on) are plain udicts, which have no lock of their
+    own, so to be thread-safe, changes must be made through the
+    `lockedudict`, e.g., with dotted keys, rather than through the nested
+    udicts it returns.
+    """
+
+    __getitem__ = _reading(udict.__getitem__)
+    __setitem__ = _writing(udict.__setitem__)
+    __delitem__ = _writing(udict.__delitem__)
+    __getattr__ = _reading(udict.__getattr__)
+    __setattr__ = _writing(udict.__setattr__)
+    __delattr__ = _writing(udict.__delattr__)
+    __contains__ = _reading(udict.__contains__)
+    __eq__ = _reading(dict.__eq__)
+    __ne__ = _reading(dict.__ne__)
+    __repr__ = _reading(dict.__repr__)
+    __reduce__ = _reading(udict.__reduce__)
+    get = _reading(udict.get)
+    get_many = _reading(udict.get_many)
+    set_many = _writing(udict.set_many)
+    update = _writing(udict.update)
+    popitem = _writing(udict.popitem)
+    clear = _writing(udict.clear)
+    setdefault = _writing(udict.setdefault)
+    pop = _writing(udict.pop)
+    copy = _reading(udict.copy)
+    todict = _reading(udict.todict)
+    toJSON = _reading(udict.toJSON)
+    dump = _reading(udict.dump)
+    iterJSON = _iterating(udict.iterJSON)
+    flatten = _iterating(udict.flatten)
+    fingerprint = _reading(udict.fingerprint)
+    diff = _reading(udict.diff)
+    apply_patch = _writing(udict.apply_patch)
+    deep_update = _writing(udict.deep_update)
+    merge = _reading(udict.merge)
+    to_bytes = _reading(udict.to_bytes)
+    if hasattr(dict, "__ior__"):
+        __ior__ = _writing(udict.__ior__)
+
+    @classmethod
+    def fromdict(cls, *args, **kwargs):
+        return _locked(cls, udict.fromdict(*args, **kwargs))
+
+    @classmethod
+    def fromJSON(cls, *args, **kwargs):
+        return _locked(cls, udict.fromJSON(*args, **kwargs))
+
+    @classmethod
+    def unflatten(cls, *args, **kwargs):
+        return _locked(cls, udict.unflatten(*args, **kwargs))
+
+    @classmethod
+    def from_bytes(cls, data):
+        return _locked(cls, udict.from_bytes(data))
+
+    @classmethod
+    def from_bytes_many(cls, data):
+        return _locked(cls, udict.from_bytes_many(data))
+
+    @classmethod
+    def iter_json_lines(cls, *args, **kwargs):
+        for value in udict.iter_json_lines(*args, **kwargs):
+            yield _locked(cls, value)
+
+    @classmethod
+    def iter_json_array(cls, *args, **kwargs):
+        for value in udict.iter_json_array(*args, **kwargs):
+            yield _locked(cls, value)
+
+    def reading(self):
+        """
+        Return a context manager that holds the lock of this `lockedudict`
+        for reading, so no other thread can change it in the meantime.
+        """
+        return _rwlock(self).reading()
+
+    def writing(self):
+        """
+        Return a context manager that holds the lock of this `lockedudict`
+        for writing, so no other thread can read or change it in the
+        meantime.
+        """
+        return _rwlock(self).writing()
+
+    @_writing
+    def compare_and_set(self, key, expected, value):
+        """
+        Set `value` for the (dotted) `key` if its current value is equal to
+        `expected`, and return whether it was set. It isn't set if the
+        `key` has no mapping.
+        """
+        current = self.get(key, _MISSING)
+        if current is _MISSING or current != expected:
+            return False
+        self[key] = value
+        return True
+
+    @_writing
+    def increment(self, key, amount=1):
+        """
+        Add `amount` to the value of the (dotted) `key`, which is set to
+        `amount` if the `key` has no mapping, and return the new value.
+        """
+        value = self.get(key, _MISSING)
+        value = amount if value is _MISSING else value + amount
+        self[key] = value
+        return value
+
+    @_writing
+    def update_paths(self, mapping):
+        """
+        Set the value for each (dotted) key in the `mapping` dict, as
+        `set_many` does, as a single atomic change.
+        """
+        self.set_many(mapping)
+
+
+def _locked(cls, value):
+    """
+    Return `value` with a `udict` (or the udicts in a list) converted to
+    the `lockedudict` class `cls`, sharing the nested values.
+    """
+    if isinstance(value, udict):
+        return _new(cls, value)
+    if type(value) is list:
+        return [_locked(cls, item) for item in value]
+    return value
+
+
+def _adopt(obj, value):
+    """
+    Return `value` converted for adding to the dict `obj`: frozen if `obj`
+    is a `frozenudict`, or else copied as by `udict.fromdict` (with the
+    class of `obj`) if it is a dict.
+    """
+    if isinstance(obj, frozenudict):
+        return _freeze(value, type(obj))
+    if isinstance(value, dict):
+        cls = type(obj) if isinstance(obj, udict) else dict
+        return _convert(value, cls, dict, False)
+    return value
+
+
+def _append(path, old, new):
+    if type(old) in _SEQUENCES and type(new) in _SEQUENCES:
+        return type(old)(list(old) + list(new))
+    return new
+
+
+_MERGE_STRATEGIES = {
+    "replace": lambda path, old, new: new,
+    "keep": lambda path, old, new: old,
+    "append": _append,
+}
+
+
+def _merge_strategy(strategy):
+    """
+    Return the function of a (path tokens, old, new) conflict that applies
+    the `strategy` given to `udict.deep_update`.
+    """
+    if isinstance(strategy, dict):
+        strategies = dict(
+            (_compile(key).tokens if isinstance(key, str) else (key,),
+             _merge_strategy(value))
+            for key, value in iteritems(strategy))
+        replace = _MERGE_STRATEGIES["replace"]
+
+        def merge(path, old, new):
+            for i in range(len(path), 0, -1):
+                func = strategies.get(path[:i])
+                if func is not None:
+                    return func(path, old, new)
+            return replace(path, old, new)
+        return merge
+    if callable(strategy):
+        def merge(path, old, new):
+            return strategy(".".join(str(token) for token in path), old, new)
+        return merge
+    try:
+        return _MERGE_STRATEGIES[strategy]
+    except (KeyError, TypeError):
+        raise ValueError("unknown merge strategy: %r" % (strategy,))
+
+
+def _merge(target, other, strategy, copy):
+    """
+    Merge the dict `other` into the dict `target` as `udict.deep_update`
+    describes. If `copy` is true, each nested dict of `target` is copied
+    before it is changed. Like `_convert`, this uses an explicit stack of
+    the pairs of dicts still to be merged rather than recursion.
+    """
+    merge = _merge_strategy(strategy)
+    pending = [(target, other, ())]
+    while pending:
+        obj, new, path = pending.pop()
+        changed = []
+        for key, value in iteritems(new):
+            old = dict.get(obj, key, _MISSING)
+            if old is _MISSING:
+                dict.__setitem__(obj, key, _adopt(obj, value))
+                changed.append(key)
+            elif isinstance(old, dict) and isinstance(value, dict):
+                if copy or isinstance(old, frozenudict):
+                    old = _new(type(old), old)
+                    dict.__setitem__(obj, key, old)
+                    changed.append(key)
+                pending.append((old, value, path + (key,)))
+            else:
+                merged = merge(path + (key,), old, value)
+                if merged is not old:
+                    dict.__setitem__(obj, key, _adopt(obj, merged))
+                    changed.append(key)
+        _touch(obj, changed)
+
+
+def _many(cls, method, values, workers, chunksize, kwargs):
+    """
+    Return an iterator over the result of the class method `method` of
+    `cls` (like 'fromJSON') with the given keyword arguments for each of
+    the `values`, in order, as described for `udict.fromJSON_many`.
+    """
+    # (checked here, as the generator wouldn't run until it's iterated)
+    if chunksize < 1:
+        raise ValueError("chunksize must be at least 1")
+    return _iter_many(cls, method, values, workers, chunksize, kwargs)
+
+
+def _iter_many(cls, method, values, workers, chunksize, kwargs):
+    convert = getattr(cls, method)
+    values = iter(values)
+    chunk = list(itertools.islice(values, chunksize))
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1 or len(chunk) < chunksize:
+        for value in itertools.chain(chunk, values):
+            yield convert(value, **kwargs)
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        # the chunks being converted, in order, with enough of them to
+        # keep every process busy while the results are consumed
+        pending = collections.deque()
+        while chunk:
+            task = (cls, method, chunk, kwargs)
+            pending.append(pool.apply_async(_convert_many, (task,)))
+            if len(pending) >= 2 * workers:
+                for value in pending.popleft().get():
+                    yield value
+            chunk = list(itertools.islice(values, chunksize))
+        while pending:
+            for value in pending.popleft().get():
+                yield value
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _convert_many(task):
+    # (run in the processes of `_many`)
+    cls, method, values, kwargs = task
+    convert = getattr(cls, method)
+    return [convert(value, **kwargs) for value in values]
+
+
+def _new(cls, items=()):
+    """
+    Return a new instance of the `dict` subclass `cls` holding the mappings
+    of the dict (or iterable of pairs) `items`, which are added in bulk
+    without going through `cls.__init__` and its handling of keys.
+    """
+    obj = dict.__new__(cls)
+    dict.update(obj, items)
+    return obj
+
+
+def _lazy(cls, obj, key, value):
+    """
+    Return `value`, the value of `key` in `obj`, converting it to a `cls`
+    instance that replaces it in `obj` if it is a plain `dict`.
+    """
+    if type(value) is not dict:
+        return value
+    converted = _new(cls, value)
+    # (the value may come from `__missing__` rather than from `obj`)
+    if isinstance(obj, dict) and dict.get(obj, key, _MISSING) is value:
+        dict.__setitem__(obj, key, converted)
+        _touch(obj)
+    return converted
+
+
+def _lazy_path(cls, obj, tokens):
+    """
+    Return the value at the path of `tokens` in the `lazyudict` `obj`, as
+    a chain of `__getitem__` calls would, converting each plain `dict` on
+    the path (see `_lazy`). A converted dict only replaces the original in
+    its parent if that is a `lazyudict` too, so nothing is ever stored in
+    a dict that the caller passed in.
+    """
+    for token in tokens:
+        value = _get(obj, token)
+        obj = _lazy(cls, obj if isinstance(obj, lazyudict) else None, token,
+                    value)
+    return obj
+
+
+def _text(data):
+    """
+    Return the JSON document `data` as text, decoding it if it is `bytes`
+    (which `json.loads` doesn't accept in all supported python versions).
+    """
+    if isinstance(data, (bytes, bytearray)) and not isinstance(data, str):
+        return data.decode("utf-8")
+    return data
+
+
+def _json_hook(cls):
+    """
+    Return an `object_pairs_hook` for the `json` module that decodes each
+    JSON object directly to an instance of `cls`.
+    """
+    def hook(pairs):
+        obj = _new(cls, pairs)
+        for key, value in pairs:
+            if "-" in key:
+                dict.pop(obj, key, None)
+                dict.__setitem__(obj, key.replace("-", "_"), value)
+        return obj
+    return hook
+
+
+class JSONBackend(object):
+
+    """
+    Base class for the JSON backends used by `udict.fromJSON` and
+    `udict.toJSON`, which are registered by name with
+    `register_json_backend`.
+
+    Subclasses must implement `loads` and `dumps`. The default `decode`
+    converts the plain dicts returned by `loads` to udicts afterwards, so
+    a backend whose decoder can construct the udicts directly should
+    override it.
+    """
+
+    def loads(self, data, **kwargs):
+        """
+        Decode the JSON `str` or `bytes` `data` to plain python objects.
+        """
+        raise NotImplementedError
+
+    def dumps(self, obj, **kwargs):
+        """
+        Encode `obj` (which may contain udicts) as a JSON `str`.
+        """
+        raise NotImplementedError
+
+    def decode(self, data, cls, **kwargs):
+        """
+        Decode `data` like `loads`, but with every JSON object decoded to
+        an instance of `cls`, as described for `udict.fromJSON`.
+        """
+        return _convert(self.loads(data, **kwargs), cls, dict, True, True)
+
+    def decoder(self, cls, **kwargs):
+        """
+        Return a function that decodes a JSON document like `decode` with
+        the given arguments, for decoding many documents.
+        """
+        return functools.partial(self.decode, cls=cls, **kwargs)
+
+    def encoder(self, **kwargs):
+        """
+        Return a function that encodes a value like `dumps` with the given
+        arguments, for encoding many values.
+        """
+        return functools.partial(self.dumps, **kwargs)
+
+    def raw_decoder(self, cls, **kwargs):
+        """
+        Return `None`, or a function like `json.JSONDecoder.raw_decode`
+        that decodes the first JSON value in a `str` starting at a given
+        index like `decode` with the given arguments, returning the value
+        and the index where it ended.
+        """
+        return None
+
+    def iterencode(self, obj, **kwargs):
+        """
+        Return an iterator over chunks of the encoding of `obj` as JSON.
+        By default, there is a single chunk, the result of `dumps`.
+        """
+        return iter([self.dumps(obj, **kwargs)])
+
+    def dump(self, obj, fp, **kwargs):
+        """
+        Write the encoding of `obj` as JSON to the file-like object `fp`,
+        one chunk (see `iterencode`) at a time.
+        """
+        for chunk in self.iterencode(obj, **kwargs):
+            fp.write(_json_text(chunk))
+
+
+class StdlibJSONBackend(JSONBackend):
+
+    """
+    A backend for the stdlib's `json` module, or for any module with the
+    same API (such as `simplejson`), which decodes JSON objects directly
+    to udicts using an `object_pairs_hook`.
+    """
+
+    def __init__(self, module=json):
+        self.module = module
+
+    def loads(self, data, **kwargs):
+        return self.module.loads(_text(data), **kwargs)
+
+    def dumps(self, obj, **kwargs):
+        return _json_encoder(self.module.dumps)(obj, **kwargs)
+
+    def decode(self, data, cls, **kwargs):
+        hook = _json_hook(cls)
+        return self.module.loads(_text(data), object_pairs_hook=hook,
+                                 **kwargs)
+
+    def decoder(self, cls, **kwargs):
+        decode = self.module.JSONDecoder(object_pairs_hook=_json_hook(cls),
+                                         **kwargs).decode
+        return lambda data: decode(_text(data))
+
+    def encoder(self, **kwargs):
+        cls = kwargs.pop("cls", None) or self.module.JSONEncoder
+        return _json_encoder(cls(**kwargs).encode)
+
+    def raw_decoder(self, cls, **kwargs):
+        return self.module.JSONDecoder(object_pairs_hook=_json_hook(cls),
+                                       **kwargs).raw_decode
+
+    def iterencode(self, obj, **kwargs):
+        """
+        Return an iterator over chunks of the encoding of `obj` as JSON.
+
+        Without an `indent`, each batch of members of a dict or list (at
+        any depth) is encoded in one go by the (C accelerated) `encode` of
+        the encoder, which is several times faster than the encoder's own
+        `iterencode`, while still limiting the size of a chunk.
+        """
+        cls = kwargs.pop("cls", None) or self.module.JSONEncoder
+        encoder = cls(**kwargs)
+        if encoder.indent is not None:
+            return (_json_text(chunk) for chunk in encoder.iterencode(obj))
+        return _iterencode(obj, encoder)
+
+
+# the number of members of a dict or list encoded per chunk, which is
+# also the most members (at any depth) a member can have and still be
+# encoded as part of a chunk rather than in chunks of its own
+_MEMBERS_PER_CHUNK = 64
+_CONTAINERS = (dict, list, tuple)
+
+
+def _larger(obj, limit):
+    """
+    Return whether the dict or list `obj` has more than `limit` members,
+    counting those of the dicts and lists in it at any depth, looking at
+    no more than about `limit` of them.
+    """
+    # (`pending` grows as it is iterated over)
+    pending = [obj]
+    for obj in pending:
+        limit -= len(obj)
+        if limit < 0:
+            return True
+        for value in (obj.values() if isinstance(obj, dict) else obj):
+            if isinstance(value, _CONTAINERS):
+                pending.append(value)
+    return False
+
+
+def _iterencode(obj, encoder):
+    """
+    Generate the JSON encoding of `obj` with the given `encoder`, in chunks
+    that each encode a batch of the members of a dict or list at any depth,
+    so the size of a chunk is bounded however deeply the values nest.
+
+    Each run of members is encoded a batch at a time by a single call to
+    the encoder, except for a member with too many members of its own
+    (see `_larger`), which is encoded in chunks in turn. The dicts and
+    lists being encoded in chunks are kept on an explicit stack of
+    [members, is_dict, is_empty, container] lists, rather than recursing.
+    """
+    encode = _json_encoder(encoder.encode)
+    item_sep, key_sep = encoder.item_separator, encoder.key_separator
+    stack = []
+    open_ids = set()  # to detect circular references, as the encoder does
+    parts = []  # the parts of the next chunk
+
+    def push(value):
+        # start encoding `value` in chunks, if it is a dict or list that
+        # can be, returning whether it is
+        if isinstance(value, dict):
+            if not all(isinstance(key, _STRINGS) for key in value):
+                # leave the conversion of non-string keys to the encoder
+                return False
+            members = list(iteritems(value))
+            if encoder.sort_keys:
+                members.sort(key=lambda item: item[0])
+            parts.append(u"{")
+        elif isinstance(value, (list, tuple)):
+            members = value
+            parts.append(u"[")
+        else:
+            return False
+        if id(value) in open_ids:
+            raise ValueError("Circular reference detected")
+        open_ids.add(id(value))
+        stack.append([iter(members), isinstance(value, dict), True, value])
+        return True
+
+    def add(frame, text):
+        # add the encoding `text` of the next member(s) of `frame`
+        if not frame[2]:
+            parts.append(item_sep)
+        frame[2] = False
+        parts.append(text)
+
+    if not push(obj):
+        yield encode(obj)
+        return
+    while stack:
+        frame = stack[-1]
+        members, is_dict = frame[0], frame[1]
+        batch = []
+        big = _MISSING
+        for member in members:
+            value = member[1] if is_dict else member
+            if (isinstance(value, _CONTAINERS) and
+                    _larger(value, _MEMBERS_PER_CHUNK)):
+                big = member
+                break
+            batch.append(member)
+            if len(batch) == _MEMBERS_PER_CHUNK:
+                # encode the batch as a dict or list, without its brackets
+                add(frame, encode(dict(batch) if is_dict else batch)[1:-1])
+                yield u"".join(parts)
+                del parts[:]
+                batch = []
+        if batch:
+            add(frame, encode(dict(batch) if is_dict else batch)[1:-1])
+            yield u"".join(parts)
+            del parts[:]
+        if big is _MISSING:
+            stack.pop()
+            open_ids.discard(id(frame[3]))
+            parts.append(u"}" if is_dict else u"]")
+        elif is_dict:
+            add(frame, encode(big[0]) + key_sep)
+            if not push(big[1]):
+                parts.append(encode(big[1]))
+        else:
+            add(frame, "")
+            if not push(big):
+                parts.append(encode(big))
+    yield u"".join(parts)
+
+
+class _ORJSONBackend(JSONBackend):
+
+    """
+    A backend for the `orjson` module.
+    """
+
+    def __init__(self, module):
+        self.module = module
+
+    def loads(self, data, **kwargs):
+        return self.module.loads(data, **kwargs)
+
+    def dumps(self, obj, **kwargs):
+        return self.module.dumps(obj, **kwargs).decode("utf-8")
+
+
+class _UJSONBackend(JSONBackend):
+
+    """
+    A backend for the `ujson` module.
+    """
+
+    def __init__(self, module):
+        self.module = module
+
+    def loads(self, data, **kwargs):
+        return self.module.loads(data, **kwargs)
+
+    def dumps(self, obj, **kwargs):
+        return self.module.dumps(obj, **kwargs)
+
+
+_json_backends = {}
+_json_backend = "json"
+
+
+def register_json_backend(name, backend):
+    """
+    Register the `JSONBackend` instance `backend` with the given `name`,
+    replacing any backend previously registered with that name.
+    """
+    _json_backends[name] = backend
+
+
+def get_json_backend(name=None):
+    """
+    Return the JSON backend registered with the given `name`, or the
+    default backend if `name` is `None`.
+    """
+    try:
+        return _json_backends[_json_backend if name is None else name]
+    except KeyError:
+        raise ValueError("no JSON backend named %r" % (name,))
+
+
+def set_json_backend(name):
+    """
+    Make the JSON backend registered with the given `name` the default,
+    which is initially the 'json' backend for the stdlib's `json` module.
+    """
+    global _json_backend
+    get_json_backend(name)
+    _json_backend = name
+
+
+def json_backends():
+    """
+    Return a sorted list of the names of the registered JSON backends.
+    """
+    return sorted(_json_backends)
+
+
+register_json_backend("json", StdlibJSONBackend())
+
+# optional faster backends, registered if they are installed
+try:
+    import simplejson
+except ImportError:
+    pass
+else:
+    register_json_backend("simplejson", StdlibJSONBackend(simplejson))
+
+try:
+    import ujson
+except ImportError:
+    pass
+else:
+    register_json_backend("ujson", _UJSONBackend(ujson))
+
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    register_json_backend("orjson", _ORJSONBackend(orjson))
+
+
+# the characters that are significant for `JSONArrayParser`, and in a string,
+# and whitespace
+_STRUCTURAL = re.compile(r'["{}\[\],]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+_WHITESPACE = re.compile(r"\s*")
+
+
+def _string_end(text, pos, escaped):
+    """
+    Return the position after the '"' that ends the JSON string whose
+    contents continue at `pos` in `text` (just after a '\\' if `escaped`)
+    and `False`, or else `None` and whether `text` ends in an escape.
+    """
+    search = _STRING_SPECIAL.search
+    if escaped:
+        pos += 1
+    while pos <= len(text):
+        match = search(text, pos)
+        if match is None:
+            return None, False
+        if text[match.start()] == '"':
+            return match.end(), False
+        pos = match.end() + 1
+    return None, True
+
+
+class JSONArrayParser(object):
+
+    """
+    An incremental parser for a JSON document containing a (possibly huge)
+    array, which decodes each element of the array as soon as it has been
+    completely fed to the parser, so memory use is proportional to the
+    size of one element rather than to the size of the document.
+
+    The array is the top-level value of the document if `path` is `None`,
+    or else the value at the given dotted `path` through the objects of the
+    document (for example, 'data.items' for the `items` array of the `data`
+    object). As for `udict` keys, a '-' in the keys of the document matches
+    a '_' in `path`. Each element is decoded as described for
+    `udict.fromJSON`, using the given `cls`, `backend`, and any keyword
+    arguments.
+
+    The parser only tracks the structure of the document, so it doesn't
+    detect every syntax error outside of the elements themselves.
+
+    Usage:
+
+        parser = JSONArrayParser('data.items')
+        for chunk in chunks:
+            for item in parser.feed(chunk):
+                ...
+        parser.close()
+    """
+
+    def __init__(self, path=None, cls=udict, backend=None, **kwargs):
+        backend = get_json_backend(backend)
+        self.decode = backend.decoder(cls, **kwargs)
+        self.raw_decode = backend.raw_decoder(cls, **kwargs)
+        self.path = tuple(token.replace("-", "_")
+                          for token in (path.split(".") if path else ()))
+        #: whether the end of the array has been reached
+        self.done = False
+        self._bytes = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""  # the last chunk fed
+        # the text of the current element (or key) in the earlier chunks
+        self._pending = []
+        # one [is_object, key, expecting_key] list per open object or array
+        self._stack = []
+        self._depth = None  # the depth of the array once it is found
+        # the position in `_buf` of the current element, or of the current
+        # key if it is split between chunks
+        self._start = None
+        # [is_key, escaped] if `_buf` ends within a string
+        self._string = None
+
+    def feed(self, data):
+        """
+        Feed the next chunk `data` (`str` or `bytes`) of the document to the
+        parser, and return a list of the elements completed by it.
+        """
+        if isinstance(data, bytes) and not isinstance(data, str):
+            data = self._bytes.decode(data)
+        if self.done:
+            return []
+        self._buf = data
+        values = self._scan()
+        # Each chunk is only scanned once, so only the part of the current
+        # element (or key) in it is kept, to be joined when it's complete.
+        if self._start is not None and not self.done:
+            self._pending.append(data[self._start:])
+            self._start = 0
+        return values
+
+    def close(self):
+        """
+        Signal the end of the document, raising `ValueError` if the end of
+        the array wasn't reached.
+        """
+        if not self.done:
+            if self._depth is None:
+                raise ValueError("no JSON array found")
+            raise ValueError("incomplete JSON array")
+
+    def _scan(self):
+        buf, stack = self._buf, self._stack
+        search = _STRUCTURAL.search
+        values = []
+        pos = 0
+        if self._string is not None:
+            # resume the string that the previous chunk ended within
+            is_key, escaped = self._string
+            pos, escaped = _string_end(buf, 0, escaped)
+            if pos is None:
+                self._string[1] = escaped
+                return values
+            self._string = None
+            if is_key:
+                self._key(self._text(buf, pos))
+                self._start = None
+        while True:
+            match = search(buf, pos)
+            if match is None:
+                break
+            index = match.start()
+            char = buf[index]
+            if char == '"':
+                is_key = self._depth is None and stack and stack[-1][2]
+                pos, escaped = _string_end(buf, index + 1, False)
+                if pos is None:
+                    # wait for the rest of the string
+                    self._string = [is_key, escaped]
+                    if is_key:
+                        self._start = index
+                    break
+                if is_key:
+                    self._key(buf[index:pos])
+                continue
+            pos = index + 1
+            if char == "{":
+                stack.append([True, None, True])
+            elif char == "[":
+                found = self._depth is None and self._found()
+                stack.append([False, None, False])
+                if found:
+                    self._depth = len(stack)
+                    self._start = pos
+                    pos = self._element(values, buf, pos)
+            elif char == ",":
+                if self._depth == len(stack):
+                    self._emit(values, self._text(buf, index))
+                    self._start = pos
+                    pos = self._element(values, buf, pos)
+                elif stack:
+                    stack[-1][2] = stack[-1][0]
+            else:
+                if self._depth == len(stack):
+                    self._emit(values, self._text(buf, index))
+                    self._start = None
+                    self.done = True
+                    break
+                if stack:
+                    stack.pop()
+        return values
+
+    def _text(self, buf, end):
+        # the text from `_start` (which may be in an earlier chunk) to `end`
+        text = buf[self._start:end]
+        if self._pending:
+            self._pending.append(text)
+            text = "".join(self._pending)
+            self._pending = []
+        return text
+
+    def _key(self, key):
+        # set the key of the current object to the JSON string `key`
+        key = json.loads(key) if "\\" in key else key[1:-1]
+        self._stack[-1][1] = key.replace("-", "_")
+        self._stack[-1][2] = False
+
+    def _found(self):
+        # whether the array at the current position is the one to parse
+        stack, path = self._stack, self.path
+        if len(stack) != len(path):
+            return False
+        for (is_object, key, _), token in zip(stack, path):
+            if not is_object or key != token:
+                return False
+        return True
+
+    def _element(self, values, buf, pos):
+        # Decode the element starting at `pos` in one go if the backend
+        # supports it and the element is complete, returning the position
+        # after it, or else leave it to be scanned and decoded when its
+        # end is found, returning `pos`. The decoded value may only be a
+        # prefix of a number split between chunks (like '1.' of '1.25'), so
+        # it's only complete if it's followed by a ',' or ']' in `buf`.
+        if self.raw_decode is None:
+            return pos
+        start = _WHITESPACE.match(buf, pos).end()
+        if start >= len(buf) or buf[start] == "]":
+            return pos
+        try:
+            value, end = self.raw_decode(buf, start)
+        except ValueError:
+            return pos
+        after = _WHITESPACE.match(buf, end).end()
+        if after >= len(buf) or buf[after] not in ",]":
+            return pos
+        values.append(value)
+        self._start = end
+        return end
+
+    def _emit(self, values, text):
+        if text.strip():
+            values.append(self.decode(text))
+
+
+# The compact binary format of `udict.to_bytes`, which is a header followed
+# by the encoded values. Each value is a tag byte followed by its data:
+#
+# - None, True, and False are just their tags
+# - an int from 0 to 127 is the tag 0x80 + the int, and any other int is
+#   the _INT tag and the int as a zigzag varint (of any size)
+# - a float is the _FLOAT tag and the float as a little-endian double
+# - a str is the _STR tag, the varint length of its UTF-8 encoding, and
+#   the encoding, or the tag 0x40 + the length if it's less than 64
+# - bytes are the _BYTES tag, the varint length, and the bytes
+# - a list or tuple is its tag, the varint length, and the items
+# - a udict or other dict is its tag, the varint length, and the key and
+#   value of each item
+#
+# A key is a varint n: if n is odd, a str key of (n >> 1) bytes of UTF-8
+# follows and is added to the key table; if n is 0, a key that isn't a
+# str follows, encoded like a value; and otherwise, the key is the one at
+# index (n >> 1) - 1 in the key table. The key table is shared by all the
+# values (see `udict.to_bytes_many`), so each key is only written once.
+#
+# A varint is an unsigned int written 7 bits at a time, least significant
+# bits first, with the high bit set in each byte but the last, and a
+# zigzag varint is the varint 2n for n >= 0, or -2n - 1 for n < 0.
+
+_BINARY_HEADER = b"UD\x01"
+_NONE, _TRUE, _FALSE, _INT, _FLOAT, _STR, _BYTES = range(7)
+_LIST, _TUPLE, _UDICT, _DICT = range(7, 11)
+_SHORT_STR = 0x40
+_SMALL_INT = 0x80
+_DOUBLE = struct.Struct("<d")
+_TEXT = type(u"")
+_INTS = (int, type(2 ** 64))
+
+
+def _as_text(value):
+    # the text of an instance of a subclass of str, as a str (unlike
+    # `str(value)`, which may be overridden, as it is by an enum)
+    return _TEXT.__getitem__(value, slice(None))
+
+
+def _write_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data, pos, n):
+    # the rest of the varint whose first byte `n` is before `pos`
+    n &= 0x7F
+    shift = 7
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _encode_binary(values, out, keys):
+    """
+    Append the encoding of each of the `values` to the `bytearray` `out`,
+    using and extending the key table `keys` (a dict of the index of each
+    key), as described above.
+
+    The containers are encoded using an explicit stack of the iterators
+    over their items rather than recursion.
+    """
+    stack = [(iter(values), False)]
+    while stack:
+        items, pairs = stack[-1]
+        for value in items:
+            if pairs:
+                key, value = value
+                if type(key) is not _TEXT and isinstance(key, _TEXT):
+                    # a subclass (like an enum) is stored as its text, so
+                    # it must share the table entry of an equal str key
+                    key = _as_text(key)
+                index = keys.get(key) if type(key) is _TEXT else None
+                if index is not None:
+                    index = index * 2 + 2
+                    if index < 0x80:
+                        out.append(index)
+                    else:
+                        _write_varint(out, index)
+                elif type(key) is _TEXT:
+                    data = key.encode("utf-8", "surrogatepass")
+                    keys[key] = len(keys)
+                    _write_varint(out, len(data) * 2 + 1)
+                    out += data
+                else:
+                    out.append(0)
+                    _encode_binary((key,), out, keys)
+            cls = type(value)
+            if cls is _TEXT:
+                data = value.encode("utf-8", "surrogatepass")
+                if len(data) < 0x40:
+                    out.append(_SHORT_STR + len(data))
+                else:
+                    out.append(_STR)
+                    _write_varint(out, len(data))
+                out += data
+            elif cls in _INTS:
+                if 0 <= value < 0x80:
+                    out.append(_SMALL_INT + value)
+                else:
+                    out.append(_INT)
+                    _write_varint(out, value * 2 if value >= 0
+                                  else -value * 2 - 1)
+            elif value is None:
+                out.append(_NONE)
+            elif value is True:
+                out.append(_TRUE)
+            elif value is False:
+                out.append(_FALSE)
+            elif cls is float:
+                out.append(_FLOAT)
+                out += _DOUBLE.pack(value)
+            elif isinstance(value, dict):
+                out.append(_UDICT if isinstance(value, udict) else _DICT)
+                _write_varint(out, len(value))
+                if value:
+                    stack.append((iter(iteritems(value)), True))
+                    break
+            elif cls is list or cls is tuple:
+                out.append(_LIST if cls is list else _TUPLE)
+                _write_varint(out, len(value))
+                if value:
+                    stack.append((iter(value), False))
+                    break
+            elif isinstance(value, bytes):
+                out.append(_BYTES)
+                _write_varint(out, len(value))
+                out += value
+            else:
+                # a subclass (like an enum) of one of the types above
+                if isinstance(value, _TEXT):
+                    _encode_binary((_as_text(value),), out, keys)
+                    continue
+                for base in (int, float, list, tuple):
+                    if isinstance(value, base):
+                        _encode_binary((base(value),), out, keys)
+                        break
+                else:
+                    raise TypeError("can't encode a value of type %r" %
+                                    (cls.__name__,))
+        else:
+            stack.pop()
+
+
+def _decode_binary(data, pos, cls, keys):
+    """
+    Return the value encoded at `pos` in `data`, with each encoded udict
+    decoded to an instance of `cls`, using and extending the key table
+    `keys` (a list), and the position after it.
+
+    The containers are decoded using an explicit stack of the unfinished
+    containers rather than recursion. Each is added to its parent before
+    its items are decoded, except that a tuple is decoded as a list and
+    replaces it when it is complete, so each entry of the stack is a list
+    of the container, the number of items still to be decoded, its tag,
+    its parent, and its index or key in its parent.
+    """
+    # (local names are faster than globals in this loop)
+    setitem = dict.__setitem__
+    read_varint = _read_varint
+    short_str, small_int = _SHORT_STR, _SMALL_INT
+    root = []
+    stack = [[root, 1, _LIST, None, None]]
+    while stack:
+        frame = stack[-1]
+        container, count, tag = frame[0], frame[1], frame[2]
+        pairs = tag >= _UDICT
+        while count:
+            count -= 1
+            if pairs:
+                n = data[pos]
+                pos += 1
+                if n >= 0x80:
+                    n, pos = read_varint(data, pos, n)
+                if n & 1:
+                    end = pos + (n >> 1)
+                    key = data[pos:end].decode("utf-8", "surrogatepass")
+                    keys.append(key)
+                    pos = end
+                elif n:
+                    key = keys[(n >> 1) - 1]
+                else:
+                    key, pos = _decode_binary(data, pos, cls, keys)
+            else:
+                key = len(container)
+            value = data[pos]
+            pos += 1
+            if value >= small_int:
+                value -= small_int
+            elif value >= short_str:
+                end = pos + value - short_str
+                value = data[pos:end].decode("utf-8", "surrogatepass")
+                pos = end
+            elif value == _NONE:
+                value = None
+            elif value == _TRUE:
+                value = True
+            elif value == _FALSE:
+                value = False
+            elif value == _FLOAT:
+                value = _DOUBLE.unpack_from(data, pos)[0]
+                pos += 8
+            elif value > _DICT:
+                raise ValueError("invalid tag %d at %d" % (value, pos - 1))
+            else:
+                value_tag = value
+                n = data[pos]
+                pos += 1
+                if n >= 0x80:
+                    n, pos = read_varint(data, pos, n)
+                if value_tag == _INT:
+                    value = n >> 1 if not n & 1 else -(n >> 1) - 1
+                elif value_tag == _STR:
+                    value = data[pos:pos + n].decode("utf-8", "surrogatepass")
+                    pos += n
+                elif value_tag == _BYTES:
+                    value = bytes(data[pos:pos + n])
+                    pos += n
+                elif value_tag >= _UDICT:
+                    value = dict.__new__(cls) if value_tag == _UDICT else {}
+                elif n or value_tag == _LIST:
+                    value = []
+                else:
+                    value = ()
+                if n and value_tag >= _LIST:
+                    if pairs:
+                        setitem(container, key, value)
+                    else:
+                        container.append(value)
+                    frame[1] = count
+                    stack.append([value, n, value_tag, container, key])
+                    break
+            if pairs:
+                setitem(container, key, value)
+            else:
+                container.append(value)
+        else:
+            stack.pop()
+            if tag == _TUPLE:
+                parent = frame[3]
+                if type(parent) is list:
+                    parent[frame[4]] = tuple(container)
+                else:
+                    setitem(parent, frame[4], tuple(container))
+    return root[0], pos
+
+
+def _iter_binary(data, cls):
+    """
+    Generate the values encoded (as by `udict.to_bytes_many`) in the
+    `bytes` `data`, with each udict decoded to an instance of `cls`,
+    raising `ValueError` if it isn't a valid encoding.
+    """
+    data = bytearray(data)
+    if data[:len(_BINARY_HEADER)] != _BINARY_HEADER:
+        raise ValueError("not a udict binary encoding")
+    keys = []
+    pos = len(_BINARY_HEADER)
+    while pos < len(data):
+        try:
+            value, pos = _decode_binary(data, pos, cls, keys)
+        except (IndexError, struct.error):
+            pos = len(data) + 1
+        if pos > len(data):
+            raise ValueError("invalid or truncated udict binary "
+                             "encoding")
+        yield value
+
+
+# helper to do careful and consistent `obj[name]`
+def _get(obj, name):
+    """
+    Get the indexable value with given `name` from `obj`, which may be
+    a `dict` (or subclass) or a non-dict that has a `__getitem__` method.
+    """
+    try:
+        # try to get value using dict's __getitem__ descriptor first
+        return dict.__getitem__(obj, name)
+    except TypeError:
+        # if it's a dict, then preserve the TypeError
+        if isinstance(obj, dict):
+            raise
+        # otherwise try one last time, relying on __getitem__ if any
+        return obj[name]
+
+
+# helper for common use case of traversing a path like 'a.b.c.d'
+# to get the 'a.b.c' object and do something to it with the 'd' token
+def _descend(obj, key):
+    """
+    Descend on `obj` by splitting `key` on '.' (`key` must contain at least
+    one '.') and using `get` on each token that results from splitting
+    to fetch the successive child elements, stopping on the next-to-last.
+
+     A `__getitem__` would do `dict.__getitem__(value, token)` with the
+     result, and a `__setitem__` would do `dict.__setitem__(value, token, v)`.
+
+    :returns:
+    (value, token) - `value` is the next-to-last object found, and
+    `token` is the last token in the `key` (the only one that wasn't consumed
+    yet).
+    """
+    path = _compile(key)
+    if not path.parents:
+        raise ValueError(key)
+    return path.parent(obj), path.token
+
+
+# the sequence types that are copied when converting with `lists=True`
+_SEQUENCES = (list, tuple)
+
+
+def _convert(root, cls, source, lists, hyphens=False):
+    """
+    Convert the `root` dict into an instance of `cls`, also converting
+    every nested value that is an instance of `source`, and copying
+    `list` and `tuple` values (not subclasses) if `lists` is true.
+    If `hyphens` is true, each '-' in the (string) keys of the converted
+    dicts is replaced by '_', as for JSON decoded by `udict.fromJSON`.
+    A `root` that is a list or tuple is copied and converted likewise.
+
+    This is the engine of `udict.fromdict` and `udict.todict`. Each
+    container is first copied in bulk and then scanned for the values that
+    need converting in turn, using an explicit stack of the copies still
+    to be scanned rather than recursion, so there is no limit on the depth
+    of `root`.
+    """
+    if cls is dict:
+        copy = dict
+    elif not hyphens:
+        def copy(mapping):
+            return _new(cls, mapping)
+    else:
+        def copy(mapping):
+            obj = _new(cls, mapping)
+            for key in mapping:
+                if "-" in key:
+                    value = dict.pop(obj, key)
+                    dict.__setitem__(obj, key.replace("-", "_"), value)
+            return obj
+    setitem = dict.__setitem__
+    if isinstance(root, source):
+        result = copy(root)
+    elif type(root) in _SEQUENCES:
+        result = list(root)
+    else:
+        return root
+    pending = [result]
+    push = pending.append
+    pop = pending.pop
+    tuples = []
+    while pending:
+        obj = pop()
+        if type(obj) is list:
+            for index, value in enumerate(obj):
+                if isinstance(value, source):
+                    obj[index] = value = copy(value)
+                    push(value)
+                elif type(value) in _SEQUENCES:
+                    if type(value) is tuple:
+                        tuples.append((obj, index))
+                    obj[index] = value = list(value)
+                    push(value)
+        elif cls is dict:
+            # plain dicts can use the (much faster) subscript assignment
+            for key, value in obj.items():
+                if isinstance(value, source):
+                    obj[key] = value = copy(value)
+                    push(value)
+                elif lists and type(value) in _SEQUENCES:
+                    if type(value) is tuple:
+                        tuples.append((obj, key))
+                    obj[key] = value = list(value)
+                    push(value)
+        else:
+            for key, value in iteritems(obj):
+                if isinstance(value, source):
+                    value = copy(value)
+                    setitem(obj, key, value)
+                    push(value)
+                elif lists and type(value) in _SEQUENCES:
+                    if type(value) is tuple:
+                        tuples.append((obj, key))
+                    value = list(value)
+                    setitem(obj, key, value)
+                    push(value)
+    # a tuple can only be created once its contents are complete, which
+    # happens for inner tuples before outer ones, so create them in reverse
+    for obj, key in reversed(tuples):
+        if type(obj) is list or cls is dict:
+            obj[key] = tuple(obj[key])
+        else:
+            setitem(obj, key, tuple(dict.__getitem__(obj, key)))
+    if type(root) is tuple:
+        result = tuple(result)
+    return result
+
+
+# a `_project` tree entry for the last token of a dotted key
+_ALL = object()
+
+
+def _paths(keys, hyphens):
+    """
+    Return a tree for `_project` of the dotted `keys`, with each '-' in them
+    replaced by '_' if `hyphens` is true. Each node of the tree is a dict
+    that maps a token to either a child node or `_ALL` if a key ends there.
+    """
+    root = {}
+    for key in keys:
+        if hyphens and isinstance(key, _STRINGS):
+            key = key.replace("-", "_")
+        tokens = _compile(key).tokens if isinstance(key, _STRINGS) else (key,)
+        node = root
+        for token in tokens[:-1]:
+            node = node.setdefault(token, {})
+            if node is _ALL:
+                break
+        else:
+            node[tokens[-1]] = _ALL
+    return root
+
+
+def _project(root, cls, lists, keep, drop, hyphens=False):
+    """
+    Convert `root` like `_convert(root, cls, dict, lists, hyphens)`, but
+    leave out everything not selected by the dotted keys in `keep` (unless
+    it is `None`) or selected by those in `drop`.
+
+    Each container still to be filled is pushed on a stack along with the
+    `keep` and `drop` tree nodes (see `_paths`) for its level, where a
+    `None` node doesn't restrict anything, and the unrestricted values are
+    converted by `_convert`.
+    """
+    if keep is not None:
+        keep = _paths(keep, hyphens)
+    if drop is not None:
+        drop = _paths(drop, hyphens) or None
+    pending = []
+    tuples = []
+
+    def project(value, keep, drop):
+        # return the projection of `value`, or `_MISSING` if there is none
+        if keep is None and drop is None:
+            if isinstance(value, dict) or (lists and
+                                           type(value) in _SEQUENCES):
+                return _convert(value, cls, dict, lists, hyphens)
+            return value
+        if isinstance(value, dict):
+            child = _new(cls)
+        elif type(value) in _SEQUENCES:
+            child = []
+        else:
+            # a scalar where `keep` expects a dict doesn't match
+            return value if keep is None else _MISSING
+        pending.append((value, child, keep, drop))
+        return child
+
+    result = project(root, keep, drop)
+    while pending:
+        src, dst, keep, drop = pending.pop()
+        if type(dst) is list:
+            for item in src:
+                value = item
+                if isinstance(item, dict) or type(item) in _SEQUENCES:
+                    value = project(item, keep, drop)
+                    if type(item) is tuple and type(value) is list:
+                        tuples.append((dst, len(dst)))
+                dst.append(value)
+            continue
+        for key, item in iteritems(src):
+            if hyphens and isinstance(key, _STRINGS) and "-" in key:
+                key = key.replace("-", "_")
+            subkeep = subdrop = None
+            if keep is not None:
+                subkeep = keep.get(key)
+                if subkeep is None:
+                    continue
+                if subkeep is _ALL:
+                    subkeep = None
+            if drop is not None:
+                subdrop = drop.get(key)
+                if subdrop is _ALL:
+                    continue
+            value = project(item, subkeep, subdrop)
+            if value is _MISSING:
+                continue
+            if type(item) is tuple and type(value) is list:
+                tuples.append((dst, key))
+            dict.__setitem__(dst, key, value)
+    for obj, key in reversed(tuples):
+        if type(obj) is list:
+            obj[key] = tuple(obj[key])
+        else:
+            dict.__setitem__(obj, key, tuple(dict.__getitem__(obj, key)))
+    if type(root) is tuple and type(result) is list:
+        result = tuple(result)
+    return result
+
+
+def _trie(keys):
+    """
+    Group `keys` by their tokens into a prefix tree, for the batch methods
+    of `udict`.
+
+    Each node of the tree is a dict that maps a token to an
+    `(indexes, children)` pair, where `indexes` is a list of the indexes
+    in `keys` of the keys that end with that token, and `children` is
+    the node of the keys that continue past it.
+    """
+    root = {}
+    for index, key in enumerate(keys):
+        if isinstance(key, str) and "." in key:
+            tokens = _compile(key).tokens
+        else:
+            tokens = (key,)
+        node = root
+        for token in tokens[:-1]:
+            entry = node.get(token)
+            if entry is None:
+                entry = node[token] = ([], {})
+            node = entry[1]
+        entry = node.get(tokens[-1])
+        if entry is None:
+            entry = node[tokens[-1]] = ([], {})
+        entry[0].append(index)
+    return root
+
+
+class dotpath(object):
+
+    """
+    A precompiled dotted key, for repeated hierarchical lookups.
+
+    Like `operator.itemgetter`, a `dotpath` is created once and then
+    applied to any number of objects, so the cost of splitting the key
+    into its tokens is paid only once:
+
+        code = dotpath('result.status.code')
+        code(ud)  # equivalent to ud['result.status.code']
+        code.get(ud, 500)  # equivalent to ud.get('result.status.code', 500)
+
+    The traversal is identical to that of the dotted-key support in
+    `udict.__getitem__` and friends, so a `dotpath` works with any
+    `dict` (or object supporting `__getitem__`), not only with a `udict`.
+    """
+
+    __slots__ = ("key", "tokens", "parents", "token")
+
+    def __init__(self, key):
+        self.key = key
+        self.tokens = tuple(key.split("."))
+        self.parents = self.tokens[:-1]
+        self.token = self.tokens[-1]
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.key)
+
+    def parent(self, obj):
+        """
+        Return the object that holds the last token of this path, i.e.,
+        the result of traversing all but the last token starting at `obj`.
+        """
+        for token in self.parents:
+            obj = _get(obj, token)
+        return obj
+
+    def __call__(self, obj):
+        """
+        Return the value at this path in `obj`, raising `KeyError` or
+        `TypeError` in the same cases as `udict.__getitem__`.
+        """
+        for token in self.parents:
+            obj = _get(obj, token)
+        return _get(obj, self.token)
+
+    def get(self, obj, default=None):
+        """
+        Return the value at this path in `obj`, or `default` if some
+        token along the path is missing.
+        """
+        try:
+            return self(obj)
+        except KeyError:
+            return default
+
+    def set(self, obj, value):
+        """
+        Set `value` at this path in `obj`. Every token but the last must
+        already exist, or `KeyError` is raised.
+        """
+        parent = _mutable(self.parent(obj))
+        dict.__setitem__(parent, self.token, value)
+        _touch(parent, (self.token,))
+
+    def delete(self, obj):
+        """
+        Remove the mapping at this path in `obj`, raising `KeyError` if
+        there is no such mapping.
+        """
+        del self.parent(obj)[self.token]
+
+    def exists(self, obj):
+        """
+        Return whether there is a mapping at this path in `obj`.
+        """
+        return self.get(obj, _MISSING) is not _MISSING
+
+
+# Cache of the keys with each '-' replaced by '_' (for `udict.__init__`),
+# emptied like the cache of compiled dotted keys below when it fills up.
+_MAXHYPHENS = 512
+_hyphens = {}
+
+
+def _unhyphenate(obj):
+    """
+    Replace each '-' in the string keys of the dict `obj` with '_'.
+    """
+    try:
+        # when all the keys are strings, a single search of them all
+        # is enough to find out if there's anything to replace
+        if "-" not in "\0".join(obj):
+            return
+    except TypeError:
+        pass
+    keys = [key for key in obj if isinstance(key, _STRINGS) and "-" in key]
+    for key in keys:
+        new = _hyphens.get(key)
+        # (on python 2, an equal str key may have been cached for unicode)
+        if type(new) is not type(key):
+            new = key.replace("-", "_")
+            if len(_hyphens) >= _MAXHYPHENS:
+                _hyphens.clear()
+            _hyphens[key] = new
+        dict.__setitem__(obj, new, dict.pop(obj, key))
+
+
+# Cache of compiled dotted keys used by the dotted-key support of `udict`.
+# Like the `re` module's cache, it is simply emptied when it fills up.
+_MAXCACHE = 512
+_cache = {}
+
+
+def _compile(key):
+    """
+    Return the (possibly cached) `dotpath` for the dotted string `key`.
+    """
+    try:
+        return _cache[key]
+    except KeyError:
+        pass
+    path = dotpath(key)
+    if len(_cache) >= _MAXCACHE:
+        _cache.clear()
+    _cache[key] = path
+    return path
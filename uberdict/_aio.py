@@ -0,0 +1,81 @@
+"""
+The asyncio versions of the JSON loaders of `udict` (`udict.afromJSON` and
+`udict.aiter_json_lines`), which are kept in their own module as they need
+python 3.6 or later.
+"""
+import asyncio
+import functools
+
+
+async def _run(func, size, executor, offload_size):
+    """
+    Return the result of `func()`, which works on `size` characters (or
+    bytes) of JSON, running it in `executor` if `size` is at least
+    `offload_size`, so that it doesn't block the event loop.
+    """
+    if offload_size is None or size < offload_size:
+        return func()
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, func)
+
+
+async def afromJSON(cls, reader, chunk_size, executor, offload_size,
+                    kwargs):
+    chunks = []
+    while True:
+        chunk = await reader.read(chunk_size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    data = chunks[0][:0].join(chunks) if chunks else ""
+    return await _run(functools.partial(cls.fromJSON, data, **kwargs),
+                      len(data), executor, offload_size)
+
+
+def _decode_lines(cls, lines, start, kwargs):
+    return list(cls.iter_json_lines(lines, start=start, **kwargs))
+
+
+async def aiter_json_lines(cls, reader, batch_size, chunk_size, executor,
+                           offload_size, kwargs):
+    # the chunks read since the last newline, which are only searched for
+    # a newline once each, and joined once a newline ends the line
+    pending = []
+    empty = None
+    lineno = kwargs.pop("start", 1)
+    batch = []
+    while True:
+        chunk = await reader.read(chunk_size)
+        if empty is None:
+            if not chunk:
+                return
+            empty = chunk[:0]
+            newline = "\n" if isinstance(chunk, str) else b"\n"
+        if chunk:
+            end = chunk.rfind(newline) + 1
+            if not end:
+                pending.append(chunk)
+                continue
+            pending.append(chunk[:end])
+            complete = empty.join(pending)
+            pending = [chunk[end:]]
+            lines = complete.split(newline)[:-1]
+        else:
+            # the last line, without a newline at the end
+            complete = empty.join(pending)
+            lines = [complete]
+        func = functools.partial(_decode_lines, cls, lines, lineno, kwargs)
+        values = await _run(func, len(complete), executor, offload_size)
+        lineno += len(lines)
+        for value in values:
+            if batch_size is None:
+                yield value
+                continue
+            batch.append(value)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if not chunk:
+            break
+    if batch:
+        yield batch